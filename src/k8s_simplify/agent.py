@@ -0,0 +1,139 @@
+"""Client side of the persistent remote agent.
+
+The agent (:mod:`k8s_simplify.remote_agent`) is uploaded to
+``~/.k8s_simplify`` on the first connection to a host and then serves all
+requests over the stdin and stdout of a single long-lived SSH command. Each
+request is a length-prefixed JSON frame with an id, so many requests can be
+in flight on the same channel without paying for a new exec each.
+"""
+
+import base64
+from concurrent.futures import Future
+import hashlib
+from importlib import resources
+import itertools
+import json
+import struct
+import subprocess
+import threading
+from typing import Any, Dict, Optional
+
+from .connection import ssh_command, ssh_env
+
+# Seconds to wait for a freshly started agent to answer
+START_TIMEOUT = 30.0
+
+_SOURCE = resources.files(__package__).joinpath("remote_agent.py").read_bytes()
+# The file name changes with the agent source so hosts never run a stale copy
+_AGENT_PATH = f"$HOME/.k8s_simplify/agent-{hashlib.sha256(_SOURCE).hexdigest()[:12]}.py"
+
+
+class AgentError(Exception):
+    """Raised when the agent of a host is not reachable."""
+
+
+def launch_command() -> str:
+    """Return the remote command uploading the agent if needed and running it."""
+    encoded = base64.b64encode(_SOURCE).decode()
+    return (
+        f'f="{_AGENT_PATH}"; '
+        'if [ ! -s "$f" ]; then '
+        f'mkdir -p "$(dirname "$f")" && printf %s {encoded} | base64 -d > "$f.tmp" '
+        '&& mv "$f.tmp" "$f" || exit 127; fi; '
+        'exec python3 -u "$f"'
+    )
+
+
+class AgentSession:
+    """One running agent on a host, shared by all threads and event loops.
+
+    Replies are read by a background thread and delivered through
+    :class:`concurrent.futures.Future` objects, which asyncio callers can
+    await with :func:`asyncio.wrap_future`.
+    """
+
+    def __init__(self, ip: str, user: str, password: str):
+        self._proc = subprocess.Popen(
+            ssh_command(ip, user, password, launch_command()),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=ssh_env(password),
+        )
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Future] = {}
+        self._closed = False
+        threading.Thread(target=self._read_replies, daemon=True).start()
+        try:
+            self.submit({"op": "ping"}).result(START_TIMEOUT)
+        except Exception as exc:
+            self.close()
+            raise AgentError(f"Agent did not start on {ip}") from exc
+
+    @property
+    def alive(self) -> bool:
+        return not self._closed
+
+    def submit(self, request: Dict[str, Any]) -> Future:
+        """Send ``request`` and return a future resolving to its reply."""
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise AgentError("Agent connection closed")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            data = json.dumps({**request, "id": request_id}).encode()
+            try:
+                self._proc.stdin.write(struct.pack(">I", len(data)) + data)
+                self._proc.stdin.flush()
+            except OSError as exc:
+                del self._pending[request_id]
+                raise AgentError("Agent connection closed") from exc
+        return future
+
+    def _read_replies(self) -> None:
+        stdout = self._proc.stdout
+        try:
+            while True:
+                head = stdout.read(4)
+                if len(head) < 4:
+                    return
+                reply = json.loads(stdout.read(struct.unpack(">I", head)[0]))
+                with self._lock:
+                    future = self._pending.pop(reply.get("id"), None)
+                if future is not None:
+                    future.set_result(reply)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                self._closed = True
+                pending, self._pending = list(self._pending.values()), {}
+            for future in pending:
+                future.set_exception(AgentError("Agent connection closed"))
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+
+
+def start_session(ip: str, user: str, password: str) -> Optional[AgentSession]:
+    """Start the agent of a host, or return None if that is not possible.
+
+    Hosts without ``python3`` (or ``base64``) cannot run the agent and are
+    served by plain SSH commands instead.
+    """
+    try:
+        return AgentSession(ip, user, password)
+    except (AgentError, OSError, RuntimeError):
+        return None
@@ -0,0 +1,317 @@
+"""Simulated-fleet benchmark for the orchestration overhead.
+
+The engine transport is replaced by an in-process fake transport
+that answers every command after a configurable latency and jitter and fails
+a configurable fraction of them. ``install``, ``update`` and ``rollback`` then
+run end to end against ``N`` virtual nodes, and the wall time, SSH execs per
+node and peak concurrency are reported::
+
+    python -m k8s_simplify.benchmark --nodes 50 --latency 0.05 --parallel 10
+"""
+
+import argparse
+import asyncio
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field, replace
+import io
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .cli import build_parser
+from .engine import set_transport
+from .images import _PULL_MARKER
+from .output import LineCallback
+from .phase1 import _PROBE_MARKER, _STEP_MARKER
+from .ratelimit import LIMITS
+from .ratelimit import configure as configure_limits
+from .retry import POLICIES
+from .rollback import _PREPARED_MARKER
+from .transport import CommandResult, Input, Transport
+
+SCENARIOS = ["install", "update", "rollback"]
+# Simulated failures are transient, so the retry policies apply to them
+_FAILURE = "Connection reset by peer"
+
+
+@dataclass
+class FakeFleet(Transport):
+    """Fake transport answering commands for a fleet of virtual nodes."""
+
+    hosts: List[str]
+    latency: float = 0.05
+    jitter: float = 0.02
+    failure_rate: float = 0.0
+    seed: Optional[int] = None
+    execs: Dict[str, int] = field(default_factory=dict)
+    peak: int = 0
+    _inflight: int = 0
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._random = random.Random(self.seed)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.execs.clear()
+            self.peak = 0
+
+    def _node_lines(self, fmt: str) -> str:
+        return "\n".join(
+            fmt.format(name=f"node-{i}", ip=ip) for i, ip in enumerate(self.hosts)
+        )
+
+    def _node_list(self, command: str) -> str:
+        items = [
+            {
+                "kind": "Node",
+                "metadata": {"name": f"node-{i}"},
+                "status": {
+                    "addresses": [{"type": "InternalIP", "address": ip}],
+                    "conditions": [{"type": "Ready", "status": "True"}],
+                },
+            }
+            for i, ip in enumerate(self.hosts)
+        ]
+        names = set(command.split()[3:])
+        if "--ignore-not-found" in names:
+            items = [item for item in items if item["metadata"]["name"] in names]
+        return json.dumps({"kind": "List", "items": items})
+
+    def _fails(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def _respond(self, command: str, script: str) -> CommandResult:
+        if script:
+            return self._respond_script(script)
+        if self._fails():
+            return CommandResult("", command, 255, "", _FAILURE, 0.0)
+        stdout = ""
+        if "/etc/kubernetes/admin.conf" in command and "test" in command:
+            # Virtual masters are not initialized yet
+            return CommandResult("", command, 1, "", "", 0.0)
+        if _PREPARED_MARKER in command:
+            # Packages survive the reset on virtual nodes
+            stdout = _PREPARED_MARKER
+        elif "apt-cache madison" in command:
+            stdout = " kubeadm | 1.33.1-1.1 | https://pkgs.k8s.io/core:/stable:/v1.33/deb  Packages"
+        elif "kubelet --version" in command:
+            stdout = "Kubernetes v1.33.0"
+        elif "systemctl is-active" in command:
+            stdout = "active"
+        elif "kubeadm token create" in command:
+            stdout = (
+                f"kubeadm join {self.hosts[0]}:6443 --token abcdef.0123456789abcdef "
+                "--discovery-token-ca-cert-hash sha256:" + "0" * 64
+            )
+        elif "kubectl get nodes" in command and "-o json" in command:
+            stdout = self._node_list(command)
+        elif "kubectl get nodes" in command:
+            stdout = self._node_lines("{name} Ready <none> 1m v1.33.0 {ip}")
+        elif "create token" in command:
+            stdout = "fake-dashboard-token"
+
+        return CommandResult("", command, 0, stdout, "", 0.0)
+
+    def _respond_script(self, script: str) -> CommandResult:
+        lines = []
+        if _STEP_MARKER in script:
+            steps = script.count(f"printf '{_STEP_MARKER} ")
+            for idx in range(steps):
+                if self._fails():
+                    lines += [_FAILURE, f"{_STEP_MARKER} {idx} 1 0 1000000"]
+                    break
+                lines.append(f"{_STEP_MARKER} {idx} 0 0 1000000")
+        elif _PULL_MARKER in script:
+            lines.append(f"{_PULL_MARKER} 0 {self._random.randint(1, 500) << 20}")
+        elif _PROBE_MARKER in script:
+            # Virtual nodes start empty, so no step is converged
+            for idx in re.findall(rf"{_PROBE_MARKER} (\d+)", script):
+                lines.append(f"{_PROBE_MARKER} {idx} 1")
+        else:
+            for name in re.findall(r"printf '(\w+)\\t", script):
+                value = "Kubernetes v1.33.0" if name == "kubelet_version" else "active"
+                lines.append(f"{name}\t0\t{value}")
+        return CommandResult("", "bash -s", 0, "\n".join(lines) + "\n", "", 0.0)
+
+    async def run(
+        self,
+        ip: str,
+        user: str,
+        password: str,
+        command: str,
+        input: Optional[Input],
+        timeout: Optional[float],
+        on_line: Optional[LineCallback] = None,
+    ) -> CommandResult:
+        """Simulate one SSH exec on a virtual node."""
+        with self._lock:
+            self.execs[ip] = self.execs.get(ip, 0) + 1
+            self._inflight += 1
+            self.peak = max(self.peak, self._inflight)
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+        script = input if isinstance(input, str) else ""
+        result = self._respond(command, script)
+        result.host = ip
+        result.duration = delay
+        if on_line is not None:
+            for line in result.stdout.splitlines():
+                on_line(line, False)
+            for line in result.stderr.splitlines():
+                on_line(line, True)
+        return result
+
+
+@dataclass
+class BenchResult:
+    scenario: str
+    ok: bool
+    wall: float
+    execs: Dict[str, int]
+    peak: int
+
+
+def _scenario_args(
+    scenario: str, hosts: List[str], parallel: int, journal_dir: str
+) -> List[str]:
+    master, workers = hosts[0], hosts[1:]
+    common = ["--master", master, "--workers", *workers]
+    if scenario == "install":
+        return [
+            "install",
+            "--name",
+            "bench",
+            *common,
+            "--parallel",
+            str(parallel),
+            "--journal-dir",
+            journal_dir,
+        ]
+    if scenario == "update":
+        return [
+            "update",
+            *common,
+            "--target-version",
+            "v1.33.1",
+            "--max-unavailable",
+            str(parallel),
+            "--prestage",
+        ]
+    return ["rollback", *common, "--parallel", str(parallel)]
+
+
+def run_benchmark(
+    nodes: int,
+    latency: float = 0.05,
+    jitter: float = 0.02,
+    failure_rate: float = 0.0,
+    parallel: int = 10,
+    scenarios: Optional[List[str]] = None,
+    seed: Optional[int] = None,
+) -> List[BenchResult]:
+    """Run the scenarios against ``nodes`` virtual nodes (one master)."""
+    hosts = [f"10.{i // 65536}.{i // 256 % 256}.{i % 256}" for i in range(1, nodes + 1)]
+    fleet = FakeFleet(hosts, latency, jitter, failure_rate, seed)
+    parser = build_parser()
+    results: List[BenchResult] = []
+    previous = set_transport(fleet)
+    # Scale retry backoff to the simulated latency
+    policies = dict(POLICIES)
+    for name, policy in policies.items():
+        POLICIES[name] = replace(
+            policy,
+            base_delay=policy.base_delay * latency,
+            max_delay=policy.max_delay * latency,
+        )
+    # Rate limits refill at simulated speed as well
+    limits = dict(LIMITS)
+    for name, limit in limits.items():
+        LIMITS[name] = replace(limit, rate=limit.rate / latency if latency else 0.0)
+    configure_limits([])
+    try:
+        with tempfile.TemporaryDirectory() as journal_dir:
+            for scenario in scenarios or SCENARIOS:
+                args = parser.parse_args(
+                    _scenario_args(scenario, hosts, parallel, journal_dir)
+                )
+                fleet.reset()
+                start = time.monotonic()
+                ok = True
+                with redirect_stdout(io.StringIO()):
+                    try:
+                        args.func(args)
+                    except SystemExit:
+                        ok = False
+                results.append(
+                    BenchResult(
+                        scenario,
+                        ok,
+                        time.monotonic() - start,
+                        dict(fleet.execs),
+                        fleet.peak,
+                    )
+                )
+    finally:
+        set_transport(previous)
+        POLICIES.update(policies)
+        LIMITS.update(limits)
+        configure_limits([])
+    return results
+
+
+def format_report(results: List[BenchResult], nodes: int) -> str:
+    lines = [
+        "SCENARIO  STATUS   WALL(s)  EXECS  EXECS/NODE  MAX/NODE  PEAK CONCURRENCY"
+    ]
+    for r in results:
+        total = sum(r.execs.values())
+        lines.append(
+            f"{r.scenario:<8}  {'ok' if r.ok else 'FAILED':<6}  {r.wall:8.2f}  "
+            f"{total:5d}  {total / nodes:10.1f}  {max(r.execs.values(), default=0):8d}  "
+            f"{r.peak:16d}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark k8s_simplify against a simulated fleet"
+    )
+    parser.add_argument("--nodes", type=int, default=20, help="Virtual nodes incl. master")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per command")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Latency jitter in seconds")
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="Fraction of failing commands"
+    )
+    parser.add_argument("--parallel", type=int, default=10, help="Worker concurrency")
+    parser.add_argument(
+        "--scenario", nargs="*", choices=SCENARIOS, help="Scenarios to run (default all)"
+    )
+    parser.add_argument("--seed", type=int, help="Random seed")
+    args = parser.parse_args()
+    if args.nodes < 1:
+        parser.error("--nodes must be at least 1")
+    results = run_benchmark(
+        args.nodes,
+        args.latency,
+        args.jitter,
+        args.failure_rate,
+        args.parallel,
+        args.scenario,
+        args.seed,
+    )
+    print(format_report(results, args.nodes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Local artifact cache and offline bundle for packages and manifests.
+
+``k8s_simplify bundle`` downloads the Kubernetes apt key, the kubelet,
+kubeadm and kubectl packages (plus their cri-tools and kubernetes-cni
+dependencies) and the Flannel and dashboard manifests once into a
+content-addressed cache on the control machine. Additional packages such as
+containerd, which depend on the node distribution, can be added from local
+``.deb`` files. During install the bundle is pushed to every node over the
+existing SSH session and the preparation steps use the local files instead of
+downloading them. Container images are not bundled and are still pulled from
+their registries.
+"""
+
+import asyncio
+from dataclasses import asdict, dataclass, replace
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.request import urlopen
+
+from .engine import DEFAULT_LIMIT, gather_hosts, run_async
+from .phase1 import BASE_PACKAGES, KUBE_REPO_URL, Step, installed_check
+from .phase2 import DASHBOARD_MANIFEST, FLANNEL_MANIFEST
+from .transport import LocalFile
+
+CACHE_DIR = os.path.expanduser("~/.cache/k8s_simplify")
+REMOTE_DIR = "$HOME/.k8s_simplify/bundle"
+KUBE_PACKAGES = ["kubelet", "kubeadm", "kubectl", "cri-tools", "kubernetes-cni"]
+
+
+class BundleError(Exception):
+    """Custom exception for bundle failures."""
+
+
+@dataclass
+class Artifact:
+    name: str
+    file: str
+    sha256: str
+    kind: str
+
+    @property
+    def remote_path(self) -> str:
+        return f"{REMOTE_DIR}/{self.sha256}/{self.file}"
+
+
+def _blob_path(cache_dir: str, digest: str) -> str:
+    return os.path.join(cache_dir, "blobs", digest)
+
+
+def _store(cache_dir: str, src, expected: str = "") -> str:
+    """Copy a file object into the cache and return its sha256 digest."""
+    os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=os.path.join(cache_dir, "blobs"))
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: src.read(1 << 20), b""):
+                digest.update(chunk)
+                out.write(chunk)
+        if expected and digest.hexdigest() != expected:
+            raise BundleError(f"Checksum mismatch, expected {expected}")
+        os.replace(tmp, _blob_path(cache_dir, digest.hexdigest()))
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return digest.hexdigest()
+
+
+def _fetch(cache_dir: str, url: str, expected: str = "") -> str:
+    if expected and os.path.exists(_blob_path(cache_dir, expected)):
+        return expected
+    try:
+        with urlopen(url, timeout=60) as resp:
+            return _store(cache_dir, resp, expected)
+    except OSError as exc:
+        raise BundleError(f"Failed to download {url}") from exc
+
+
+def _version_key(version: str) -> Tuple[int, ...]:
+    return tuple(int(n) for n in re.findall(r"\d+", version))
+
+
+def _latest_packages(index: str, names: List[str], arch: str) -> Dict[str, Dict[str, str]]:
+    """Return the newest entry per package from an apt ``Packages`` index."""
+    latest: Dict[str, Dict[str, str]] = {}
+    for paragraph in index.split("\n\n"):
+        fields = dict(
+            line.split(": ", 1) for line in paragraph.splitlines() if ": " in line
+        )
+        name = fields.get("Package")
+        if name not in names or fields.get("Architecture") not in (arch, "all"):
+            continue
+        current = latest.get(name)
+        if current is None or _version_key(fields["Version"]) > _version_key(
+            current["Version"]
+        ):
+            latest[name] = fields
+    missing = [n for n in names if n not in latest]
+    if missing:
+        raise BundleError("Packages not found in repository: " + ", ".join(missing))
+    return latest
+
+
+def fetch_bundle(
+    cache_dir: str = CACHE_DIR,
+    arch: str = "amd64",
+    extra_debs: Iterable[str] = (),
+) -> Dict[str, Artifact]:
+    """Download all artifacts into the cache and write the bundle index."""
+    artifacts: Dict[str, Artifact] = {}
+
+    print("* Fetching Kubernetes apt key")
+    digest = _fetch(cache_dir, KUBE_REPO_URL + "Release.key")
+    artifacts["apt-key"] = Artifact("apt-key", "Release.key", digest, "key")
+
+    print("* Fetching Kubernetes package index")
+    try:
+        with urlopen(KUBE_REPO_URL + "Packages", timeout=60) as resp:
+            index = resp.read().decode("utf-8")
+    except OSError as exc:
+        raise BundleError("Failed to download the Kubernetes package index") from exc
+    for name, fields in _latest_packages(index, KUBE_PACKAGES, arch).items():
+        print(f"* Fetching {name} {fields['Version']}")
+        digest = _fetch(cache_dir, KUBE_REPO_URL + fields["Filename"], fields["SHA256"])
+        file = os.path.basename(fields["Filename"])
+        artifacts[name] = Artifact(name, file, digest, "deb")
+
+    for name, url in (("flannel", FLANNEL_MANIFEST), ("dashboard", DASHBOARD_MANIFEST)):
+        print(f"* Fetching {name} manifest")
+        digest = _fetch(cache_dir, url)
+        artifacts[name] = Artifact(name, os.path.basename(url), digest, "manifest")
+
+    for path in extra_debs:
+        print(f"* Adding {path}")
+        try:
+            with open(path, "rb") as f:
+                digest = _store(cache_dir, f)
+        except OSError as exc:
+            raise BundleError(f"Failed to read {path}") from exc
+        file = os.path.basename(path)
+        artifacts[f"extra:{file}"] = Artifact(f"extra:{file}", file, digest, "extra-deb")
+
+    with open(os.path.join(cache_dir, "bundle.json"), "w", encoding="utf-8") as f:
+        json.dump({n: asdict(a) for n, a in artifacts.items()}, f, indent=2)
+    return artifacts
+
+
+def load_bundle(cache_dir: str = CACHE_DIR) -> Dict[str, Artifact]:
+    """Load the bundle index written by :func:`fetch_bundle`."""
+    try:
+        with open(os.path.join(cache_dir, "bundle.json"), encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as exc:
+        raise BundleError(
+            f"No bundle found in {cache_dir}, run 'k8s_simplify bundle' first"
+        ) from exc
+    return {name: Artifact(**fields) for name, fields in data.items()}
+
+
+def _tarball(cache_dir: str, artifacts: List[Artifact], path: str) -> LocalFile:
+    """Write the artifacts to a tarball at ``path``, streaming from the cache."""
+    with tarfile.open(path, mode="w") as tar:
+        for artifact in artifacts:
+            tar.add(
+                _blob_path(cache_dir, artifact.sha256),
+                arcname=f"{artifact.sha256}/{artifact.file}",
+            )
+    return LocalFile(path)
+
+
+def push_bundle(
+    hosts: Iterable[str],
+    user: str,
+    password: str,
+    artifacts: Dict[str, Artifact],
+    cache_dir: str = CACHE_DIR,
+    limit: int = DEFAULT_LIMIT,
+) -> None:
+    """Copy the artifacts a host is missing to all hosts concurrently.
+
+    Artifacts are addressed by digest, so files already present on a host
+    are not sent again. Transferred files are verified with ``sha256sum``.
+    One tarball is written to a temporary directory per set of missing
+    artifacts and streamed from disk to every host missing that set.
+    """
+    tarballs: Dict[frozenset, "asyncio.Future[LocalFile]"] = {}
+    tmp_dir = tempfile.mkdtemp(prefix="bundle-", dir=cache_dir)
+
+    async def _push(host: str) -> None:
+        listing = await run_async(
+            host, user, password, f"mkdir -p {REMOTE_DIR} && ls {REMOTE_DIR}"
+        )
+        if listing.returncode != 0:
+            raise BundleError(f"Failed to inspect bundle on {host}: {listing.stderr}")
+        present = set(listing.stdout.split())
+        missing = [a for a in artifacts.values() if a.sha256 not in present]
+        if not missing:
+            return
+        key = frozenset(a.sha256 for a in missing)
+        if key not in tarballs:
+            path = os.path.join(tmp_dir, f"{len(tarballs)}.tar")
+            tarballs[key] = asyncio.ensure_future(
+                asyncio.to_thread(_tarball, cache_dir, missing, path)
+            )
+        tarball = await tarballs[key]
+        checks = "\n".join(f"{a.sha256}  {a.sha256}/{a.file}" for a in missing)
+        result = await run_async(
+            host,
+            user,
+            password,
+            f"tar -xf - -C {REMOTE_DIR} && cd {REMOTE_DIR} && "
+            f"printf '%s\\n' '{checks}' | sha256sum -c --quiet "
+            f"|| {{ rm -rf {' '.join(sorted(key))}; exit 1; }}",
+            input=tarball,
+            label=f"push {len(missing)} artifacts",
+        )
+        if result.returncode != 0:
+            raise BundleError(f"Failed to push bundle to {host}: {result.stderr}")
+        print(f" - Pushed {len(missing)} artifacts to {host}")
+
+    try:
+        results = asyncio.run(gather_hosts(hosts, _push, limit))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    errors = [str(r) for r in results.values() if isinstance(r, BaseException)]
+    if errors:
+        raise BundleError("\n".join(errors))
+
+
+def _package_name(deb: str) -> str:
+    """Return the package name of a ``name_version_arch.deb`` file."""
+    return deb.split("_", 1)[0]
+
+
+def offline_steps(steps: List[Step], artifacts: Dict[str, Artifact]) -> List[Step]:
+    """Rewrite preparation steps to install from the pushed bundle.
+
+    Extra packages are installed together with the base packages, replacing
+    the mirror's package of the same name. The package index is still
+    updated first, since dependencies of bundled packages come from the
+    mirror.
+    """
+    kube_debs = " ".join(artifacts[name].remote_path for name in KUBE_PACKAGES)
+    extra = [a for a in artifacts.values() if a.kind == "extra-deb"]
+    bundled = {_package_name(a.file) for a in extra}
+    base = [name for name in BASE_PACKAGES if name not in bundled]
+    base_installed = installed_check(base + sorted(bundled))
+    base_install = " ".join(base + [a.remote_path for a in extra])
+    replaced: Dict[str, Optional[dict]] = {
+        "update package index": {"check": base_installed},
+        "install base packages": {
+            "command": f"sudo apt-get install -y {base_install}",
+            "check": base_installed,
+        },
+        # The bundled key needs no download
+        "add kubernetes apt key": {
+            "command": (
+                "sudo gpg --batch --yes --dearmor "
+                "-o /etc/apt/keyrings/kubernetes-apt-keyring.gpg "
+                f"<{artifacts['apt-key'].remote_path}"
+            ),
+            "resources": (),
+        },
+        # Bundled Kubernetes packages do not need the Kubernetes index
+        "update kubernetes package index": None,
+        "install kubernetes packages": {
+            "command": (
+                f"sudo apt-get install -y {kube_debs} && "
+                "sudo apt-mark hold kubelet kubeadm kubectl"
+            ),
+        },
+    }
+    result: List[Step] = []
+    for step in steps:
+        if step.name not in replaced:
+            result.append(step)
+        elif replaced[step.name] is not None:
+            result.append(replace(step, **replaced[step.name]))
+    return result
+
+
+def manifest_paths(artifacts: Dict[str, Artifact]) -> Dict[str, str]:
+    """Return ``init_master`` keyword arguments pointing at bundled manifests."""
+    return {
+        "flannel_manifest": artifacts["flannel"].remote_path,
+        "dashboard_manifest": artifacts["dashboard"].remote_path,
+    }
+
@@ -1,23 +1,57 @@
 import argparse
 from dataclasses import dataclass, field
-from typing import List
+from typing import Callable, Dict, List, Optional, Set
 
-from .phase1 import Phase1Error, prepare_master
+from .bundle import (
+    CACHE_DIR,
+    Artifact,
+    BundleError,
+    fetch_bundle,
+    load_bundle,
+    manifest_paths,
+    offline_steps,
+    push_bundle,
+)
+from .connection import register_hosts
+from .engine import (
+    DEFAULT_LIMIT,
+    DEFAULT_TIMEOUT,
+    get_transport,
+    set_timeout,
+    set_transport,
+)
+from .images import format_pulls, format_size, kube_version, prepull_images
+from .inventory import InventoryError, load_inventory
+from .journal import JOURNAL_DIR, Journal, JournalError, check_name
+from .output import configure as configure_output
+from .parallel import BackgroundHosts, format_results, run_per_host
+from .phase1 import MASTER_STEPS, NODE_STEPS, Phase1Error, prepare_master
 from .phase2 import Phase2Error, init_master
-from .phase3 import Phase3Error, verify_master_node
+from .phase3 import Phase3Error, verify_dashboard, verify_master_node
 from .phase4 import (
+    TOKEN_MARGIN,
+    TOKEN_TTL,
+    JoinTokenBroker,
     Phase4Error,
-    get_join_command,
     join_worker,
     prepare_worker,
 )
-from .phase5 import Phase5Error, check_node_health, list_nodes
+from .phase5 import Phase5Error, list_nodes, wait_for_dashboard, wait_for_nodes
 from .phase6 import Phase6Error, finalize_cluster
+from .ratelimit import LIMITS, RateLimitError, limits_summary
+from .ratelimit import configure as configure_limits
+from .retry import retry_summary
+from .scheduler import DEFAULT_TASKS, Task, make_plan, run_tasks
+from .tracing import in_phase, summary, write_chrome_trace
+from .transport import TRANSPORTS
 from .utils import check_local_tools
 from .update import (
     UpdateError,
+    batch_size,
     post_update_validation,
     pre_update_check,
+    prestage_packages,
+    resolve_package_version,
     update_master,
     update_workers,
 )
@@ -25,8 +59,7 @@ from .rollback import (
     RollbackError,
     post_rollback_validation,
     rejoin_workers,
-    rollback_master,
-    rollback_workers,
+    reset_nodes,
 )
 
 
@@ -39,53 +72,225 @@ class ClusterConfig:
     ssh_password: str = ""
     dashboard_token: str = ""
     export_file: str = ""
+    parallel: int = 1
+    query_limit: int = DEFAULT_LIMIT
+    node_timeout: float = 300
+    # Lifetime in seconds of the bootstrap tokens used to join workers
+    token_ttl: int = TOKEN_TTL
+    journal: Optional[Journal] = None
+    bundle: Optional[Dict[str, Artifact]] = None
+    # Inventory group of every host and concurrency limits per group
+    groups: Dict[str, str] = field(default_factory=dict)
+    group_limits: Dict[str, int] = field(default_factory=dict)
+    # False when --limit excludes the master from update and rollback
+    manage_master: bool = True
+    # Worker preparation running in the background during phases 1-3
+    preparation: Optional[BackgroundHosts] = None
+    # Pull container images before they are needed
+    prepull: bool = True
+
+
+def cluster_config(args: argparse.Namespace, **kwargs) -> ClusterConfig:
+    """Build the config from ``--master``/``--workers`` or ``--inventory``.
+
+    With an inventory its per-host SSH settings are registered for all
+    connections and ``--limit`` restricts the workers (and master) handled.
+    """
+    if not args.inventory:
+        if not args.master:
+            raise SystemExit("Either --master or --inventory is required")
+        if args.limit:
+            raise SystemExit("--limit requires --inventory")
+        return ClusterConfig(
+            master_ip=args.master,
+            worker_ips=args.workers or [],
+            ssh_user=args.user,
+            ssh_password=args.password,
+            **kwargs,
+        )
+    try:
+        inventory = load_inventory(args.inventory)
+        selected = inventory.select(args.limit) if args.limit else None
+    except InventoryError as exc:
+        raise SystemExit(str(exc))
+    register_hosts(inventory.hosts)
+    if getattr(args, "transport", "ssh") != "paramiko":
+        # Passwords may come from the inventory instead of --password
+        try:
+            check_local_tools(any(host.password for host in inventory.hosts.values()))
+        except RuntimeError as exc:
+            raise SystemExit(str(exc))
+    workers = inventory.workers
+    if selected is not None:
+        workers = [host for host in workers if host in selected]
+    return ClusterConfig(
+        master_ip=inventory.master,
+        worker_ips=workers,
+        ssh_user=args.user,
+        ssh_password=args.password,
+        groups={host: inventory.group_of(host) for host in inventory.hosts},
+        group_limits=inventory.group_limits(),
+        manage_master=selected is None or inventory.master in selected,
+        **kwargs,
+    )
+
+
+def _host_progress(cfg: ClusterConfig, ip: str):
+    """Return the ``skip``/``on_step`` arguments recording steps of a host."""
+    if cfg.journal is None:
+        return {}
+    journal = cfg.journal
+    return {
+        "skip": journal.host_steps(ip),
+        "on_step": lambda result: journal.mark_host_step(ip, result.name),
+    }
 
 
 def master_node_preparation(cfg: ClusterConfig):
     print(f"[Phase 1] Preparing master node {cfg.master_ip}")
     try:
-        prepare_master(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
+        prepare_master(
+            cfg.master_ip,
+            cfg.ssh_user,
+            cfg.ssh_password,
+            steps=offline_steps(MASTER_STEPS, cfg.bundle) if cfg.bundle else None,
+            **_host_progress(cfg, cfg.master_ip),
+        )
     except Phase1Error as exc:
         print(exc)
         raise SystemExit(1)
 
 
+def _manifests(cfg: ClusterConfig) -> Dict[str, str]:
+    return manifest_paths(cfg.bundle) if cfg.bundle else {}
+
+
+def prepull_master(cfg: ClusterConfig):
+    print(f"[Image pre-pull] Pulling control plane images on {cfg.master_ip}")
+    results = prepull_images(
+        cfg.master_ip, [], cfg.ssh_user, cfg.ssh_password, **_manifests(cfg)
+    )
+    print(format_pulls(results.values()))
+
+
 def install_master(cfg: ClusterConfig):
     print(f"[Phase 2] Installing Kubernetes on master {cfg.master_ip}")
     try:
-        cfg.dashboard_token = init_master(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
+        cfg.dashboard_token = init_master(
+            cfg.master_ip,
+            cfg.ssh_user,
+            cfg.ssh_password,
+            **_manifests(cfg),
+        )
     except Phase2Error as exc:
         print(exc)
         raise SystemExit(1)
+    if cfg.journal is not None:
+        cfg.journal.set("dashboard_token", cfg.dashboard_token)
 
 
 def verify_master(cfg: ClusterConfig):
     print("[Phase 3] Verifying master node setup")
     try:
-        verify_master_node(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
+        verify_master_node(
+            cfg.master_ip, cfg.ssh_user, cfg.ssh_password, dashboard=False
+        )
     except Phase3Error as exc:
         print(exc)
         raise SystemExit(1)
 
 
+def _prepare_worker(cfg: ClusterConfig, ip: str, log) -> None:
+    progress = _host_progress(cfg, ip)
+    if "joined" in progress.get("skip", ()):
+        return
+    log(f" - Preparing worker {ip}")
+    steps = offline_steps(NODE_STEPS, cfg.bundle) if cfg.bundle else None
+    prepare_worker(ip, cfg.ssh_user, cfg.ssh_password, steps=steps, **progress)
+    log(f" - Worker {ip} prepared")
+    if cfg.prepull:
+        pulled = prepull_images(
+            None, [ip], cfg.ssh_user, cfg.ssh_password, **_manifests(cfg)
+        )[ip]
+        if pulled.ok:
+            log(
+                f" - Worker {ip} pulled images in {pulled.duration:.1f}s"
+                f" ({format_size(pulled.bytes)})"
+            )
+        else:
+            log(f" - Worker {ip} image pre-pull failed, continuing: {pulled.error}")
+
+
+def start_worker_preparation(cfg: ClusterConfig) -> None:
+    """Prepare the workers in the background while the master is set up.
+
+    Preparation does not depend on the master, so it is taken off the
+    critical path; phase 4 only waits for it before joining each worker.
+    """
+    if not cfg.worker_ips:
+        return
+    if cfg.journal is not None and cfg.journal.phase_done("Phase 4"):
+        return
+    print(f"* Preparing {len(cfg.worker_ips)} workers in the background")
+    cfg.preparation = BackgroundHosts(
+        cfg.worker_ips,
+        lambda ip, log: _prepare_worker(cfg, ip, log),
+        cfg.parallel,
+        errors=(Phase4Error,),
+        groups=cfg.groups,
+        group_limits=cfg.group_limits,
+    )
+    with in_phase("Worker preparation"):
+        cfg.preparation.start()
+
+
 def deploy_workers(cfg: ClusterConfig):
     if not cfg.worker_ips:
         print("No worker nodes specified, skipping worker deployment")
         return
     print("[Phase 4] Deploying worker nodes")
     try:
-        join_cmd = get_join_command(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
+        broker = JoinTokenBroker(
+            cfg.master_ip, cfg.ssh_user, cfg.ssh_password, cfg.token_ttl
+        )
     except Phase4Error as exc:
         print(exc)
         raise SystemExit(1)
-    for ip in cfg.worker_ips:
-        print(f" - Preparing worker {ip}")
+
+    def provision(ip: str, log) -> None:
+        progress = _host_progress(cfg, ip)
+        if "joined" in progress.get("skip", ()):
+            log(f" - Worker {ip} already joined, skipping")
+            return
+        if cfg.preparation is None:
+            _prepare_worker(cfg, ip, log)
+        else:
+            prepared = cfg.preparation.result(ip)
+            if not prepared.ok:
+                raise Phase4Error(f"Preparation of {ip} failed: {prepared.error}")
+        log(f" - Joining worker {ip}")
+        join_worker(ip, cfg.ssh_user, cfg.ssh_password, broker.join_command())
+        if cfg.journal is not None:
+            cfg.journal.mark_host_step(ip, "joined")
+
+    with broker:
         try:
-            prepare_worker(ip, cfg.ssh_user, cfg.ssh_password)
-            join_worker(ip, cfg.ssh_user, cfg.ssh_password, join_cmd)
+            broker.join_command()
         except Phase4Error as exc:
             print(exc)
             raise SystemExit(1)
+        results = run_per_host(
+            cfg.worker_ips,
+            provision,
+            cfg.parallel,
+            errors=(Phase4Error,),
+            groups=cfg.groups,
+            group_limits=cfg.group_limits,
+        )
+    print("* Worker results:")
+    print(format_results(results))
+    if not all(r.ok for r in results):
+        raise SystemExit(1)
 
 
 def check_nodes(cfg: ClusterConfig):
@@ -94,8 +299,22 @@ def check_nodes(cfg: ClusterConfig):
         print("* Current node status:")
         nodes = list_nodes(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
         print(nodes)
-        check_node_health(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
-    except Phase5Error as exc:
+        print("* Waiting for nodes to become Ready")
+        wait_for_nodes(
+            cfg.master_ip,
+            cfg.ssh_user,
+            cfg.ssh_password,
+            [cfg.master_ip] + cfg.worker_ips,
+            cfg.node_timeout,
+        )
+        if cfg.worker_ips:
+            print("* Waiting for the dashboard to become Available")
+            wait_for_dashboard(
+                cfg.master_ip, cfg.ssh_user, cfg.ssh_password, cfg.node_timeout
+            )
+            print("* Checking dashboard access")
+            verify_dashboard(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
+    except (Phase3Error, Phase5Error) as exc:
         print(exc)
         raise SystemExit(1)
 
@@ -111,108 +330,654 @@ def finalize_install(cfg: ClusterConfig):
                 cfg.ssh_password,
                 cfg.dashboard_token,
                 cfg.export_file or None,
+                cfg.query_limit,
             )
         except Phase6Error as exc:
             print(exc)
             raise SystemExit(1)
 
 
+def distribute_bundle(cfg: ClusterConfig, cache_dir: str):
+    print(f"Pushing bundle from {cache_dir}")
+    try:
+        cfg.bundle = load_bundle(cache_dir)
+        push_bundle(
+            [cfg.master_ip] + cfg.worker_ips,
+            cfg.ssh_user,
+            cfg.ssh_password,
+            cfg.bundle,
+            cache_dir,
+            cfg.query_limit,
+        )
+    except BundleError as exc:
+        print(exc)
+        raise SystemExit(1)
+
+
+def _run_phase(
+    cfg: ClusterConfig, name: str, phase: Callable[[ClusterConfig], None]
+) -> None:
+    """Run an install phase unless the journal records it as completed."""
+    if cfg.journal is not None and cfg.journal.phase_done(name):
+        print(f"[{name}] Already completed, skipping")
+        return
+    with in_phase(name):
+        phase(cfg)
+    if cfg.journal is not None:
+        cfg.journal.mark_phase(name)
+
+
+def finish_run(args: argparse.Namespace):
+    """Close SSH sessions and report the timing of all remote commands."""
+    get_transport().close()
+    print("\nTiming summary:")
+    print(summary())
+    print("\nRetry summary:")
+    print(retry_summary())
+    print("\nRate limit summary:")
+    print(limits_summary())
+    if args.trace:
+        try:
+            write_chrome_trace(args.trace)
+            print(f"Trace written to {args.trace}")
+        except OSError as exc:
+            print(f"Failed to write trace to {args.trace}: {exc}")
+
+
+def install_tasks(cfg: ClusterConfig, args: argparse.Namespace) -> List[Task]:
+    """Return the install as a task graph; estimates are rough seconds."""
+    master = [cfg.master_ip]
+
+    def phase(name: str, func: Callable[[ClusterConfig], None]) -> Callable[[], None]:
+        return lambda: _run_phase(cfg, name, func)
+
+    tasks: List[Task] = []
+    start: List[str] = []
+    if args.bundle:
+        tasks.append(
+            Task(
+                "Bundle",
+                lambda: distribute_bundle(cfg, args.cache_dir),
+                hosts=master + cfg.worker_ips,
+                estimate=60,
+            )
+        )
+        start = ["Bundle"]
+    tasks += [
+        # Only starts the background preparation, Phase 4 waits for each worker
+        Task(
+            "Worker preparation",
+            lambda: start_worker_preparation(cfg),
+            start,
+            cfg.worker_ips,
+            180,
+        ),
+        Task("Phase 1", phase("Phase 1", master_node_preparation), start, master, 180),
+    ]
+    before_init = "Phase 1"
+    if cfg.prepull:
+        tasks.append(
+            Task(
+                "Image pre-pull",
+                phase("Image pre-pull", prepull_master),
+                ["Phase 1"],
+                master,
+                60,
+            )
+        )
+        before_init = "Image pre-pull"
+    return tasks + [
+        Task("Phase 2", phase("Phase 2", install_master), [before_init], master, 180),
+        Task("Phase 3", phase("Phase 3", verify_master), ["Phase 2"], master, 30),
+        Task(
+            "Phase 4",
+            phase("Phase 4", deploy_workers),
+            ["Phase 2", "Worker preparation"],
+            cfg.worker_ips,
+            60,
+        ),
+        Task("Phase 5", phase("Phase 5", check_nodes), ["Phase 3", "Phase 4"], master, 60),
+        Task("Phase 6", phase("Phase 6", finalize_install), ["Phase 5"], master, 10),
+    ]
+
+
+def print_plan(tasks: List[Task], args: argparse.Namespace) -> None:
+    print("Execution plan:")
+    print(make_plan(tasks, args.max_tasks, args.host_tasks).format())
+
+
 def install_cluster(args: argparse.Namespace):
-    cfg = ClusterConfig(
+    cfg = cluster_config(
+        args,
         cluster_name=args.name,
-        master_ip=args.master,
-        worker_ips=args.workers or [],
-        ssh_user=args.user,
-        ssh_password=args.password,
         export_file=args.export_file or "",
+        parallel=args.parallel,
+        query_limit=args.query_limit,
+        node_timeout=args.node_timeout,
+        token_ttl=args.token_ttl,
+        prepull=not args.no_prepull,
     )
-    master_node_preparation(cfg)
-    install_master(cfg)
-    verify_master(cfg)
-    deploy_workers(cfg)
-    check_nodes(cfg)
-    finalize_install(cfg)
+    tasks = install_tasks(cfg, args)
+    if args.plan:
+        print_plan(tasks, args)
+        return
+    journal = Journal(cfg.cluster_name, args.journal_dir)
+    try:
+        resumed = args.resume and journal.load()
+    except JournalError as exc:
+        raise SystemExit(f"{exc}, remove it or install without --resume") from exc
+    if resumed:
+        print(f"Resuming install of {cfg.cluster_name} from {journal.path}")
+        cfg.dashboard_token = journal.get("dashboard_token") or ""
+    else:
+        journal.reset()
+    cfg.journal = journal
+    try:
+        run_tasks(tasks, args.max_tasks, args.host_tasks)
+    finally:
+        if cfg.preparation is not None:
+            cfg.preparation.stop()
+        finish_run(args)
+
+
+def bundle_artifacts(args: argparse.Namespace):
+    print(f"Fetching artifacts into {args.cache_dir}")
+    try:
+        artifacts = fetch_bundle(args.cache_dir, args.arch, args.deb or [])
+    except BundleError as exc:
+        print(exc)
+        raise SystemExit(1)
+    print(f"Bundle complete, {len(artifacts)} artifacts cached")
+
+
+def update_tasks(cfg: ClusterConfig, args: argparse.Namespace) -> List[Task]:
+    """Return the update as a task graph; estimates are rough seconds."""
+    master = [cfg.master_ip]
+    nodes = (master if cfg.manage_master else []) + cfg.worker_ips
+
+    def check() -> None:
+        pre_update_check(
+            cfg.master_ip,
+            cfg.worker_ips,
+            cfg.ssh_user,
+            cfg.ssh_password,
+            cfg.query_limit,
+        )
+
+    def prepull() -> None:
+        print("* Pre-pulling images for the target version")
+        results = prepull_images(
+            cfg.master_ip if cfg.manage_master else None,
+            cfg.worker_ips,
+            cfg.ssh_user,
+            cfg.ssh_password,
+            kube_version(args.target_version),
+            limit=cfg.query_limit,
+        )
+        print(format_pulls(results.values()))
+
+    # Exact package version, set once the packages are pre-staged
+    staged: Dict[str, str] = {}
+
+    def prestage() -> None:
+        package_version = resolve_package_version(
+            cfg.master_ip, cfg.ssh_user, cfg.ssh_password, args.target_version
+        )
+        print(f"* Pre-staging packages {package_version} on {len(nodes)} nodes")
+        prestage_packages(
+            nodes,
+            cfg.ssh_user,
+            cfg.ssh_password,
+            package_version,
+            cfg.query_limit,
+            cfg.groups,
+            cfg.group_limits,
+        )
+        staged["version"] = package_version
+
+    tasks = [Task("Pre-update check", check, [], master + cfg.worker_ips, 10)]
+    # Pre-pull and pre-stage only need the check, both finish before the master
+    staging = [
+        Task(name, func, ["Pre-update check"], nodes, estimate)
+        for name, func, enabled, estimate in (
+            ("Image pre-pull", prepull, cfg.prepull, 120),
+            ("Package pre-stage", prestage, args.prestage, 120),
+        )
+        if enabled
+    ]
+    tasks += staging
+    previous = [task.name for task in staging] or ["Pre-update check"]
+    if cfg.manage_master:
+        tasks.append(
+            Task(
+                "Master update",
+                lambda: update_master(
+                    cfg.master_ip,
+                    cfg.ssh_user,
+                    cfg.ssh_password,
+                    args.target_version,
+                    staged.get("version"),
+                ),
+                previous,
+                master,
+                300,
+            )
+        )
+        previous = ["Master update"]
+    return tasks + [
+        Task(
+            "Worker update",
+            lambda: update_workers(
+                cfg.master_ip,
+                cfg.worker_ips,
+                cfg.ssh_user,
+                cfg.ssh_password,
+                args.target_version,
+                args.max_unavailable,
+                cfg.groups,
+                cfg.group_limits,
+                staged.get("version"),
+            ),
+            previous,
+            cfg.worker_ips,
+            300,
+        ),
+        Task(
+            "Validation",
+            lambda: post_update_validation(
+                cfg.master_ip, cfg.worker_ips, cfg.ssh_user, cfg.ssh_password
+            ),
+            ["Worker update"],
+            master,
+            60,
+        ),
+    ]
 
 
 def update_cluster(args: argparse.Namespace):
-    cfg = ClusterConfig(
+    cfg = cluster_config(
+        args,
         cluster_name="",
-        master_ip=args.master,
-        worker_ips=args.workers or [],
-        ssh_user=args.user,
-        ssh_password=args.password,
+        query_limit=args.query_limit,
+        prepull=not args.no_prepull,
     )
+    tasks = update_tasks(cfg, args)
+    if args.plan:
+        print_plan(tasks, args)
+        return
     print("Starting cluster update")
     try:
-        versions = pre_update_check(
-            cfg.master_ip, cfg.worker_ips, cfg.ssh_user, cfg.ssh_password
-        )
-        for ip, ver in versions.items():
-            print(f"Current version on {ip}: {ver}")
-        update_master(cfg.master_ip, cfg.ssh_user, cfg.ssh_password, args.target_version)
-        update_workers(cfg.worker_ips, cfg.ssh_user, cfg.ssh_password, args.target_version)
-        post_update_validation(
-            cfg.master_ip, cfg.worker_ips, cfg.ssh_user, cfg.ssh_password
-        )
+        run_tasks(tasks, args.max_tasks, args.host_tasks)
         print("Update complete")
     except UpdateError as exc:
         print(exc)
         raise SystemExit(1)
+    finally:
+        finish_run(args)
+
+
+def rollback_tasks(cfg: ClusterConfig) -> List[Task]:
+    """Return the rollback as a task graph; estimates are rough seconds."""
+    hosts = ([cfg.master_ip] if cfg.manage_master else []) + cfg.worker_ips
+    prepared: Set[str] = set()
+
+    def reset() -> None:
+        print(f"* Resetting {len(hosts)} nodes")
+        prepared.update(
+            reset_nodes(
+                hosts,
+                cfg.ssh_user,
+                cfg.ssh_password,
+                cfg.parallel,
+                cfg.groups,
+                cfg.group_limits,
+            )
+        )
+
+    def rejoin() -> None:
+        print("* Rejoining workers")
+        rejoin_workers(
+            cfg.master_ip,
+            cfg.worker_ips,
+            cfg.ssh_user,
+            cfg.ssh_password,
+            prepared,
+            cfg.parallel,
+            cfg.groups,
+            cfg.group_limits,
+            cfg.token_ttl,
+        )
+
+    return [
+        Task("Reset", reset, [], hosts, 60),
+        Task("Rejoin", rejoin, ["Reset"], cfg.worker_ips, 120),
+        Task(
+            "Validation",
+            lambda: post_rollback_validation(
+                cfg.master_ip, cfg.ssh_user, cfg.ssh_password
+            ),
+            ["Rejoin"],
+            [cfg.master_ip],
+            60,
+        ),
+    ]
 
 
 def rollback_cluster(args: argparse.Namespace):
-    cfg = ClusterConfig(
-        cluster_name="",
-        master_ip=args.master,
-        worker_ips=args.workers or [],
-        ssh_user=args.user,
-        ssh_password=args.password,
+    cfg = cluster_config(
+        args, cluster_name="", parallel=args.parallel, token_ttl=args.token_ttl
     )
+    tasks = rollback_tasks(cfg)
+    if args.plan:
+        print_plan(tasks, args)
+        return
     print("Starting rollback")
     try:
-        rollback_master(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
-        rollback_workers(cfg.worker_ips, cfg.ssh_user, cfg.ssh_password)
-        rejoin_workers(cfg.master_ip, cfg.worker_ips, cfg.ssh_user, cfg.ssh_password)
-        post_rollback_validation(cfg.master_ip, cfg.ssh_user, cfg.ssh_password)
+        run_tasks(tasks, args.max_tasks, args.host_tasks)
         print("Rollback complete")
     except RollbackError as exc:
         print(exc)
         raise SystemExit(1)
+    finally:
+        finish_run(args)
 
 
-def main():
+def _token_ttl(value: str) -> int:
+    """Parse ``--token-ttl``, which must leave room for the refresh margin."""
+    try:
+        ttl = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}") from None
+    if ttl <= 2 * TOKEN_MARGIN:
+        raise argparse.ArgumentTypeError(
+            f"must be greater than {2 * TOKEN_MARGIN} seconds"
+        )
+    return ttl
+
+
+def _cluster_name(value: str) -> str:
+    """Parse ``--name``, which names the install journal file."""
+    try:
+        return check_name(value)
+    except JournalError as exc:
+        raise argparse.ArgumentTypeError(str(exc)) from None
+
+
+def _max_unavailable(value: str) -> str:
+    """Parse ``--max-unavailable``, a positive count or a percentage."""
+    try:
+        batch_size(value, 1)
+    except UpdateError:
+        raise argparse.ArgumentTypeError(
+            f"expected a positive count or a percentage, got {value!r}"
+        ) from None
+    return value
+
+
+def _add_host_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--master", help="Master node IP")
+    parser.add_argument("--workers", nargs="*", help="Worker node IPs")
+    parser.add_argument("--user", default="root", help="SSH username")
+    parser.add_argument("--password", default="", help="SSH password")
+    parser.add_argument(
+        "--inventory",
+        help="JSON or YAML inventory with host groups, replaces --master/--workers",
+    )
+    parser.add_argument(
+        "--limit",
+        action="append",
+        help="Only handle inventory hosts matching group:<name> or host:<address>",
+    )
+
+
+def _add_output_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print the output of long running remote commands live, prefixed by host",
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="Append the output of long running remote commands to <host>.log files here",
+    )
+
+
+def _task_limit(value: str) -> int:
+    """Parse ``--max-tasks`` and ``--host-tasks``, which must be positive."""
+    try:
+        limit = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}") from None
+    if limit < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return limit
+
+
+def _add_plan_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Show the task graph, critical path and parallelism without running",
+    )
+    parser.add_argument(
+        "--max-tasks",
+        type=_task_limit,
+        default=DEFAULT_TASKS,
+        help="Maximum number of steps of the task graph running at once",
+    )
+    parser.add_argument(
+        "--host-tasks",
+        type=_task_limit,
+        default=1,
+        help="Maximum number of steps working on the same host at once",
+    )
+
+
+def _add_limit_options(parser: argparse.ArgumentParser) -> None:
+    defaults = ", ".join(
+        f"{name}={limit.concurrency}:{limit.rate:g}" for name, limit in LIMITS.items()
+    )
+    parser.add_argument(
+        "--rate-limit",
+        action="append",
+        metavar="NAME=CONCURRENCY[:RATE]",
+        help=(
+            "Limit commands in flight and started per second for a shared "
+            f"upstream, 0 for no limit (defaults: {defaults})"
+        ),
+    )
+    parser.add_argument(
+        "--command-timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=(
+            "Seconds after which a remote command, or the work on one host of a "
+            "fleet-wide query, is aborted, 0 for no timeout"
+        ),
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Kubernetes simplify toolkit")
     sub = parser.add_subparsers(dest="command", required=True)
 
     install = sub.add_parser("install", help="Install a new cluster")
-    install.add_argument("--name", required=True, help="Cluster name")
-    install.add_argument("--master", required=True, help="Master node IP")
-    install.add_argument("--workers", nargs="*", help="Worker node IPs")
-    install.add_argument("--user", default="root", help="SSH username")
-    install.add_argument("--password", default="", help="SSH password")
+    install.add_argument(
+        "--name", required=True, type=_cluster_name, help="Cluster name"
+    )
+    _add_host_options(install)
     install.add_argument(
         "--export-file",
         help="Write final cluster information to file",
     )
+    install.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Number of workers to provision concurrently",
+    )
+    install.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip phases and steps completed by a previous run",
+    )
+    install.add_argument(
+        "--journal-dir",
+        default=JOURNAL_DIR,
+        help="Directory holding install journals",
+    )
+    install.add_argument(
+        "--query-limit",
+        type=int,
+        default=DEFAULT_LIMIT,
+        help="Maximum number of hosts queried concurrently",
+    )
+    install.add_argument(
+        "--node-timeout",
+        type=float,
+        default=300,
+        help="Seconds to wait for all nodes to become Ready in phase 5",
+    )
+    install.add_argument(
+        "--token-ttl",
+        type=_token_ttl,
+        default=TOKEN_TTL,
+        help="Lifetime in seconds of join tokens, refreshed before they expire",
+    )
+    install.add_argument(
+        "--bundle",
+        action="store_true",
+        help="Install packages and manifests from the local bundle",
+    )
+    install.add_argument(
+        "--cache-dir", default=CACHE_DIR, help="Bundle cache directory"
+    )
+    install.add_argument(
+        "--trace",
+        help="Write a Chrome trace-event JSON file of all remote commands",
+    )
+    install.add_argument(
+        "--transport",
+        choices=sorted(TRANSPORTS),
+        default="ssh",
+        help="SSH implementation: OpenSSH client, in-process paramiko or remote agent",
+    )
+    install.add_argument(
+        "--no-prepull",
+        action="store_true",
+        help="Do not pull container images ahead of the steps that need them",
+    )
+    _add_plan_options(install)
+    _add_output_options(install)
+    _add_limit_options(install)
     install.set_defaults(func=install_cluster)
 
+    bundle = sub.add_parser(
+        "bundle", help="Download packages and manifests for installs with --bundle"
+    )
+    bundle.add_argument(
+        "--cache-dir", default=CACHE_DIR, help="Bundle cache directory"
+    )
+    bundle.add_argument("--arch", default="amd64", help="Node package architecture")
+    bundle.add_argument(
+        "--deb",
+        action="append",
+        help="Additional local .deb file to include (e.g. containerd)",
+    )
+    bundle.set_defaults(func=bundle_artifacts)
+
     update = sub.add_parser("update", help="Update existing cluster")
-    update.add_argument("--master", required=True, help="Master node IP")
-    update.add_argument("--workers", nargs="*", help="Worker node IPs")
-    update.add_argument("--user", default="root", help="SSH username")
-    update.add_argument("--password", default="", help="SSH password")
+    _add_host_options(update)
     update.add_argument("--target-version", required=True, help="Target kube version")
+    update.add_argument(
+        "--max-unavailable",
+        type=_max_unavailable,
+        default="1",
+        help="Workers upgraded at once, as a count or percentage (e.g. 25%%)",
+    )
+    update.add_argument(
+        "--query-limit",
+        type=int,
+        default=DEFAULT_LIMIT,
+        help="Maximum number of hosts queried concurrently",
+    )
+    update.add_argument(
+        "--trace",
+        help="Write a Chrome trace-event JSON file of all remote commands",
+    )
+    update.add_argument(
+        "--transport",
+        choices=sorted(TRANSPORTS),
+        default="ssh",
+        help="SSH implementation: OpenSSH client, in-process paramiko or remote agent",
+    )
+    update.add_argument(
+        "--prestage",
+        action="store_true",
+        help="Download the target packages on all nodes before the rolling update",
+    )
+    update.add_argument(
+        "--no-prepull",
+        action="store_true",
+        help="Do not pull container images ahead of the steps that need them",
+    )
+    _add_plan_options(update)
+    _add_output_options(update)
+    _add_limit_options(update)
     update.set_defaults(func=update_cluster)
 
     rollback = sub.add_parser("rollback", help="Rollback cluster changes")
-    rollback.add_argument("--master", required=True, help="Master node IP")
-    rollback.add_argument("--workers", nargs="*", help="Worker node IPs")
-    rollback.add_argument("--user", default="root", help="SSH username")
-    rollback.add_argument("--password", default="", help="SSH password")
+    _add_host_options(rollback)
+    rollback.add_argument(
+        "--parallel",
+        type=int,
+        default=DEFAULT_LIMIT,
+        help="Number of nodes reset and rejoined concurrently",
+    )
+    rollback.add_argument(
+        "--token-ttl",
+        type=_token_ttl,
+        default=TOKEN_TTL,
+        help="Lifetime in seconds of join tokens, refreshed before they expire",
+    )
+    rollback.add_argument(
+        "--trace",
+        help="Write a Chrome trace-event JSON file of all remote commands",
+    )
+    rollback.add_argument(
+        "--transport",
+        choices=sorted(TRANSPORTS),
+        default="ssh",
+        help="SSH implementation: OpenSSH client, in-process paramiko or remote agent",
+    )
+    _add_plan_options(rollback)
+    _add_output_options(rollback)
+    _add_limit_options(rollback)
     rollback.set_defaults(func=rollback_cluster)
 
+    return parser
+
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
-    check_local_tools(bool(getattr(args, "password", "")))
+    transport = getattr(args, "transport", "ssh")
+    if transport != "paramiko":
+        check_local_tools(bool(getattr(args, "password", "")))
+    try:
+        set_transport(TRANSPORTS[transport]())
+    except RuntimeError as exc:
+        print(exc)
+        raise SystemExit(1)
+    if hasattr(args, "stream"):
+        configure_output(args.stream, args.log_dir)
+    if hasattr(args, "command_timeout"):
+        set_timeout(args.command_timeout)
+    try:
+        configure_limits(getattr(args, "rate_limit", None) or [])
+    except RateLimitError as exc:
+        print(exc)
+        raise SystemExit(1)
     args.func(args)
 
 
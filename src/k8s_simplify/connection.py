@@ -0,0 +1,188 @@
+"""Multiplexed SSH sessions shared by all phases."""
+
+from dataclasses import dataclass
+from subprocess import DEVNULL, SubprocessError, run
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+CONTROL_PERSIST = "10m"
+
+_lock = threading.Lock()
+_control_dir: Optional[str] = None
+_sessions: Dict[Tuple[str, str], threading.Lock] = {}
+
+
+@dataclass
+class HostSettings:
+    """Per-host SSH settings overriding the command line defaults."""
+
+    user: str = ""
+    password: str = ""
+    port: int = 0
+    key_file: str = ""
+
+
+_hosts: Dict[str, HostSettings] = {}
+
+
+def register_hosts(settings: Dict[str, HostSettings]) -> None:
+    """Use ``settings`` for the given hosts in all following connections."""
+    with _lock:
+        _hosts.update(settings)
+
+
+def host_settings(ip: str) -> HostSettings:
+    with _lock:
+        return _hosts.get(ip) or HostSettings()
+
+
+def resolve_login(ip: str, user: str, password: str) -> Tuple[str, str]:
+    """Return the user and password for ``ip``, preferring its own settings."""
+    settings = host_settings(ip)
+    return settings.user or user, settings.password or password
+
+
+def _host_options(ip: str) -> List[str]:
+    settings = host_settings(ip)
+    options: List[str] = []
+    if settings.port:
+        options += ["-p", str(settings.port)]
+    if settings.key_file:
+        options += ["-i", os.path.expanduser(settings.key_file)]
+    return options
+
+
+def _get_control_dir() -> str:
+    global _control_dir
+    with _lock:
+        if _control_dir is None:
+            # Keep the path short, unix socket paths are limited to ~100 chars
+            _control_dir = tempfile.mkdtemp(prefix="k8s-ssh-")
+        return _control_dir
+
+
+def _control_path(ip: str, user: str) -> str:
+    return f"{_get_control_dir()}/{user}@{ip}"
+
+
+def session_options(ip: str, user: str) -> List[str]:
+    """Return ssh options that route a command over the shared session."""
+    return [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={_control_path(ip, user)}",
+        "-o",
+        f"ControlPersist={CONTROL_PERSIST}",
+    ]
+
+
+def ssh_env(password: str) -> Optional[Dict[str, str]]:
+    """Return the environment passing ``password`` to ``sshpass -e``.
+
+    Using the environment keeps the password off the process table.
+    """
+    if not password:
+        return None
+    return {**os.environ, "SSHPASS": password}
+
+
+def ensure_session(ip: str, user: str, password: str) -> None:
+    """Open the master connection for a host unless it already exists.
+
+    Failures are ignored, commands then fall back to regular connections.
+    """
+    key = (ip, user)
+    with _lock:
+        host_lock = _sessions.get(key)
+        if host_lock is None:
+            host_lock = _sessions[key] = threading.Lock()
+            opening = True
+        else:
+            opening = False
+    if not opening:
+        # Wait for a concurrent opener of the same host to finish
+        with host_lock:
+            return
+    with host_lock:
+        prefix = ["sshpass", "-e"] if password else []
+        cmd = prefix + [
+            "ssh",
+            "-o",
+            "StrictHostKeyChecking=no",
+            *_host_options(ip),
+            *session_options(ip, user),
+            "-o",
+            "ControlMaster=yes",
+            "-f",
+            "-N",
+            f"{user}@{ip}",
+        ]
+        try:
+            run(
+                cmd,
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+                env=ssh_env(password),
+                timeout=60,
+            )
+        except (OSError, SubprocessError):
+            pass
+
+
+def close_sessions() -> None:
+    """Terminate all master connections and remove their sockets."""
+    global _control_dir
+    with _lock:
+        keys = list(_sessions)
+        _sessions.clear()
+        control_dir, _control_dir = _control_dir, None
+    if control_dir is None:
+        return
+    for ip, user in keys:
+        try:
+            run(
+                [
+                    "ssh",
+                    "-o",
+                    f"ControlPath={control_dir}/{user}@{ip}",
+                    "-O",
+                    "exit",
+                    f"{user}@{ip}",
+                ],
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+                timeout=10,
+            )
+        except (OSError, SubprocessError):
+            pass
+    shutil.rmtree(control_dir, ignore_errors=True)
+
+
+def ssh_command(ip: str, user: str, password: str, command: str) -> List[str]:
+    """Return the argv running ``command`` on a host over its shared session.
+
+    With a password the argv must be run with the environment from
+    :func:`ssh_env`.
+    """
+    prefix: List[str] = []
+    if password:
+        if shutil.which("sshpass") is None:
+            raise RuntimeError("sshpass is required for password authentication")
+        prefix = ["sshpass", "-e"]
+    ensure_session(ip, user, password)
+    base = [
+        "ssh",
+        "-o",
+        "StrictHostKeyChecking=no",
+        *_host_options(ip),
+        *session_options(ip, user),
+        f"{user}@{ip}",
+        command,
+    ]
+    return prefix + base
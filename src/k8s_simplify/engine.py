@@ -0,0 +1,201 @@
+"""Asynchronous remote command execution engine.
+
+All remote commands are executed by :func:`run_async` through the current
+:class:`~k8s_simplify.transport.Transport`. Phases that work on a
+single host keep using the synchronous :func:`run_command` wrapper, while
+fleet-wide operations fan out with :func:`gather_hosts` under a concurrency
+limit. Remote commands and the work on each host of :func:`gather_hosts` are
+bounded by a timeout, see :func:`set_timeout`, so one hung host cannot stall
+a whole phase. Transports with a remote agent additionally answer operations
+through :func:`call_async`.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, TypeVar, Union
+
+from .connection import resolve_login
+from .output import LineCallback
+from .tracing import queued_since, record
+from .transport import CommandResult, Input, SubprocessTransport, Transport
+
+DEFAULT_LIMIT = 64
+# Default seconds a remote command, or the work on one host, may take
+DEFAULT_TIMEOUT = 1800.0
+# Extra seconds granted to transports to enforce the timeout themselves
+_TIMEOUT_GRACE = 5.0
+
+T = TypeVar("T")
+
+_transport: Transport = SubprocessTransport()
+_timeout: Optional[float] = DEFAULT_TIMEOUT
+
+
+def get_transport() -> Transport:
+    return _transport
+
+
+def set_transport(transport: Optional[Transport]) -> Transport:
+    """Replace the transport used for all commands.
+
+    ``None`` restores the default OpenSSH subprocess transport. Returns the
+    previous transport so callers can restore it.
+    """
+    global _transport
+    previous = _transport
+    _transport = transport or SubprocessTransport()
+    return previous
+
+
+def set_timeout(timeout: Optional[float]) -> None:
+    """Set the default timeout in seconds, None or 0 for no timeout."""
+    global _timeout
+    _timeout = timeout or None
+
+
+async def run_async(
+    ip: str,
+    user: str,
+    password: str,
+    command: str,
+    input: Optional[Input] = None,
+    timeout: Optional[float] = None,
+    attempt: int = 1,
+    label: Optional[str] = None,
+    on_line: Optional[LineCallback] = None,
+) -> CommandResult:
+    """Run a command on a remote host and return its result.
+
+    ``input`` is written to the command's stdin, text is sent UTF-8 encoded
+    and a :class:`~k8s_simplify.transport.LocalFile` is streamed from disk.
+    A command exceeding ``timeout`` seconds (the default set with
+    :func:`set_timeout` if None) is killed and reported with exit code 124,
+    like coreutils ``timeout``, including time spent connecting. With ``on_line`` the output is
+    streamed to the callback and only its tail is kept in the result. Every
+    call is recorded as a tracing span named ``label`` (the command by
+    default) with the given ``attempt``.
+    """
+    queued = queued_since.get()
+    queued_since.set(None)
+    user, password = resolve_login(ip, user, password)
+    if timeout is None:
+        timeout = _timeout
+    start = time.monotonic()
+    try:
+        result = await asyncio.wait_for(
+            _transport.run(ip, user, password, command, input, timeout, on_line),
+            None if timeout is None else timeout + _TIMEOUT_GRACE,
+        )
+    except asyncio.TimeoutError:
+        # The transport hung, e.g. while connecting to an unresponsive sshd
+        result = CommandResult(
+            ip, command, 124, "", f"timed out after {timeout}s", time.monotonic() - start
+        )
+    record(
+        ip,
+        label or command,
+        attempt,
+        result.returncode,
+        start + result.queue,
+        result.duration,
+        result.queue + (start - queued if queued is not None else 0.0),
+    )
+    return result
+
+
+def run_command(
+    ip: str,
+    user: str,
+    password: str,
+    command: str,
+    input: Optional[Input] = None,
+    timeout: Optional[float] = None,
+    attempt: int = 1,
+    label: Optional[str] = None,
+    on_line: Optional[LineCallback] = None,
+) -> CommandResult:
+    """Synchronous wrapper around :func:`run_async`."""
+    try:
+        return asyncio.run(
+            run_async(
+                ip, user, password, command, input, timeout, attempt, label, on_line
+            )
+        )
+    finally:
+        # Queue time is only attributed to the first command of a unit of work
+        queued_since.set(None)
+
+
+async def call_async(
+    ip: str, user: str, password: str, op: str, **args: Any
+) -> Optional[Dict[str, Any]]:
+    """Run a remote agent operation and return its reply.
+
+    Returns None if the current transport has no agent on the host, callers
+    then fall back to an equivalent command. Answered calls are recorded as
+    tracing spans named ``rpc: <op>``.
+    """
+    queued = queued_since.get()
+    queued_since.set(None)
+    user, password = resolve_login(ip, user, password)
+    start = time.monotonic()
+    reply = await _transport.call(ip, user, password, op, args)
+    if reply is not None:
+        record(
+            ip,
+            f"rpc: {op}",
+            1,
+            reply.get("rc", 0),
+            start,
+            time.monotonic() - start,
+            start - queued if queued is not None else 0.0,
+        )
+    return reply
+
+
+def call(ip: str, user: str, password: str, op: str, **args: Any) -> Optional[Dict[str, Any]]:
+    """Synchronous wrapper around :func:`call_async`."""
+    try:
+        return asyncio.run(call_async(ip, user, password, op, **args))
+    finally:
+        queued_since.set(None)
+
+
+async def gather_hosts(
+    hosts: Iterable[str],
+    func: Callable[[str], Awaitable[T]],
+    limit: int = DEFAULT_LIMIT,
+    on_result: Optional[Callable[[str, Union[T, BaseException]], None]] = None,
+    timeout: Optional[float] = None,
+) -> Dict[str, Union[T, BaseException]]:
+    """Await ``func(host)`` for all hosts with at most ``limit`` in flight.
+
+    Exceptions are returned in place of a result so one failing host does not
+    cancel the others. A host whose ``func`` does not finish within
+    ``timeout`` seconds (the default set with :func:`set_timeout` if None) is
+    cancelled and reported with a :class:`TimeoutError`. ``on_result`` is called for every host as soon as its
+    result arrives. The returned mapping keeps the order of ``hosts``.
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+    if timeout is None:
+        timeout = _timeout
+
+    async def _one(host: str) -> T:
+        queued_since.set(time.monotonic())
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(func(host), timeout)
+            except asyncio.TimeoutError:
+                result = TimeoutError(f"{host} did not finish within {timeout:g}s")
+            except Exception as exc:  # reported per host
+                result = exc
+        if on_result is not None:
+            on_result(host, result)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    hosts = list(hosts)
+    results = await asyncio.gather(*(_one(h) for h in hosts), return_exceptions=True)
+    return dict(zip(hosts, results))
+
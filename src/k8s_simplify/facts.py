@@ -0,0 +1,111 @@
+"""Fleet-wide fact queries.
+
+All requested facts of a host are collected with a single remote exec, or a
+single RPC when the host runs the remote agent, and hosts are queried
+concurrently through the asyncio engine.
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .engine import DEFAULT_LIMIT, call_async, gather_hosts, run_async
+
+FACT_COMMANDS = {
+    "kubelet_version": "kubelet --version",
+    "containerd": "systemctl is-active containerd",
+    "kubelet": "systemctl is-active kubelet",
+}
+
+
+@dataclass
+class HostFacts:
+    host: str
+    facts: Dict[str, str] = field(default_factory=dict)
+    codes: Dict[str, int] = field(default_factory=dict)
+    error: str = ""
+
+    def ok(self, name: str) -> bool:
+        """Return True if the fact was collected with exit code 0."""
+        return self.codes.get(name) == 0
+
+
+def _facts_script(names: List[str]) -> str:
+    """Return a script printing ``name<TAB>exit code<TAB>first line`` per fact."""
+    lines = []
+    for name in names:
+        lines += [
+            f"__v=$({FACT_COMMANDS[name]} 2>/dev/null)",
+            "__rc=$?",
+            f"printf '{name}\\t%s\\t%s\\n' \"$__rc\" \"$(printf '%s' \"$__v\" | head -n1)\"",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def _parse_facts(host: str, stdout: str) -> HostFacts:
+    result = HostFacts(host)
+    for line in stdout.splitlines():
+        parts = line.split("\t", 2)
+        if len(parts) != 3 or parts[0] not in FACT_COMMANDS:
+            continue
+        result.codes[parts[0]] = int(parts[1])
+        result.facts[parts[0]] = parts[2].strip()
+    return result
+
+
+async def query_host(ip: str, user: str, password: str, names: List[str]) -> HostFacts:
+    """Collect the named facts of one host in a single exec."""
+    commands = {name: FACT_COMMANDS[name] for name in names}
+    reply = await call_async(ip, user, password, "facts", commands=commands)
+    if reply is not None:
+        if reply["rc"] != 0:
+            return HostFacts(ip, error=reply.get("error", f"exit code {reply['rc']}"))
+        result = HostFacts(ip)
+        for name, (code, value) in reply["facts"].items():
+            result.codes[name] = code
+            result.facts[name] = value
+        return result
+    result = await run_async(
+        ip,
+        user,
+        password,
+        "bash -s",
+        input=_facts_script(names),
+        label="facts: " + ", ".join(names),
+    )
+    if result.returncode != 0:
+        return HostFacts(ip, error=result.stderr.strip() or f"exit code {result.returncode}")
+    return _parse_facts(ip, result.stdout)
+
+
+def gather_facts(
+    hosts: Iterable[str],
+    user: str,
+    password: str,
+    names: List[str],
+    limit: int = DEFAULT_LIMIT,
+    on_result: Optional[Callable[[HostFacts], None]] = None,
+) -> Dict[str, HostFacts]:
+    """Query facts on all hosts concurrently.
+
+    ``on_result`` is invoked for each host as soon as its facts arrive.
+    """
+
+    async def _query(host: str) -> HostFacts:
+        return await query_host(host, user, password, names)
+
+    def _arrived(host: str, result) -> None:
+        if isinstance(result, BaseException):
+            result = HostFacts(host, error=str(result))
+        if on_result is not None:
+            on_result(result)
+
+    results = asyncio.run(gather_hosts(hosts, _query, limit, _arrived))
+    return {
+        host: (
+            result
+            if isinstance(result, HostFacts)
+            else HostFacts(host, error=str(result))
+        )
+        for host, result in results.items()
+    }
@@ -0,0 +1,170 @@
+"""Image pre-pull stage.
+
+Container images are pulled into containerd before the steps that need them,
+so downloads do not happen inside ``kubeadm init``, ``kubeadm upgrade apply``
+or right after a worker joined. The master pulls all control plane images
+(``kubeadm config images pull``), workers only ``kube-proxy`` and ``pause``.
+Every node also pulls the images referenced by the CNI manifest and, where
+dashboard pods may run, the dashboard manifest.
+
+Pulling is an optimization only: failures are reported but do not stop the
+run, the images are then pulled by Kubernetes as before.
+"""
+
+import asyncio
+from dataclasses import dataclass
+import shlex
+from typing import Dict, Iterable, List, Optional
+
+from .engine import DEFAULT_LIMIT, gather_hosts, run_async
+from .phase2 import DASHBOARD_MANIFEST, FLANNEL_MANIFEST
+
+_PULL_MARKER = "@@K8S_PULL"
+CRI_ENDPOINT = "unix:///run/containerd/containerd.sock"
+_CONTENT_DIR = "/var/lib/containerd/io.containerd.content.v1.content"
+
+
+@dataclass
+class PullResult:
+    host: str
+    ok: bool
+    duration: float
+    # Growth of the containerd content store, i.e. the downloaded layers
+    bytes: int = 0
+    error: str = ""
+
+
+def kube_version(version: str) -> str:
+    """Return ``v1.33.1`` for versions such as ``1.33.1-1.1`` or ``v1.33.1``."""
+    return "v" + version.lstrip("v").split("-")[0]
+
+
+def _quote_path(path: str) -> str:
+    """Quote a remote path, keeping a leading ``$HOME`` (bundle paths) expandable."""
+    if path.startswith("$HOME/"):
+        return '"$HOME"/' + shlex.quote(path[len("$HOME/"):])
+    return shlex.quote(path)
+
+
+def _pull_script(control_plane: bool, version: Optional[str], manifests: List[str]) -> str:
+    version_flag = f" --kubernetes-version {shlex.quote(version)}" if version else ""
+    lines = [
+        f"size() {{ s=$(sudo du -sb {_CONTENT_DIR} 2>/dev/null | cut -f1); echo \"${{s:-0}}\"; }}",
+        "before=$(size)",
+        "failed=0",
+        f"pull() {{ sudo crictl --runtime-endpoint {CRI_ENDPOINT} pull \"$1\" >/dev/null "
+        "|| { echo \"failed to pull $1\" >&2; failed=1; }; }",
+    ]
+    if control_plane:
+        lines.append(
+            f"sudo kubeadm config images pull{version_flag} >/dev/null || failed=1"
+        )
+    else:
+        lines += [
+            f"for image in $(kubeadm config images list{version_flag} 2>/dev/null"
+            " | grep -E '/(kube-proxy|pause):'); do pull \"$image\"; done",
+        ]
+    for manifest in manifests:
+        if "://" in manifest:
+            fetch = f"curl -fsSL {shlex.quote(manifest)}"
+        else:
+            fetch = f"cat {_quote_path(manifest)}"
+        lines += [
+            f"manifest=$({fetch}) || {{ echo \"failed to read {manifest}\" >&2; failed=1; }}",
+            "for image in $(printf '%s\\n' \"$manifest\""
+            " | grep -oE \"image:[[:space:]]*[\\\"']?[^\\\"'[:space:]]+\""
+            " | sed -E \"s/image:[[:space:]]*[\\\"']?//\" | sort -u); do pull \"$image\"; done",
+        ]
+    lines.append(f"printf '{_PULL_MARKER} %s %s\\n' \"$failed\" \"$(( $(size) - before ))\"")
+    return "\n".join(lines) + "\n"
+
+
+async def pull_images(
+    ip: str,
+    user: str,
+    password: str,
+    control_plane: bool = False,
+    version: Optional[str] = None,
+    manifests: Iterable[str] = (FLANNEL_MANIFEST,),
+) -> PullResult:
+    """Pull the images of one node in a single exec."""
+    result = await run_async(
+        ip,
+        user,
+        password,
+        "bash -s",
+        input=_pull_script(control_plane, version, list(manifests)),
+        label="image pre-pull",
+    )
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == _PULL_MARKER:
+            return PullResult(
+                ip,
+                parts[1] == "0" and result.returncode == 0,
+                result.duration,
+                max(0, int(parts[2])),
+                result.stderr.strip(),
+            )
+    return PullResult(
+        ip, False, result.duration, error=result.stderr.strip() or f"exit code {result.returncode}"
+    )
+
+
+def prepull_images(
+    master_ip: Optional[str],
+    worker_ips: List[str],
+    user: str,
+    password: str,
+    version: Optional[str] = None,
+    flannel_manifest: str = FLANNEL_MANIFEST,
+    dashboard_manifest: str = DASHBOARD_MANIFEST,
+    limit: int = DEFAULT_LIMIT,
+) -> Dict[str, PullResult]:
+    """Pull images on the master (if given) and all workers concurrently.
+
+    Dashboard images go to the workers, or to the master of a cluster
+    without workers.
+    """
+    hosts = ([master_ip] if master_ip else []) + worker_ips
+
+    async def _pull(host: str) -> PullResult:
+        manifests = [flannel_manifest]
+        if host != master_ip or not worker_ips:
+            manifests.append(dashboard_manifest)
+        return await pull_images(host, user, password, host == master_ip, version, manifests)
+
+    results = asyncio.run(gather_hosts(hosts, _pull, limit))
+    return {
+        host: (
+            result
+            if isinstance(result, PullResult)
+            else PullResult(host, False, 0.0, error=str(result))
+        )
+        for host, result in results.items()
+    }
+
+
+def format_size(size: int) -> str:
+    value = float(size)
+    for unit in ("B", "KiB", "MiB"):
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GiB"
+
+
+def format_pulls(results: Iterable[PullResult]) -> str:
+    """Return a per-node table of pull time and downloaded bytes."""
+    results = list(results)
+    width = max([len("HOST")] + [len(r.host) for r in results])
+    lines = [f"{'HOST':<{width}}  STATUS  TIME     DOWNLOADED"]
+    for r in results:
+        status = "ok" if r.ok else "FAILED"
+        line = f"{r.host:<{width}}  {status:<6}  {r.duration:6.1f}s  {format_size(r.bytes):>10}"
+        if r.error and not r.ok:
+            line += "  " + r.error.splitlines()[-1]
+        lines.append(line)
+    total = sum(r.bytes for r in results)
+    lines.append(f"Total downloaded: {format_size(total)}")
+    return "\n".join(lines)
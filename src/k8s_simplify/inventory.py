@@ -0,0 +1,165 @@
+"""Inventory files describing the hosts of a cluster.
+
+An inventory is a JSON (or, with PyYAML installed, YAML) document::
+
+    {
+      "vars": {"user": "ubuntu", "key_file": "~/.ssh/cluster"},
+      "groups": {
+        "master": {"hosts": ["10.0.0.10"]},
+        "rack3": {
+          "parallel": 10,
+          "vars": {"user": "admin"},
+          "hosts": ["10.0.3.1", {"address": "10.0.3.2", "port": 2222}]
+        }
+      }
+    }
+
+The ``master`` group holds the control plane node, the hosts of all other
+groups are workers. SSH settings (``user``, ``password``, ``port`` and
+``key_file``) are taken from the host, then its group, then the top level
+``vars``. ``parallel`` limits how many hosts of a group are worked on at the
+same time.
+"""
+
+from dataclasses import dataclass, field, fields
+import json
+import os
+from typing import Dict, Iterable, List
+
+from .connection import HostSettings
+
+try:
+    import yaml
+except ImportError:  # optional dependency
+    yaml = None
+
+_READ_ERRORS = (OSError, ValueError) + ((yaml.YAMLError,) if yaml else ())
+
+MASTER_GROUP = "master"
+
+
+class InventoryError(Exception):
+    """Custom exception for invalid inventories."""
+
+
+@dataclass
+class Group:
+    name: str
+    hosts: List[str] = field(default_factory=list)
+    # Maximum number of hosts of the group worked on concurrently, 0 for none
+    parallel: int = 0
+
+
+@dataclass
+class Inventory:
+    groups: Dict[str, Group] = field(default_factory=dict)
+    hosts: Dict[str, HostSettings] = field(default_factory=dict)
+
+    @property
+    def master(self) -> str:
+        return self.groups[MASTER_GROUP].hosts[0]
+
+    @property
+    def workers(self) -> List[str]:
+        workers: List[str] = []
+        for group in self.groups.values():
+            if group.name != MASTER_GROUP:
+                workers += [host for host in group.hosts if host not in workers]
+        return workers
+
+    def group_of(self, host: str) -> str:
+        """Return the first group listing ``host``."""
+        for group in self.groups.values():
+            if host in group.hosts:
+                return group.name
+        return ""
+
+    def group_limits(self) -> Dict[str, int]:
+        return {
+            group.name: group.parallel
+            for group in self.groups.values()
+            if group.parallel > 0
+        }
+
+    def select(self, selectors: Iterable[str]) -> List[str]:
+        """Return the hosts matching any selector, in inventory order.
+
+        A selector is ``group:<name>``, ``host:<address>`` or a bare group
+        name or address. Several selectors may be separated by commas.
+        """
+        chosen: List[str] = []
+        for selector in (s for item in selectors for s in item.split(",") if s):
+            kind, _, name = selector.rpartition(":")
+            if kind == "group" or (not kind and name in self.groups):
+                if name not in self.groups:
+                    raise InventoryError(f"Unknown group: {name}")
+                matched = self.groups[name].hosts
+            elif kind in ("host", ""):
+                if name not in self.hosts:
+                    raise InventoryError(f"Unknown host: {name}")
+                matched = [name]
+            else:
+                raise InventoryError(f"Invalid selector: {selector}")
+            chosen += [host for host in matched if host not in chosen]
+        order = list(self.hosts)
+        return sorted(chosen, key=order.index)
+
+
+def _settings(source: Dict, defaults: HostSettings) -> HostSettings:
+    if not isinstance(source, dict):
+        raise InventoryError(f"SSH settings must be a mapping, got {source!r}")
+    values = {}
+    for item in fields(HostSettings):
+        value = source.get(item.name, getattr(defaults, item.name))
+        try:
+            values[item.name] = item.type(value) if value is not None else item.default
+        except (TypeError, ValueError) as exc:
+            raise InventoryError(f"Invalid {item.name}: {value!r}") from exc
+    return HostSettings(**values)
+
+
+def parse_inventory(data: Dict) -> Inventory:
+    """Build an inventory from its decoded JSON or YAML document."""
+    if not isinstance(data, dict) or not isinstance(data.get("groups"), dict):
+        raise InventoryError("Inventory must contain a 'groups' mapping")
+    defaults = _settings(data.get("vars") or {}, HostSettings())
+    inventory = Inventory()
+    for name, spec in data["groups"].items():
+        spec = spec or {}
+        if not isinstance(spec, dict):
+            raise InventoryError(f"Group {name} must be a mapping")
+        group_defaults = _settings(spec.get("vars") or {}, defaults)
+        try:
+            group = Group(name, parallel=int(spec.get("parallel", 0)))
+        except (TypeError, ValueError) as exc:
+            raise InventoryError(f"Invalid parallel limit of group {name}") from exc
+        hosts = spec.get("hosts") or []
+        if not isinstance(hosts, list):
+            raise InventoryError(f"Hosts of group {name} must be a list")
+        for entry in hosts:
+            if isinstance(entry, str):
+                entry = {"address": entry}
+            if not isinstance(entry, dict):
+                raise InventoryError(f"Invalid host entry in group {name}: {entry!r}")
+            address = entry.get("address")
+            if not address:
+                raise InventoryError(f"Host without address in group {name}")
+            group.hosts.append(address)
+            inventory.hosts.setdefault(address, _settings(entry, group_defaults))
+        inventory.groups[name] = group
+    if not inventory.groups.get(MASTER_GROUP, Group(MASTER_GROUP)).hosts:
+        raise InventoryError(f"Inventory needs a host in the '{MASTER_GROUP}' group")
+    return inventory
+
+
+def load_inventory(path: str) -> Inventory:
+    """Read an inventory file, YAML files require PyYAML."""
+    is_yaml = os.path.splitext(path)[1].lower() in (".yaml", ".yml")
+    if is_yaml and yaml is None:
+        raise InventoryError("PyYAML is required for YAML inventories")
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = yaml.safe_load(f) if is_yaml else json.load(f)
+    except _READ_ERRORS as exc:
+        raise InventoryError(f"Failed to read inventory {path}: {exc}") from exc
+    return parse_inventory(data)
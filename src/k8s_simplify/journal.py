@@ -0,0 +1,107 @@
+"""On-disk checkpoint journal for resumable installs."""
+
+from datetime import datetime, timezone
+import json
+import os
+import threading
+import re
+from typing import Dict, Optional
+
+JOURNAL_DIR = os.path.expanduser("~/.k8s_simplify")
+# Cluster names become file names inside JOURNAL_DIR
+_NAME_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+
+class JournalError(Exception):
+    """Custom exception for journal failures."""
+
+
+def check_name(cluster_name: str) -> str:
+    """Return ``cluster_name`` if it is usable as a journal file name."""
+    if not _NAME_RE.fullmatch(cluster_name):
+        raise JournalError(
+            f"Invalid cluster name {cluster_name!r}, use letters, digits, '.', '_' and '-'"
+        )
+    return cluster_name
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+class Journal:
+    """Record completed phases and per-host steps of a cluster install.
+
+    The journal is stored as JSON in ``JOURNAL_DIR/<cluster_name>.json`` and
+    rewritten atomically after every change, so an interrupted run leaves a
+    consistent record behind. It may hold the dashboard token and is
+    therefore only readable by the owner.
+    """
+
+    def __init__(self, cluster_name: str, directory: str = JOURNAL_DIR):
+        self.path = os.path.join(directory, f"{check_name(cluster_name)}.json")
+        self._lock = threading.Lock()
+        self._data: Dict = {
+            "cluster": cluster_name,
+            "phases": {},
+            "hosts": {},
+            "data": {},
+        }
+
+    def load(self) -> bool:
+        """Load an existing journal, returning False if there is none."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as exc:
+            raise JournalError(f"Failed to read journal {self.path}: {exc}") from exc
+        if not isinstance(data, dict) or not all(
+            isinstance(data.get(key, {}), dict) for key in ("phases", "hosts", "data")
+        ):
+            raise JournalError(f"Journal {self.path} is corrupt")
+        self._data.update(data)
+        return True
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def reset(self) -> None:
+        """Forget all recorded progress."""
+        with self._lock:
+            self._data.update(phases={}, hosts={}, data={})
+            self._save()
+
+    def phase_done(self, phase: str) -> bool:
+        with self._lock:
+            return phase in self._data["phases"]
+
+    def mark_phase(self, phase: str) -> None:
+        with self._lock:
+            self._data["phases"][phase] = _now()
+            self._save()
+
+    def host_steps(self, ip: str) -> Dict[str, str]:
+        """Return completed steps of a host mapped to their timestamps."""
+        with self._lock:
+            return dict(self._data["hosts"].get(ip, {}))
+
+    def mark_host_step(self, ip: str, step: str) -> None:
+        with self._lock:
+            self._data["hosts"].setdefault(ip, {})[step] = _now()
+            self._save()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._data["data"].get(key)
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._data["data"][key] = value
+            self._save()
@@ -0,0 +1,103 @@
+"""Line-streamed remote output with bounded memory.
+
+Transports split the output of a command into lines and pass them to a
+callback as they arrive. Only a bounded tail of every stream is kept for
+error messages. :func:`host_output` provides the callback used for long
+running commands: depending on :func:`configure` it prints every line with a
+host prefix and appends it to a per-host log file.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import os
+import threading
+from typing import Callable, Iterator, Optional
+
+# Called with each line (without newline) and whether it came from stderr
+LineCallback = Callable[[str, bool], None]
+
+TAIL_LINES = 40
+# Longer lines are split so a missing newline cannot grow the buffer unbounded
+MAX_LINE = 64 * 1024
+
+_stream = False
+_log_dir: Optional[str] = None
+_print_lock = threading.Lock()
+
+
+def configure(stream: bool = False, log_dir: Optional[str] = None) -> None:
+    """Enable live printing and/or per-host log files for streamed output."""
+    global _stream, _log_dir
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    _stream = stream
+    _log_dir = log_dir or None
+
+
+class Tail:
+    """Ring buffer keeping the last ``maxlen`` lines of a stream."""
+
+    def __init__(self, maxlen: int = TAIL_LINES):
+        self._lines: deque = deque(maxlen=maxlen)
+        self.dropped = 0
+
+    def append(self, line: str) -> None:
+        if len(self._lines) == self._lines.maxlen:
+            self.dropped += 1
+        self._lines.append(line)
+
+    def text(self) -> str:
+        lines = list(self._lines)
+        if self.dropped:
+            lines.insert(0, f"... ({self.dropped} earlier lines omitted)")
+        return "\n".join(lines)
+
+
+class LineSplitter:
+    """Turn chunks of bytes into lines passed to ``on_line``."""
+
+    def __init__(self, on_line: Callable[[str], None]):
+        self._on_line = on_line
+        self._buffer = b""
+
+    def feed(self, data: bytes) -> None:
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        while len(self._buffer) > MAX_LINE:
+            lines.append(self._buffer[:MAX_LINE])
+            self._buffer = self._buffer[MAX_LINE:]
+        for line in lines:
+            self._on_line(line.rstrip(b"\r").decode("utf-8", "replace"))
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._on_line(self._buffer.decode("utf-8", "replace"))
+            self._buffer = b""
+
+
+@contextmanager
+def host_output(host: str, command: str) -> Iterator[LineCallback]:
+    """Yield a line callback printing and logging the output of ``host``.
+
+    The log file ``<log_dir>/<host>.log`` is only readable by the owner as
+    commands may contain join tokens.
+    """
+    log = None
+    if _log_dir is not None:
+        path = os.path.join(_log_dir, f"{host}.log")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        log = os.fdopen(fd, "a", encoding="utf-8")
+        log.write(f"$ {command}\n")
+
+    def _line(line: str, stderr: bool) -> None:
+        if log is not None:
+            log.write(line + "\n")
+        if _stream:
+            with _print_lock:
+                print(f"[{host}] {line}", flush=True)
+
+    try:
+        yield _line
+    finally:
+        if log is not None:
+            log.close()
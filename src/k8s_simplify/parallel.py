@@ -0,0 +1,168 @@
+"""Helpers for running per-host work concurrently."""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextvars
+from dataclasses import dataclass
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+from .tracing import queued_since
+
+_print_lock = threading.Lock()
+
+
+@dataclass
+class HostResult:
+    host: str
+    ok: bool
+    duration: float
+    error: str = ""
+
+
+def run_per_host(
+    hosts: Iterable[str],
+    func: Callable[[str, Callable[[str], None]], None],
+    limit: int = 1,
+    errors: Tuple[Type[BaseException], ...] = (Exception,),
+    groups: Optional[Dict[str, str]] = None,
+    group_limits: Optional[Dict[str, int]] = None,
+    on_result: Optional[Callable[[HostResult], None]] = None,
+    cancel: Optional[threading.Event] = None,
+) -> List[HostResult]:
+    """Run ``func(host, log)`` for every host on a bounded thread pool.
+
+    Messages passed to ``log`` are buffered and printed as one block when the
+    host finishes so output of concurrent hosts does not interleave. Failures
+    matching ``errors`` are recorded instead of aborting the other hosts.
+    Results are returned in the order of ``hosts``. Every host runs in a copy
+    of the caller's context so the current tracing phase is preserved.
+
+    ``groups`` maps hosts to group names; at most ``group_limits[group]``
+    hosts of a group run at the same time, hosts of other groups move ahead
+    while a group is at its limit. ``on_result`` is called with every result
+    as soon as its host finishes. Once ``cancel`` is set no further hosts are
+    started; they are reported as failed.
+    """
+
+    def _run(host: str, queued: float) -> HostResult:
+        queued_since.set(queued)
+        lines: List[str] = []
+        start = time.monotonic()
+        try:
+            func(host, lines.append)
+            result = HostResult(host, True, time.monotonic() - start)
+        except errors as exc:
+            lines.append(str(exc))
+            result = HostResult(host, False, time.monotonic() - start, str(exc))
+        with _print_lock:
+            for line in lines:
+                print(line)
+        return result
+
+    hosts = list(hosts)
+    if not hosts:
+        return []
+    groups = groups or {}
+    group_limits = group_limits or {}
+    limit = max(1, min(limit, len(hosts)))
+    queued = time.monotonic()
+    pending = list(hosts)
+    running: Dict = {}
+    in_use: Dict[str, int] = {}
+    results: Dict[str, HostResult] = {}
+    with ThreadPoolExecutor(max_workers=limit) as pool:
+        while pending or running:
+            if cancel is not None and cancel.is_set():
+                for host in pending:
+                    results[host] = HostResult(host, False, 0.0, "cancelled")
+                    if on_result is not None:
+                        on_result(results[host])
+                pending = []
+            for host in list(pending):
+                if len(running) >= limit:
+                    break
+                group = groups.get(host, "")
+                if in_use.get(group, 0) >= group_limits.get(group, limit):
+                    continue
+                pending.remove(host)
+                in_use[group] = in_use.get(group, 0) + 1
+                future = pool.submit(contextvars.copy_context().run, _run, host, queued)
+                running[future] = host
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                host = running.pop(future)
+                in_use[groups.get(host, "")] -= 1
+                results[host] = future.result()
+                if on_result is not None:
+                    on_result(results[host])
+    return [results[host] for host in hosts]
+
+
+class BackgroundHosts:
+    """Run :func:`run_per_host` in a background thread.
+
+    Callers can wait for the result of single hosts while the others are
+    still running. The arguments are those of :func:`run_per_host`.
+    """
+
+    def __init__(self, hosts: Iterable[str], func, limit: int = 1, **kwargs):
+        self._hosts = list(hosts)
+        self._args = (func, limit)
+        self._kwargs = kwargs
+        self._cancel = threading.Event()
+        self._done: Dict[str, threading.Event] = {h: threading.Event() for h in self._hosts}
+        self._results: Dict[str, HostResult] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def _finished(self, result: HostResult) -> None:
+        self._results[result.host] = result
+        self._done[result.host].set()
+
+    def _run(self) -> None:
+        try:
+            run_per_host(
+                self._hosts,
+                *self._args,
+                **self._kwargs,
+                on_result=self._finished,
+                cancel=self._cancel,
+            )
+        finally:
+            # Never leave waiters hanging if the run itself failed
+            for host in self._hosts:
+                if not self._done[host].is_set():
+                    self._finished(HostResult(host, False, 0.0, "not run"))
+
+    def start(self) -> None:
+        """Start the hosts in a copy of the caller's context."""
+        self._thread = threading.Thread(
+            target=contextvars.copy_context().run, args=(self._run,), daemon=True
+        )
+        self._thread.start()
+
+    def result(self, host: str) -> HostResult:
+        """Wait for ``host`` to finish and return its result."""
+        self._done[host].wait()
+        return self._results[host]
+
+    def stop(self) -> None:
+        """Start no further hosts and wait for the running ones to finish."""
+        self._cancel.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def format_results(results: List[HostResult]) -> str:
+    """Return a per-host result table."""
+    width = max([len("HOST")] + [len(r.host) for r in results])
+    lines = [f"{'HOST':<{width}}  STATUS  TIME"]
+    for r in results:
+        status = "ok" if r.ok else "FAILED"
+        line = f"{r.host:<{width}}  {status:<6}  {r.duration:6.1f}s"
+        if r.error:
+            line += "  " + r.error.splitlines()[0]
+        lines.append(line)
+    return "\n".join(lines)
@@ -1,122 +1,399 @@
 """Utilities for Phase 1: master node preparation."""
 
-from subprocess import CalledProcessError, run
-import shutil
-from typing import Optional
-from typing import List
+from dataclasses import dataclass
+from typing import Callable, Collection, Iterable, List, Optional, Set, Tuple
+
+from .engine import run_command
+from .output import LineCallback, Tail, host_output
+from .ratelimit import APT_MIRROR, consume
+from .retry import should_retry
 
 
 class Phase1Error(Exception):
     """Custom exception for phase 1 failures."""
 
 
-def _ssh_cmd(ip: str, user: str, password: str, command: str) -> List[str]:
-    base = ["ssh", "-o", "StrictHostKeyChecking=no", f"{user}@{ip}", command]
-    if password:
-        if shutil.which("sshpass") is None:
-            raise Phase1Error("sshpass is required for password authentication")
-        return ["sshpass", "-p", password] + base
-    return base
-
-
-def run_remote(ip: str, user: str, password: str, command: str, retries: int = 2) -> None:
-    """Run a command on a remote host via SSH with simple retries."""
-    last_exc: Optional[CalledProcessError] = None
-    for _ in range(retries + 1):
-        try:
-            run(
-                _ssh_cmd(ip, user, password, command),
-                check=True,
-                capture_output=True,
-                text=True,
+@dataclass
+class Step:
+    name: str
+    command: str
+    # Cheap probe that succeeds when the desired state is already in place
+    check: str = ""
+    # Name of the retry policy applied when the step fails
+    retry: str = "default"
+    # Shared upstream resources the step uses, see k8s_simplify.ratelimit
+    resources: Tuple[str, ...] = ()
+
+
+@dataclass
+class StepResult:
+    name: str
+    returncode: int
+    duration: float
+    output: str
+
+
+def run_remote(
+    ip: str,
+    user: str,
+    password: str,
+    command: str,
+    retries: Optional[int] = None,
+    policy: str = "default",
+    resources: Iterable[str] = (),
+) -> None:
+    """Run a command on a remote host via SSH, retrying transient failures.
+
+    The output is streamed through :func:`~k8s_simplify.output.host_output`
+    and only its tail is included in the error. Every attempt holds the named
+    rate-limited ``resources``.
+    """
+    attempt = 1
+    while True:
+        with consume(resources) as usage, host_output(ip, command) as on_line:
+            result = run_command(
+                ip, user, password, command, attempt=attempt, on_line=on_line
             )
+            usage.report(result.returncode, result.stderr + result.stdout)
+        if result.returncode == 0:
             return
-        except CalledProcessError as exc:
-            last_exc = exc
-    stderr = last_exc.stderr or ""
-    stdout = last_exc.stdout or ""
+        if not should_retry(
+            attempt, result.returncode, result.stderr + result.stdout, policy, retries
+        ):
+            break
+        attempt += 1
     raise Phase1Error(
-        f"Command failed on {ip}: {command}\nSTDOUT: {stdout}\nSTDERR: {stderr}"
-    ) from last_exc
+        f"Command failed on {ip}: {command}\nSTDOUT: {result.stdout}\nSTDERR: {result.stderr}"
+    )
 
 
-def prepare_master(ip: str, user: str, password: str) -> None:
-    """Execute master node preparation steps."""
-    print("* Installing required packages on master")
-    run_remote(ip, user, password, "sudo apt-get update -y")
-    run_remote(
-        ip,
-        user,
-        password,
-        "sudo apt-get install -y containerd apt-transport-https curl gpg",
-    )
+_STEP_MARKER = "@@K8S_STEP"
+_PROBE_MARKER = "@@K8S_PROBE"
+
 
-    print("* Configuring containerd")
-    run_remote(ip, user, password, "sudo mkdir -p /etc/containerd")
-    run_remote(
+def probe_steps(ip: str, user: str, password: str, steps: List[Step]) -> Set[str]:
+    """Return the names of steps whose check probe reports converged state.
+
+    All probes run in one remote exec. If the probe session fails nothing is
+    considered converged.
+    """
+    lines = []
+    for idx, step in enumerate(steps):
+        if step.check:
+            lines += [
+                f"( {step.check}",
+                ") </dev/null >/dev/null 2>&1",
+                f"printf '{_PROBE_MARKER} {idx} %d\\n' \"$?\"",
+            ]
+    if not lines:
+        return set()
+    result = run_command(
         ip,
         user,
         password,
-        "sudo sh -c 'containerd config default >/etc/containerd/config.toml'",
+        "bash -s",
+        input="\n".join(lines) + "\n",
+        label=f"probe {len(lines) // 3} steps",
     )
-    run_remote(ip, user, password, "sudo systemctl restart containerd")
+    if result.returncode != 0:
+        return set()
+    converged: Set[str] = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == _PROBE_MARKER and parts[2] == "0":
+            converged.add(steps[int(parts[1])].name)
+    return converged
 
-    print("* Installing kubeadm, kubelet and kubectl")
-    run_remote(
-        ip,
-        user,
-        password,
-        "curl -fsSL https://pkgs.k8s.io/core:/stable:/v1.33/deb/Release.key | "
-        "sudo gpg --batch --yes --dearmor -o /etc/apt/keyrings/kubernetes-apt-keyring.gpg",
+
+def _batch_script(steps: List[Step]) -> str:
+    """Compile steps into one shell script reporting a marker line per step.
+
+    Every step runs in a subshell with stdin detached so it cannot consume the
+    script itself. Its combined output is passed through line by line (awk
+    terminates a last line lacking a newline) and followed by a marker with
+    the step index, exit code and start and end time in nanoseconds.
+    Execution stops at the first failing step.
+    """
+    lines = []
+    for idx, step in enumerate(steps):
+        lines += [
+            "__s=$(date +%s%N)",
+            f"( {step.command}",
+            ") </dev/null 2>&1 | awk '{ print; fflush() }'",
+            "__rc=${PIPESTATUS[0]}",
+            "__e=$(date +%s%N)",
+            f"printf '{_STEP_MARKER} {idx} %d %s %s\\n' \"$__rc\" \"$__s\" \"$__e\"",
+            '[ "$__rc" -eq 0 ] || exit 0',
+        ]
+    return "\n".join(lines) + "\n"
+
+
+class _BatchOutput:
+    """Split the streamed output of a batch into per-step results.
+
+    Output lines are forwarded to ``on_line`` and the last lines of the
+    running step are kept for its result.
+    """
+
+    def __init__(self, steps: List[Step], on_line: Optional[LineCallback] = None):
+        self.steps = steps
+        self.results: List[StepResult] = []
+        self.tail = Tail()
+        self._on_line = on_line
+
+    def __call__(self, line: str, stderr: bool = False) -> None:
+        if not stderr and line.startswith(_STEP_MARKER + " "):
+            idx, rc, start, end = (int(p) for p in line.split()[1:5])
+            self.results.append(
+                StepResult(self.steps[idx].name, rc, (end - start) / 1e9, self.tail.text())
+            )
+            self.tail = Tail()
+            return
+        self.tail.append(line)
+        if self._on_line is not None:
+            self._on_line(line, stderr)
+
+
+def run_batch(
+    ip: str, user: str, password: str, steps: List[Step], attempt: int = 1
+) -> List[StepResult]:
+    """Run steps in a single SSH session and return per-step results.
+
+    Step output is streamed through :func:`~k8s_simplify.output.host_output`.
+    Steps after the first failure are not executed and have no result.
+    """
+    label = f"batch: {steps[0].name} .. {steps[-1].name}"
+    with host_output(ip, label) as on_line:
+        batch = _BatchOutput(steps, on_line)
+        proc = run_command(
+            ip,
+            user,
+            password,
+            "bash -s",
+            input=_batch_script(steps),
+            attempt=attempt,
+            label=label,
+            on_line=batch,
+        )
+    results = batch.results
+    if proc.returncode != 0 and len(results) < len(steps):
+        # The session itself failed, record it against the next step
+        results.append(
+            StepResult(
+                steps[len(results)].name,
+                proc.returncode,
+                0.0,
+                batch.tail.text(),
+            )
+        )
+    return results
+
+
+def run_steps(
+    ip: str,
+    user: str,
+    password: str,
+    steps: List[Step],
+    retries: Optional[int] = None,
+    skip: Collection[str] = (),
+    on_step: Optional[Callable[[StepResult], None]] = None,
+) -> List[StepResult]:
+    """Run steps in batches, retrying only the failed step and its successors.
+
+    A failed step is retried according to its retry policy, ``retries``
+    overrides the number of retries of every step. Each step has its own
+    retry budget, retries of earlier steps do not count against it. Each batch holds the
+    rate-limited resources declared by its steps. Steps named in ``skip``
+    are not executed. ``on_step`` is called for every successful step once
+    the batch has returned.
+    """
+    steps = [step for step in steps if step.name not in skip]
+    done: List[StepResult] = []
+    if not steps:
+        return done
+    attempt, failed_at = 1, 0
+    while True:
+        pending = steps[len(done):]
+        # The batch holds the resources of all its steps
+        with consume(r for step in pending for r in step.resources) as usage:
+            results = run_batch(ip, user, password, pending, attempt)
+            # Only failures of steps using the resources count against them
+            for step, result in zip(pending, results):
+                if result.returncode != 0 and step.resources:
+                    usage.report(result.returncode, result.output)
+        for result in results:
+            if result.returncode != 0:
+                break
+            done.append(result)
+            if on_step is not None:
+                on_step(result)
+        if len(done) == len(steps):
+            return done
+        if len(done) > failed_at:
+            attempt, failed_at = 1, len(done)
+        failed = results[-1] if results else StepResult(pending[0].name, 1, 0.0, "")
+        if not should_retry(
+            attempt, failed.returncode, failed.output, steps[len(done)].retry, retries
+        ):
+            break
+        attempt += 1
+    failed = steps[len(done)]
+    output = results[-1].output if results else ""
+    raise Phase1Error(
+        f"Step '{failed.name}' failed on {ip}: {failed.command}\nOUTPUT: {output}"
     )
-    run_remote(
-        ip,
-        user,
-        password,
-        "echo 'deb [signed-by=/etc/apt/keyrings/kubernetes-apt-keyring.gpg] "
-        "https://pkgs.k8s.io/core:/stable:/v1.33/deb/ /' | "
-        "sudo tee /etc/apt/sources.list.d/kubernetes.list",
+
+
+BASE_PACKAGES = ["containerd", "apt-transport-https", "curl", "gpg"]
+_KUBE_PACKAGES = ["kubelet", "kubeadm", "kubectl"]
+KUBE_REPO_URL = "https://pkgs.k8s.io/core:/stable:/v1.33/deb/"
+_KUBE_REPO = (
+    "deb [signed-by=/etc/apt/keyrings/kubernetes-apt-keyring.gpg] "
+    f"{KUBE_REPO_URL} /"
+)
+
+
+def installed_check(packages: List[str]) -> str:
+    """Return a probe succeeding when all packages are installed."""
+    return (
+        "test \"$(dpkg-query -W -f='${db:Status-Status}\\n' "
+        + " ".join(packages)
+        + f" 2>/dev/null | grep -cx installed)\" -eq {len(packages)}"
     )
-    run_remote(ip, user, password, "sudo apt-get update -y")
-    run_remote(
-        ip,
-        user,
-        password,
+
+
+_CONTAINERD_CONFIGURED = (
+    "containerd config default | cmp -s - /etc/containerd/config.toml"
+)
+
+NODE_STEPS = [
+    Step(
+        "update package index",
+        "sudo apt-get update -y",
+        check=installed_check(BASE_PACKAGES),
+        retry="apt",
+        resources=(APT_MIRROR,),
+    ),
+    Step(
+        "install base packages",
+        "sudo apt-get install -y " + " ".join(BASE_PACKAGES),
+        check=installed_check(BASE_PACKAGES),
+        retry="apt",
+        resources=(APT_MIRROR,),
+    ),
+    Step(
+        "create containerd config dir",
+        "sudo mkdir -p /etc/containerd",
+        check="test -d /etc/containerd",
+    ),
+    Step(
+        "write containerd config",
+        "sudo sh -c 'containerd config default >/etc/containerd/config.toml'",
+        check=_CONTAINERD_CONFIGURED,
+    ),
+    Step(
+        "restart containerd",
+        "sudo systemctl restart containerd",
+        # Only restart when the config is rewritten or containerd is down
+        check=_CONTAINERD_CONFIGURED + " && systemctl is-active --quiet containerd",
+    ),
+    Step(
+        "add kubernetes apt key",
+        f"curl -fsSL {KUBE_REPO_URL}Release.key | "
+        "sudo gpg --batch --yes --dearmor -o /etc/apt/keyrings/kubernetes-apt-keyring.gpg",
+        check="test -s /etc/apt/keyrings/kubernetes-apt-keyring.gpg",
+        resources=(APT_MIRROR,),
+    ),
+    Step(
+        "add kubernetes apt repo",
+        f"echo '{_KUBE_REPO}' | sudo tee /etc/apt/sources.list.d/kubernetes.list",
+        check=f"grep -qxF '{_KUBE_REPO}' /etc/apt/sources.list.d/kubernetes.list",
+    ),
+    Step(
+        "update kubernetes package index",
+        "sudo apt-get update -y",
+        check=installed_check(_KUBE_PACKAGES),
+        retry="apt",
+        resources=(APT_MIRROR,),
+    ),
+    Step(
+        "install kubernetes packages",
         "sudo apt-get install -y kubelet kubeadm kubectl && "
         "sudo apt-mark hold kubelet kubeadm kubectl",
-    )
-
-    print("* Disabling swap")
-    run_remote(ip, user, password, "sudo swapoff -a")
-    run_remote(
-        ip,
-        user,
-        password,
+        check=installed_check(_KUBE_PACKAGES)
+        + " && test \"$(apt-mark showhold | grep -cxE 'kubelet|kubeadm|kubectl')\" -eq 3",
+        retry="apt",
+        resources=(APT_MIRROR,),
+    ),
+    Step(
+        "disable swap",
+        "sudo swapoff -a",
+        check="test -z \"$(swapon --show --noheadings)\"",
+    ),
+    Step(
+        "disable swap in fstab",
         "sudo sed -i '/ swap / s/^/#/' /etc/fstab",
-    )
-
-    print("* Enabling IPv4 forwarding")
-    run_remote(ip, user, password, "sudo sysctl -w net.ipv4.ip_forward=1")
-    run_remote(
-        ip,
-        user,
-        password,
+        check="! grep -v '^#' /etc/fstab | grep -q ' swap '",
+    ),
+    Step(
+        "enable ipv4 forwarding",
+        "sudo sysctl -w net.ipv4.ip_forward=1",
+        check="test \"$(sysctl -n net.ipv4.ip_forward)\" = 1",
+    ),
+    Step(
+        "persist ipv4 forwarding",
         "grep -q '^net.ipv4.ip_forward=1' /etc/sysctl.conf || "
         "echo 'net.ipv4.ip_forward=1' | sudo tee -a /etc/sysctl.conf",
-    )
+        check="grep -q '^net.ipv4.ip_forward=1' /etc/sysctl.conf",
+    ),
+]
 
-    print("* Creating k8sadmin user")
-    run_remote(
-        ip,
-        user,
-        password,
+# Succeeds when a node still has everything NODE_STEPS set up, e.g. after
+# ``kubeadm reset``
+NODE_PREPARED_CHECK = " && ".join(f"( {step.check} )" for step in NODE_STEPS)
+
+MASTER_STEPS = NODE_STEPS + [
+    Step(
+        "create k8sadmin user",
         "id k8sadmin >/dev/null 2>&1 || sudo useradd -m -s /bin/bash k8sadmin",
-    )
-    run_remote(
+        check="id k8sadmin",
+    ),
+    Step(
+        "grant k8sadmin sudo",
+        "echo 'k8sadmin ALL=(ALL) NOPASSWD:ALL' | sudo tee /etc/sudoers.d/k8sadmin",
+        check="sudo grep -qxF 'k8sadmin ALL=(ALL) NOPASSWD:ALL' /etc/sudoers.d/k8sadmin",
+    ),
+]
+
+
+def prepare_master(
+    ip: str,
+    user: str,
+    password: str,
+    skip: Collection[str] = (),
+    on_step: Optional[Callable[[StepResult], None]] = None,
+    steps: Optional[List[Step]] = None,
+) -> None:
+    """Execute master node preparation steps in a single SSH round trip.
+
+    Steps whose check probe shows the desired state is already in place are
+    skipped. ``steps`` replaces the default ``MASTER_STEPS``.
+    """
+    print("* Running master preparation steps")
+    steps = MASTER_STEPS if steps is None else steps
+    pending = [step for step in steps if step.name not in skip]
+    converged = probe_steps(ip, user, password, pending)
+    for step in pending:
+        if step.name in converged:
+            print(f"  - {step.name} (already converged, skipped)")
+    results = run_steps(
         ip,
         user,
         password,
-        "echo 'k8sadmin ALL=(ALL) NOPASSWD:ALL' | sudo tee /etc/sudoers.d/k8sadmin",
+        pending,
+        skip=converged,
+        on_step=on_step,
     )
+    for result in results:
+        print(f"  - {result.name} ({result.duration:.1f}s)")
     print("Master node preparation complete")
-
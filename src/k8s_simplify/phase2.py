@@ -1,104 +1,208 @@
 """Utilities for Phase 2: Kubernetes master installation."""
 
-from subprocess import CalledProcessError, run
-from typing import Optional
 import time
+from typing import Iterable, Optional
 
-from .phase1 import _ssh_cmd
+from .engine import run_command
+from .output import host_output
+from .ratelimit import consume
+from .retry import should_retry
+
+FLANNEL_MANIFEST = (
+    "https://raw.githubusercontent.com/flannel-io/flannel/master/Documentation/kube-flannel.yml"
+)
+DASHBOARD_MANIFEST = (
+    "https://raw.githubusercontent.com/kubernetes/dashboard/v2.7.0/aio/deploy/recommended.yaml"
+)
 
 
 class Phase2Error(Exception):
     """Custom exception for phase 2 failures."""
 
 
-def run_remote_capture(ip: str, user: str, password: str, command: str, retries: int = 2) -> str:
-    """Run a remote command via SSH and return its output with retries."""
-    cmd = _ssh_cmd(ip, user, password, command)
-    last_exc: Optional[CalledProcessError] = None
-    for _ in range(retries + 1):
-        try:
-            result = run(cmd, check=True, capture_output=True, text=True)
+def run_remote_capture(
+    ip: str,
+    user: str,
+    password: str,
+    command: str,
+    retries: Optional[int] = None,
+    policy: str = "default",
+    stream: bool = False,
+    resources: Iterable[str] = (),
+) -> str:
+    """Run a remote command via SSH and return its output.
+
+    Transient failures are retried according to the named retry policy. With
+    ``stream`` the output is streamed through
+    :func:`~k8s_simplify.output.host_output` and only its tail is returned.
+    Every attempt holds the named rate-limited ``resources``.
+    """
+    attempt = 1
+    while True:
+        with consume(resources) as usage:
+            if stream:
+                with host_output(ip, command) as on_line:
+                    result = run_command(
+                        ip, user, password, command, attempt=attempt, on_line=on_line
+                    )
+            else:
+                result = run_command(ip, user, password, command, attempt=attempt)
+            usage.report(result.returncode, result.stderr + result.stdout)
+        if result.returncode == 0:
             return result.stdout.strip()
-        except CalledProcessError as exc:
-            last_exc = exc
-    stderr = last_exc.stderr if last_exc and last_exc.stderr else ""
+        if not should_retry(
+            attempt, result.returncode, result.stderr + result.stdout, policy, retries
+        ):
+            break
+        attempt += 1
     raise Phase2Error(
-        f"Command failed on {ip}: {command}\n{stderr}"
-    ) from last_exc
+        f"Command failed on {ip}: {command}\n{result.stderr}"
+    )
+
+
+def _wait_until(
+    ip: str,
+    user: str,
+    password: str,
+    command: str,
+    what: str,
+    timeout: int = 120,
+    initial_delay: float = 0.5,
+    max_delay: float = 10.0,
+) -> None:
+    """Poll ``command`` on the host until it succeeds or ``timeout`` expires.
+
+    The delay between attempts doubles after every failed poll, capped at
+    ``max_delay``, so fast steps are detected quickly without hammering the
+    host on slow ones.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while run_command(ip, user, password, command).returncode != 0:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Phase2Error(f"{what} on {ip} did not become ready")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
 
 
 def _wait_for_apiserver(ip: str, user: str, password: str, timeout: int = 60) -> None:
     """Wait until the API server on the master node becomes reachable."""
-    end_time = time.time() + timeout
-    while time.time() < end_time:
-        try:
-            run_remote_capture(
-                ip,
-                user,
-                password,
-                f"curl -kfs https://{ip}:6443/healthz >/dev/null",
-            )
-            return
-        except Phase2Error:
-            time.sleep(5)
-    raise Phase2Error(f"API server on {ip} did not become ready")
-
-
-def init_master(ip: str, user: str, password: str) -> str:
-    """Initialize Kubernetes control plane and dashboard."""
-    print("* Initializing Kubernetes control plane")
-    run_remote_capture(ip, user, password, "sudo kubeadm init --pod-network-cidr=10.244.0.0/16")
-    time.sleep(10)
+    _wait_until(
+        ip,
+        user,
+        password,
+        f"curl -kfs https://{ip}:6443/healthz >/dev/null",
+        "API server",
+        timeout,
+    )
+
+
+def init_master(
+    ip: str,
+    user: str,
+    password: str,
+    flannel_manifest: str = FLANNEL_MANIFEST,
+    dashboard_manifest: str = DASHBOARD_MANIFEST,
+) -> str:
+    """Initialize Kubernetes control plane and dashboard.
+
+    Each step is followed by a readiness check polled with exponential backoff
+    instead of a fixed delay. The manifests may be URLs or paths on the master.
+    All steps are idempotent, so a failed run can be resumed from the start of
+    the phase on a master that is already initialized.
+    """
+    if run_command(ip, user, password, "sudo test -s /etc/kubernetes/admin.conf").returncode == 0:
+        print("* Kubernetes control plane already initialized")
+    else:
+        print("* Initializing Kubernetes control plane")
+        run_remote_capture(
+            ip,
+            user,
+            password,
+            "sudo kubeadm init --pod-network-cidr=10.244.0.0/16",
+            stream=True,
+        )
     _wait_for_apiserver(ip, user, password)
 
     print("* Configuring kubeconfig")
     run_remote_capture(ip, user, password, "mkdir -p $HOME/.kube")
-    time.sleep(10)
     run_remote_capture(ip, user, password, "sudo cp /etc/kubernetes/admin.conf $HOME/.kube/config")
-    time.sleep(10)
     run_remote_capture(ip, user, password, "sudo chown $(id -u):$(id -g) $HOME/.kube/config")
-    time.sleep(10)
+    _wait_until(
+        ip,
+        user,
+        password,
+        "test -s $HOME/.kube/config && kubectl get --raw /healthz >/dev/null",
+        "kubeconfig",
+    )
 
     print("* Deploying Flannel networking")
     run_remote_capture(
         ip,
         user,
         password,
-        "kubectl apply -f https://raw.githubusercontent.com/flannel-io/flannel/master/Documentation/kube-flannel.yml",
+        f"kubectl apply -f {flannel_manifest}",
+    )
+    _wait_until(
+        ip,
+        user,
+        password,
+        "kubectl -n kube-flannel rollout status daemonset/kube-flannel-ds --timeout=10s",
+        "Flannel DaemonSet",
+        timeout=300,
     )
-    time.sleep(10)
 
     print("* Installing Kubernetes dashboard")
     run_remote_capture(
         ip,
         user,
         password,
-        "kubectl apply -f https://raw.githubusercontent.com/kubernetes/dashboard/v2.7.0/aio/deploy/recommended.yaml",
+        f"kubectl apply -f {dashboard_manifest}",
+    )
+    # The dashboard pod only schedules on workers, so Phase 5 waits for it
+    # to become Available once they have joined
+    _wait_until(
+        ip,
+        user,
+        password,
+        "kubectl -n kubernetes-dashboard get deployment/kubernetes-dashboard",
+        "Dashboard deployment",
+    )
+    run_remote_capture(
+        ip,
+        user,
+        password,
+        "kubectl create serviceaccount dashboard-admin -n kubernetes-dashboard "
+        "--dry-run=client -o yaml | kubectl apply -f -",
+    )
+    _wait_until(
+        ip,
+        user,
+        password,
+        "kubectl -n kubernetes-dashboard get serviceaccount dashboard-admin",
+        "Dashboard service account",
     )
-    time.sleep(10)
-    run_remote_capture(ip, user, password, "kubectl create serviceaccount dashboard-admin -n kubernetes-dashboard")
-    time.sleep(10)
     run_remote_capture(
         ip,
         user,
         password,
-        "kubectl create clusterrolebinding dashboard-admin --clusterrole=cluster-admin --serviceaccount=kubernetes-dashboard:dashboard-admin",
+        "kubectl create clusterrolebinding dashboard-admin --clusterrole=cluster-admin "
+        "--serviceaccount=kubernetes-dashboard:dashboard-admin "
+        "--dry-run=client -o yaml | kubectl apply -f -",
     )
-    time.sleep(10)
     run_remote_capture(
         ip,
         user,
         password,
         "kubectl -n kubernetes-dashboard patch svc kubernetes-dashboard --type='json' -p='[{\"op\":\"replace\",\"path\":\"/spec/type\",\"value\":\"NodePort\"},{\"op\":\"add\",\"path\":\"/spec/ports/0/nodePort\",\"value\":32443}]'",
     )
-    time.sleep(10)
     token = run_remote_capture(
         ip,
         user,
         password,
         "kubectl -n kubernetes-dashboard create token dashboard-admin --duration=8760h",
     )
-    time.sleep(10)
     print(f"Dashboard URL: https://{ip}:32443")
     print(f"Dashboard token: {token}")
     return token
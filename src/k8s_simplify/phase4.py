@@ -1,69 +1,186 @@
 """Utilities for Phase 4: worker node deployment."""
 
-from subprocess import CalledProcessError, run
+import contextvars
+import re
+import shlex
+import threading
+import time
+from typing import Callable, Collection, List, Optional
 
-from .phase1 import Phase1Error, run_remote
+from .phase1 import (
+    NODE_STEPS,
+    Phase1Error,
+    Step,
+    StepResult,
+    probe_steps,
+    run_remote,
+    run_steps,
+)
 from .phase2 import run_remote_capture
+from .ratelimit import APISERVER_JOIN
+
+
+# Lifetime of bootstrap tokens minted by the broker, in seconds
+TOKEN_TTL = 2 * 3600
+# A join command is handed out only if its token stays valid this long
+TOKEN_MARGIN = 600
+TOKEN_DESCRIPTION = "k8s_simplify worker join"
 
 
 class Phase4Error(Exception):
     """Custom exception for phase 4 failures."""
 
 
-def get_join_command(ip: str, user: str, password: str) -> str:
-    """Retrieve the kubeadm join command from the master node."""
+def get_join_command(
+    ip: str, user: str, password: str, ttl: Optional[int] = None
+) -> str:
+    """Retrieve the kubeadm join command from the master node.
+
+    ``ttl`` sets the lifetime of the new token in seconds instead of the
+    kubeadm default of 24 hours.
+    """
+    command = "kubeadm token create --print-join-command"
+    if ttl is not None:
+        command += f" --ttl {ttl}s --description {shlex.quote(TOKEN_DESCRIPTION)}"
     try:
-        return run_remote_capture(
-            ip,
-            user,
-            password,
-            "kubeadm token create --print-join-command",
-        )
+        return run_remote_capture(ip, user, password, command)
     except Exception as exc:  # broad but fine for CLI tool
         raise Phase4Error(f"Failed to get join command from {ip}") from exc
 
 
-def prepare_worker(ip: str, user: str, password: str) -> None:
-    """Install prerequisites on the worker node."""
-    steps = [
-        "sudo apt-get update -y",
-        "sudo apt-get install -y containerd apt-transport-https curl gpg",
-        "sudo mkdir -p /etc/containerd",
-        "sudo sh -c 'containerd config default >/etc/containerd/config.toml'",
-        "sudo systemctl restart containerd",
-        (
-            "curl -fsSL https://pkgs.k8s.io/core:/stable:/v1.33/deb/Release.key | "
-            "sudo gpg --batch --yes --dearmor -o /etc/apt/keyrings/kubernetes-apt-keyring.gpg"
-        ),
-        (
-            "echo 'deb [signed-by=/etc/apt/keyrings/kubernetes-apt-keyring.gpg] "
-            "https://pkgs.k8s.io/core:/stable:/v1.33/deb/ /' | "
-            "sudo tee /etc/apt/sources.list.d/kubernetes.list"
-        ),
-        "sudo apt-get update -y",
-        (
-            "sudo apt-get install -y kubelet kubeadm kubectl && "
-            "sudo apt-mark hold kubelet kubeadm kubectl"
-        ),
-        "sudo swapoff -a",
-        "sudo sed -i '/ swap / s/^/#/' /etc/fstab",
-        "sudo sysctl -w net.ipv4.ip_forward=1",
-        (
-            "grep -q '^net.ipv4.ip_forward=1' /etc/sysctl.conf || "
-            "echo 'net.ipv4.ip_forward=1' | sudo tee -a /etc/sysctl.conf"
-        ),
-    ]
-    for cmd in steps:
+class JoinTokenBroker:
+    """Share one join command between concurrent worker joins.
+
+    The join command is minted once and handed to every joiner while its
+    token has more than ``margin`` seconds left. Within ``2 * margin`` of
+    the expiry a fresh token is minted in the background, so joiners only
+    wait on the master for the first token or if the refresh fell behind.
+    Tokens created by the broker are deleted by :meth:`revoke`, which is
+    called automatically when it is used as a context manager.
+    """
+
+    def __init__(
+        self,
+        ip: str,
+        user: str,
+        password: str,
+        ttl: int = TOKEN_TTL,
+        margin: int = TOKEN_MARGIN,
+    ):
+        if ttl <= 2 * margin:
+            raise Phase4Error(
+                f"Token TTL of {ttl}s must exceed twice the refresh margin ({2 * margin}s)"
+            )
+        self._login = (ip, user, password)
+        self._ttl = ttl
+        self._margin = margin
+        self._lock = threading.Lock()
+        self._mint_lock = threading.Lock()
+        self._join_cmd = ""
+        self._expires = 0.0
+        self._refreshing = False
+        self._closed = False
+        self._tokens: List[str] = []
+
+    def _mint(self) -> None:
+        """Mint a token, the caller holds ``_mint_lock``."""
+        with self._lock:
+            # A refresh racing with revoke must not leave a token behind
+            if self._closed:
+                raise Phase4Error("Join token broker is closed")
+        start = time.monotonic()
+        join_cmd = get_join_command(*self._login, ttl=self._ttl)
+        match = re.search(r"--token\s+(\S+)", join_cmd)
+        with self._lock:
+            if match:
+                self._tokens.append(match.group(1))
+            if start + self._ttl > self._expires:
+                self._join_cmd = join_cmd
+                self._expires = start + self._ttl
+
+    def _refresh(self) -> None:
+        try:
+            with self._mint_lock:
+                self._mint()
+        except Phase4Error:
+            pass  # joiners mint synchronously once the margin is reached
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _valid(self) -> bool:
+        return self._expires - time.monotonic() > self._margin
+
+    def join_command(self) -> str:
+        """Return a join command whose token is valid for at least ``margin``."""
+        with self._lock:
+            if self._valid():
+                remaining = self._expires - time.monotonic()
+                if remaining <= 2 * self._margin and not self._refreshing:
+                    self._refreshing = True
+                    context = contextvars.copy_context()
+                    threading.Thread(
+                        target=context.run, args=(self._refresh,), daemon=True
+                    ).start()
+                return self._join_cmd
+        # Only one joiner mints, the others reuse its token
+        with self._mint_lock:
+            with self._lock:
+                if self._valid():
+                    return self._join_cmd
+            self._mint()
+            with self._lock:
+                return self._join_cmd
+
+    def revoke(self) -> None:
+        """Delete all tokens created by the broker, failures are reported.
+
+        The broker mints no further tokens afterwards.
+        """
+        with self._mint_lock, self._lock:
+            self._closed = True
+            tokens, self._tokens = self._tokens, []
+            self._join_cmd, self._expires = "", 0.0
+        if not tokens:
+            return
         try:
-            run_remote(ip, user, password, cmd)
-        except Phase1Error as exc:
-            raise Phase4Error(str(exc)) from exc
+            run_remote_capture(*self._login, "kubeadm token delete " + " ".join(tokens))
+        except Exception as exc:  # broad but fine for CLI tool
+            print(f"Warning: failed to delete join tokens on {self._login[0]}: {exc}")
+
+    def __enter__(self) -> "JoinTokenBroker":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.revoke()
+
+
+def prepare_worker(
+    ip: str,
+    user: str,
+    password: str,
+    skip: Collection[str] = (),
+    on_step: Optional[Callable[[StepResult], None]] = None,
+    steps: Optional[List[Step]] = None,
+) -> None:
+    """Install prerequisites on the worker node in a single SSH round trip.
+
+    Steps whose check probe shows the desired state is already in place are
+    skipped. ``steps`` replaces the default ``NODE_STEPS``.
+    """
+    steps = NODE_STEPS if steps is None else steps
+    pending = [step for step in steps if step.name not in skip]
+    try:
+        converged = probe_steps(ip, user, password, pending)
+        run_steps(ip, user, password, pending, skip=converged, on_step=on_step)
+    except Phase1Error as exc:
+        raise Phase4Error(str(exc)) from exc
 
 
 def join_worker(ip: str, user: str, password: str, join_cmd: str) -> None:
     """Join the worker node to the Kubernetes cluster."""
     try:
-        run_remote(ip, user, password, f"sudo {join_cmd}")
+        run_remote(ip, user, password, f"sudo {join_cmd}", resources=(APISERVER_JOIN,))
     except Phase1Error as exc:
         raise Phase4Error(str(exc)) from exc
 
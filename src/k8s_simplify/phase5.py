@@ -1,5 +1,11 @@
 """Utilities for Phase 5: node health checks."""
 
+from dataclasses import dataclass, field
+import json
+import shlex
+import time
+from typing import Dict, Iterable, List, Optional
+
 from .phase2 import run_remote_capture
 
 
@@ -7,6 +13,27 @@ class Phase5Error(Exception):
     """Custom exception for phase 5 failures."""
 
 
+@dataclass
+class NodeState:
+    name: str
+    internal_ip: str = ""
+    # All addresses of the node (InternalIP, ExternalIP, Hostname, ...)
+    addresses: List[str] = field(default_factory=list)
+    # Condition type mapped to its status ("True", "False" or "Unknown")
+    conditions: Dict[str, str] = field(default_factory=dict)
+    reason: str = ""
+    message: str = ""
+
+    @property
+    def ready(self) -> bool:
+        return self.conditions.get("Ready") == "True"
+
+    def status(self) -> str:
+        if self.ready:
+            return "Ready"
+        return "NotReady" + (f" ({self.reason})" if self.reason else "")
+
+
 def list_nodes(ip: str, user: str, password: str) -> str:
     """Return the output of `kubectl get nodes` from the master node."""
     try:
@@ -15,17 +42,152 @@ def list_nodes(ip: str, user: str, password: str) -> str:
         raise Phase5Error(f"Failed to retrieve node list from {ip}") from exc
 
 
+def _parse_nodes(output: str) -> Dict[str, NodeState]:
+    """Parse ``kubectl get nodes -o json`` output into node states by name."""
+    try:
+        data = json.loads(output)
+    except ValueError as exc:
+        raise Phase5Error("Invalid node list returned by kubectl") from exc
+    # A single named node is returned as the object itself
+    items = data.get("items", [data] if data.get("kind") == "Node" else [])
+    nodes: Dict[str, NodeState] = {}
+    for item in items:
+        status = item.get("status", {})
+        node = NodeState(item["metadata"]["name"])
+        for address in status.get("addresses", []):
+            if address.get("type") == "InternalIP" and not node.internal_ip:
+                node.internal_ip = address.get("address", "")
+            if address.get("address"):
+                node.addresses.append(address["address"])
+        for condition in status.get("conditions", []):
+            node.conditions[condition["type"]] = condition.get("status", "Unknown")
+            if condition["type"] == "Ready":
+                node.reason = condition.get("reason", "")
+                node.message = condition.get("message", "")
+        nodes[node.name] = node
+    return nodes
+
+
+def get_nodes(
+    ip: str, user: str, password: str, names: Optional[Iterable[str]] = None
+) -> Dict[str, NodeState]:
+    """Return the state of the named nodes, or of all nodes by default.
+
+    Named nodes are fetched individually by the API server, so polling a few
+    pending nodes does not transfer the whole node list.
+    """
+    command = "kubectl get nodes -o json"
+    if names is not None:
+        command = (
+            "kubectl get nodes "
+            + " ".join(shlex.quote(name) for name in sorted(names))
+            + " --ignore-not-found -o json"
+        )
+    try:
+        output = run_remote_capture(ip, user, password, command)
+    except Exception as exc:  # broad but fine for CLI tool
+        raise Phase5Error(f"Failed to retrieve node list from {ip}") from exc
+    # --ignore-not-found prints nothing if none of the nodes exist
+    return _parse_nodes(output) if output else {}
+
+
+def wait_for_dashboard(ip: str, user: str, password: str, timeout: float = 300) -> None:
+    """Wait until the dashboard deployment reports Available."""
+    try:
+        run_remote_capture(
+            ip,
+            user,
+            password,
+            "kubectl -n kubernetes-dashboard wait --for=condition=Available "
+            f"deployment/kubernetes-dashboard --timeout={int(timeout)}s",
+        )
+    except Exception as exc:  # broad but fine for CLI tool
+        raise Phase5Error(f"Dashboard on {ip} not Available after {timeout:.0f}s") from exc
+
+
 def check_node_health(ip: str, user: str, password: str) -> None:
     """Validate that all nodes report Ready status."""
-    output = list_nodes(ip, user, password)
-    unhealthy = []
-    for line in output.splitlines():
-        parts = line.split()
-        if len(parts) < 2:
-            continue
-        name, status = parts[0], parts[1]
-        if status != "Ready":
-            unhealthy.append(f"{name} ({status})")
+    unhealthy = [
+        f"{node.name} ({node.status()})"
+        for node in get_nodes(ip, user, password).values()
+        if not node.ready
+    ]
     if unhealthy:
         raise Phase5Error("Unhealthy nodes detected: " + ", ".join(unhealthy))
 
+
+def wait_for_nodes(
+    ip: str,
+    user: str,
+    password: str,
+    expected_ips: Optional[List[str]] = None,
+    timeout: float = 300,
+    initial_delay: float = 1.0,
+    max_delay: float = 10.0,
+) -> Dict[str, NodeState]:
+    """Wait until the nodes with ``expected_ips`` are registered and Ready.
+
+    An expected host matches a node by any of its addresses (internal,
+    external or hostname) or by its name. Without ``expected_ips`` all
+    registered nodes must become Ready. Condition changes of every node are
+    printed as they are observed. The full node list is only fetched while
+    expected nodes are still unregistered, afterwards only the pending nodes
+    are polled by name. A failed poll, e.g. while the API server restarts,
+    counts as no progress. Raises :class:`Phase5Error` listing the pending
+    nodes once ``timeout`` expires.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = initial_delay
+    seen: Dict[str, NodeState] = {}
+    pending: Optional[List[str]] = None
+    error: Optional[Phase5Error] = None
+    while True:
+        try:
+            nodes = get_nodes(ip, user, password, pending)
+            error = None
+        except Phase5Error as exc:
+            nodes, error = {}, exc
+        for node in nodes.values():
+            previous = seen.get(node.name)
+            changed = [
+                f"{kind}={status}"
+                for kind, status in sorted(node.conditions.items())
+                if previous is None or previous.conditions.get(kind) != status
+            ]
+            if previous is None or changed:
+                label = f"{node.name} ({node.internal_ip})" if node.internal_ip else node.name
+                print(
+                    f"  - {label}: {node.status()} after {time.monotonic() - start:.1f}s"
+                    + (f" [{', '.join(changed)}]" if previous is not None and changed else "")
+                )
+            seen[node.name] = node
+        by_ip = {
+            address: node
+            for node in seen.values()
+            for address in [node.name] + node.addresses
+        }
+        if expected_ips is None:
+            unregistered: List[str] = []
+            waiting = [node for node in seen.values() if not node.ready]
+        else:
+            unregistered = [host for host in expected_ips if host not in by_ip]
+            waiting = [
+                by_ip[host] for host in expected_ips if host in by_ip and not by_ip[host].ready
+            ]
+        if not unregistered and not waiting and seen and error is None:
+            return seen
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if error is not None and not seen:
+                raise error
+            details = [f"{host} (not registered)" for host in unregistered] + [
+                f"{node.name} ({node.status()}{': ' + node.message if node.message else ''})"
+                for node in waiting
+            ]
+            raise Phase5Error(
+                f"Nodes not Ready after {timeout:.0f}s: " + ", ".join(details)
+            )
+        pending = None if unregistered else [node.name for node in waiting]
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
@@ -1,8 +1,9 @@
 """Utilities for Phase 6: finalization and handover."""
 
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 
-from .phase2 import run_remote_capture
+from .engine import DEFAULT_LIMIT
+from .facts import HostFacts, gather_facts
 from .phase5 import list_nodes
 from .phase1 import run_remote
 
@@ -11,26 +12,28 @@ class Phase6Error(Exception):
     """Custom exception for phase 6 failures."""
 
 
-def _service_status(ip: str, user: str, password: str, service: str) -> str:
-    """Return the systemd service status on the remote host."""
-    try:
-        return run_remote_capture(ip, user, password, f"systemctl is-active {service}")
-    except Exception:
-        return "unknown"
-
-
 def gather_cluster_summary(
-    master_ip: str, worker_ips: List[str], user: str, password: str
+    master_ip: str,
+    worker_ips: List[str],
+    user: str,
+    password: str,
+    limit: int = DEFAULT_LIMIT,
+    on_result: Optional[Callable[[HostFacts], None]] = None,
 ) -> Dict[str, Dict[str, str]]:
-    """Return service status summary for all nodes."""
-    summary: Dict[str, Dict[str, str]] = {}
-    all_ips = [master_ip] + worker_ips
-    for ip in all_ips:
-        summary[ip] = {
-            "containerd": _service_status(ip, user, password, "containerd"),
-            "kubelet": _service_status(ip, user, password, "kubelet"),
-        }
-    return summary
+    """Return service status summary for all nodes.
+
+    Both services are queried with one exec per host and hosts are queried
+    concurrently. ``on_result`` receives the facts of each host as they
+    arrive.
+    """
+    services = ["containerd", "kubelet"]
+    facts = gather_facts(
+        [master_ip] + worker_ips, user, password, services, limit, on_result
+    )
+    return {
+        ip: {svc: host.facts.get(svc) or "unknown" for svc in services}
+        for ip, host in facts.items()
+    }
 
 
 def finalize_cluster(
@@ -40,15 +43,26 @@ def finalize_cluster(
     password: str,
     token: str,
     export_file: str | None = None,
+    limit: int = DEFAULT_LIMIT,
 ) -> None:
     """Display final cluster information and optionally write to a file.
 
     After printing the summary, root SSH access on the master node is disabled
     again and the root password is locked to prevent login.
     """
+
+    def _report(host: HostFacts) -> None:
+        states = ", ".join(
+            f"{svc} {host.facts.get(svc) or 'unknown'}" for svc in ("containerd", "kubelet")
+        )
+        print(f"  - {host.host}: {host.error or states}")
+
     try:
         nodes = list_nodes(master_ip, user, password)
-        services = gather_cluster_summary(master_ip, worker_ips, user, password)
+        print("* Checking services")
+        services = gather_cluster_summary(
+            master_ip, worker_ips, user, password, limit, _report
+        )
     except Exception as exc:  # broad but acceptable for CLI
         raise Phase6Error("Failed to gather cluster information") from exc
 
@@ -0,0 +1,203 @@
+"""Fleet-wide limits for shared upstream resources.
+
+Remote work that hits a shared upstream, such as the package mirror during
+``apt-get update`` or the API server during ``kubeadm join``, declares the
+named resources it consumes. Every resource combines a semaphore limiting
+the commands in flight with a token bucket limiting how many start per
+second.
+
+Limits adapt to the upstream: a transient upstream error (see
+:func:`~k8s_simplify.retry.classify`) halves the effective concurrency and
+rate, each success raises them again step by step up to the configured
+limit. The time spent waiting for every resource is reported by
+:func:`limits_summary`.
+"""
+
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List
+
+from .retry import classify
+
+APT_MIRROR = "apt-mirror"
+APISERVER_JOIN = "apiserver-join"
+
+# Error kinds caused by the upstream rather than by the host itself
+UPSTREAM_ERRORS = {"mirror error", "network", "api overload"}
+# Lowest fraction of the configured limits adaptive backoff goes down to
+MIN_SCALE = 1 / 16
+
+
+@dataclass(frozen=True)
+class Limit:
+    # Maximum commands in flight, 0 for no limit
+    concurrency: int = 0
+    # Maximum commands started per second, 0 for no limit
+    rate: float = 0.0
+
+
+LIMITS: Dict[str, Limit] = {
+    APT_MIRROR: Limit(concurrency=32, rate=5.0),
+    APISERVER_JOIN: Limit(concurrency=16, rate=2.0),
+}
+
+
+class RateLimitError(Exception):
+    """Raised for invalid rate limit specifications."""
+
+
+@dataclass
+class ResourceStats:
+    acquired: int = 0
+    wait: float = 0.0
+    max_wait: float = 0.0
+    backoffs: int = 0
+
+
+class Resource:
+    """Semaphore and token bucket of one named resource."""
+
+    def __init__(self, name: str, limit: Limit):
+        self.name = name
+        self.limit = limit
+        self.stats = ResourceStats()
+        self._cond = threading.Condition()
+        self._in_use = 0
+        self._scale = 1.0
+        self._tokens = float(max(1, limit.concurrency))
+        self._refilled = time.monotonic()
+
+    def _concurrency(self) -> int:
+        return max(1, int(self.limit.concurrency * self._scale))
+
+    def _refill(self, now: float) -> None:
+        rate = self.limit.rate * self._scale
+        capacity = max(1, self._concurrency())
+        self._tokens = min(capacity, self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+
+    def acquire(self) -> float:
+        """Wait until the resource may be used and return the time waited."""
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                timeout = None
+                free = not self.limit.concurrency or self._in_use < self._concurrency()
+                if free and self.limit.rate and self._tokens < 1:
+                    timeout = (1 - self._tokens) / (self.limit.rate * self._scale)
+                elif free:
+                    break
+                self._cond.wait(timeout)
+            self._in_use += 1
+            if self.limit.rate:
+                self._tokens -= 1
+            waited = time.monotonic() - start
+            self.stats.acquired += 1
+            self.stats.wait += waited
+            self.stats.max_wait = max(self.stats.max_wait, waited)
+        return waited
+
+    def release(self, upstream_error: bool = False) -> None:
+        """Release the resource, backing off after an upstream error."""
+        with self._cond:
+            self._in_use -= 1
+            if upstream_error:
+                self._scale = max(MIN_SCALE, self._scale / 2)
+                self.stats.backoffs += 1
+            elif self._scale < 1:
+                step = 1 / self.limit.concurrency if self.limit.concurrency else 0.1
+                self._scale = min(1.0, self._scale + step)
+            self._cond.notify_all()
+
+    def scale(self) -> float:
+        with self._cond:
+            return self._scale
+
+
+class Usage:
+    """Handle passed to the block holding resources, see :func:`consume`."""
+
+    def __init__(self) -> None:
+        self.upstream_error = False
+
+    def report(self, returncode: int, output: str) -> None:
+        """Record the result of the command that used the resources."""
+        self.upstream_error = (
+            returncode != 0 and classify(returncode, output) in UPSTREAM_ERRORS
+        )
+
+
+_lock = threading.Lock()
+_resources: Dict[str, Resource] = {}
+
+
+def _resource(name: str) -> Resource:
+    with _lock:
+        if name not in _resources:
+            _resources[name] = Resource(name, LIMITS.get(name, Limit()))
+        return _resources[name]
+
+
+def configure(specs: Iterable[str]) -> None:
+    """Apply limits given as ``NAME=CONCURRENCY[:RATE]``, e.g. ``apt-mirror=20:5``.
+
+    A value of 0 disables that part of the limit.
+    """
+    for spec in specs:
+        name, sep, value = spec.partition("=")
+        concurrency, _, rate = value.partition(":")
+        try:
+            limit = Limit(int(concurrency), float(rate) if rate else 0.0)
+        except ValueError:
+            raise RateLimitError(f"Invalid rate limit: {spec}") from None
+        if not sep or not name or limit.concurrency < 0 or limit.rate < 0:
+            raise RateLimitError(f"Invalid rate limit: {spec}")
+        LIMITS[name] = limit
+    with _lock:
+        _resources.clear()
+
+
+@contextmanager
+def consume(names: Iterable[str]) -> Iterator[Usage]:
+    """Hold the named resources for the duration of the block.
+
+    Resources are acquired in name order so concurrent holders of several
+    resources cannot deadlock. Call :meth:`Usage.report` with the result of
+    the command so upstream errors slow down the following users.
+    """
+    resources = [_resource(name) for name in sorted(set(names))]
+    held: List[Resource] = []
+    usage = Usage()
+    try:
+        for resource in resources:
+            resource.acquire()
+            held.append(resource)
+        yield usage
+    finally:
+        for resource in held:
+            resource.release(usage.upstream_error)
+
+
+def limits_summary() -> str:
+    """Return a table of uses, queueing time and backoffs per resource."""
+    with _lock:
+        resources = sorted(_resources.values(), key=lambda r: r.name)
+    if not resources:
+        return "No rate-limited resources used"
+    width = max(len("RESOURCE"), *(len(r.name) for r in resources))
+    lines = [
+        f"{'RESOURCE':<{width}}  LIMIT        USES  WAIT(s)  AVG(s)  MAX(s)  BACKOFFS  SCALE"
+    ]
+    for r in resources:
+        s = replace(r.stats)
+        limit = f"{r.limit.concurrency or '-'}/{r.limit.rate or '-'}/s"
+        avg = s.wait / s.acquired if s.acquired else 0.0
+        lines.append(
+            f"{r.name:<{width}}  {limit:<11}  {s.acquired:4d}  {s.wait:7.1f}  {avg:6.2f}"
+            f"  {s.max_wait:6.1f}  {s.backoffs:8d}  {r.scale():5.2f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,122 @@
+"""Helper process run on remote hosts by the agent transport.
+
+The agent reads requests from stdin and writes replies to stdout, each frame
+being a 4 byte big-endian length followed by a JSON object. Requests carry an
+``id`` echoed in the reply and are served concurrently, so replies may arrive
+out of order. Supported operations:
+
+``ping``
+    Check the agent is alive.
+``exec``
+    Run ``command`` with bash, optionally feeding ``input`` and enforcing
+    ``timeout``. Returns ``rc``, ``stdout`` and ``stderr``.
+``service``
+    Return the ``systemctl is-active`` ``status`` of service ``name``.
+``read``
+    Return the base64 encoded ``data`` of the file at ``path``.
+``facts``
+    Run the ``commands`` mapping concurrently and return ``facts`` mapping
+    every name to its exit code and first output line.
+
+This file only uses the standard library and is executed by ``python3`` on
+the host, it is not imported by the control machine.
+"""
+
+import base64
+import json
+import struct
+import subprocess
+import sys
+import threading
+
+_write_lock = threading.Lock()
+
+
+def _send(message):
+    data = json.dumps(message).encode()
+    with _write_lock:
+        sys.stdout.buffer.write(struct.pack(">I", len(data)) + data)
+        sys.stdout.buffer.flush()
+
+
+def _run(command, input=None, timeout=None):
+    try:
+        proc = subprocess.run(
+            ["bash", "-c", command],
+            input=None if input is None else input.encode(),
+            stdin=subprocess.DEVNULL if input is None else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return 124, "", "timed out after {}s".format(timeout)
+    return (
+        proc.returncode,
+        proc.stdout.decode("utf-8", "replace"),
+        proc.stderr.decode("utf-8", "replace"),
+    )
+
+
+def _facts(commands):
+    facts = {}
+
+    def _one(name, command):
+        rc, stdout, _ = _run(command)
+        lines = stdout.splitlines()
+        facts[name] = [rc, lines[0].strip() if lines else ""]
+
+    threads = [
+        threading.Thread(target=_one, args=item) for item in commands.items()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {"rc": 0, "facts": facts}
+
+
+def _handle(request):
+    op = request["op"]
+    if op == "ping":
+        return {"rc": 0}
+    if op == "exec":
+        rc, stdout, stderr = _run(
+            request["command"], request.get("input"), request.get("timeout")
+        )
+        return {"rc": rc, "stdout": stdout, "stderr": stderr}
+    if op == "service":
+        rc, stdout, _ = _run("systemctl is-active -- '{}'".format(request["name"]))
+        return {"rc": rc, "status": stdout.strip()}
+    if op == "read":
+        try:
+            with open(request["path"], "rb") as f:
+                return {"rc": 0, "data": base64.b64encode(f.read()).decode()}
+        except OSError as exc:
+            return {"rc": 1, "error": str(exc)}
+    if op == "facts":
+        return _facts(request["commands"])
+    return {"rc": 1, "error": "unknown operation: {}".format(op)}
+
+
+def _serve(request):
+    try:
+        reply = _handle(request)
+    except Exception as exc:  # reported to the caller
+        reply = {"rc": 1, "error": repr(exc)}
+    reply["id"] = request.get("id")
+    _send(reply)
+
+
+def main():
+    stdin = sys.stdin.buffer
+    while True:
+        head = stdin.read(4)
+        if len(head) < 4:
+            return
+        request = json.loads(stdin.read(struct.unpack(">I", head)[0]).decode())
+        threading.Thread(target=_serve, args=(request,), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
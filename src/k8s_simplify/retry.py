@@ -0,0 +1,134 @@
+"""Retry policies with transient-error classification.
+
+A failed remote command is only retried when its exit code or output matches
+a known transient failure, such as an SSH connection error, a held dpkg lock
+or a server error of a package mirror. Retries wait with jittered exponential
+backoff. Deterministic failures, for example a misspelled package name, fail
+immediately instead of being repeated.
+"""
+
+from dataclasses import dataclass, replace
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+# ssh reports connection and authentication errors with exit code 255
+SSH_ERROR = 255
+
+TRANSIENT_ERRORS = {
+    "dpkg lock": re.compile(
+        r"Could not get lock|Unable to acquire the dpkg frontend lock"
+    ),
+    "mirror error": re.compile(
+        r"\b5\d\d\s+(Internal Server Error|Bad Gateway|Service Unavailable|Gateway Time-?out)"
+        r"|returned error: 5\d\d|Hash Sum mismatch"
+    ),
+    "network": re.compile(
+        r"Temporary failure resolving|Could not resolve host|"
+        r"Connection (reset by peer|timed out|refused)|Network is unreachable"
+    ),
+    "api overload": re.compile(
+        r"429 Too Many Requests|etcdserver: too many requests|"
+        r"the server is currently unable to handle the request"
+    ),
+}
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    retries: int = 2
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+
+    def delay(self, attempt: int) -> float:
+        """Return the backoff after failed ``attempt`` (full jitter)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+# Named policies steps can refer to; "apt" tolerates long lock contention,
+# e.g. by unattended-upgrades right after a host boots
+POLICIES: Dict[str, RetryPolicy] = {
+    "default": RetryPolicy(),
+    "apt": RetryPolicy(retries=5, base_delay=2.0, max_delay=60.0),
+}
+
+
+def get_policy(name: str = "default") -> RetryPolicy:
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError(f"Unknown retry policy: {name}") from None
+
+
+def classify(returncode: int, output: str) -> Optional[str]:
+    """Return the kind of transient failure, or None if it is permanent."""
+    if returncode == SSH_ERROR:
+        return "ssh connection"
+    for kind, pattern in TRANSIENT_ERRORS.items():
+        if pattern.search(output):
+            return kind
+    return None
+
+
+@dataclass
+class RetryStats:
+    retries: int = 0
+    backoff: float = 0.0
+    exhausted: int = 0
+
+
+_lock = threading.Lock()
+_stats: Dict[str, RetryStats] = {}
+
+
+def _stat(kind: str) -> RetryStats:
+    return _stats.setdefault(kind, RetryStats())
+
+
+def should_retry(
+    attempt: int,
+    returncode: int,
+    output: str,
+    policy: str = "default",
+    retries: Optional[int] = None,
+) -> bool:
+    """Decide whether failed ``attempt`` is retried and back off if so.
+
+    ``retries`` overrides the number of retries of the named policy.
+    """
+    settings = get_policy(policy)
+    if retries is not None:
+        settings = replace(settings, retries=retries)
+    kind = classify(returncode, output) or "permanent"
+    if kind == "permanent" or attempt > settings.retries:
+        with _lock:
+            _stat(kind).exhausted += 1
+        return False
+    delay = settings.delay(attempt)
+    with _lock:
+        stat = _stat(kind)
+        stat.retries += 1
+        stat.backoff += delay
+    time.sleep(delay)
+    return True
+
+
+def stats() -> Dict[str, RetryStats]:
+    with _lock:
+        return {kind: replace(stat) for kind, stat in _stats.items()}
+
+
+def retry_summary() -> str:
+    """Return a table of retries and failures per error kind."""
+    items = stats()
+    if not items:
+        return "No failed remote commands"
+    width = max(len("ERROR"), *(len(kind) for kind in items))
+    lines: List[str] = [f"{'ERROR':<{width}}  RETRIES  BACKOFF(s)  FAILED"]
+    for kind, stat in sorted(items.items()):
+        lines.append(
+            f"{kind:<{width}}  {stat.retries:7d}  {stat.backoff:10.1f}  {stat.exhausted:6d}"
+        )
+    return "\n".join(lines)
@@ -1,24 +1,73 @@
 """Utilities for rolling back a Kubernetes cluster."""
 
-from typing import List
+import threading
+from typing import Collection, Dict, List, Optional, Set
 
-from .phase1 import run_remote
+from .engine import DEFAULT_LIMIT
+from .parallel import format_results, run_per_host
+from .phase1 import NODE_PREPARED_CHECK
+from .phase2 import run_remote_capture
 from .phase3 import verify_master_node
-from .phase4 import get_join_command, join_worker, prepare_worker
-from .phase5 import check_node_health
+from .phase4 import TOKEN_TTL, JoinTokenBroker, Phase4Error, join_worker, prepare_worker
+from .phase5 import wait_for_nodes
+
+_PREPARED_MARKER = "@@K8S_PREPARED"
 
 
 class RollbackError(Exception):
     """Custom exception for rollback failures."""
 
 
-def reset_node(ip: str, user: str, password: str) -> None:
-    """Reset Kubernetes state on a node."""
+def reset_node(ip: str, user: str, password: str) -> bool:
+    """Reset Kubernetes state on a node.
+
+    Returns True if the packages and configuration installed by the
+    preparation steps survived the reset, checked in the same exec, so the
+    node can rejoin without being prepared again.
+    """
+    command = (
+        "sudo kubeadm reset -f && sudo systemctl restart containerd && "
+        f"{{ if ( {NODE_PREPARED_CHECK} ) </dev/null >/dev/null 2>&1; "
+        f"then echo {_PREPARED_MARKER}; fi; }}"
+    )
     try:
-        run_remote(ip, user, password, "sudo kubeadm reset -f")
-        run_remote(ip, user, password, "sudo systemctl restart containerd")
+        output = run_remote_capture(ip, user, password, command, stream=True)
     except Exception as exc:
         raise RollbackError(f"Failed to reset node {ip}") from exc
+    return output.endswith(_PREPARED_MARKER)
+
+
+def reset_nodes(
+    hosts: List[str],
+    user: str,
+    password: str,
+    limit: int = DEFAULT_LIMIT,
+    groups: Optional[Dict[str, str]] = None,
+    group_limits: Optional[Dict[str, int]] = None,
+) -> Set[str]:
+    """Reset all hosts concurrently and return those still prepared."""
+    prepared: Set[str] = set()
+    lock = threading.Lock()
+
+    def _reset(ip: str, log) -> None:
+        log(f" - Resetting {ip}")
+        if reset_node(ip, user, password):
+            with lock:
+                prepared.add(ip)
+
+    results = run_per_host(
+        hosts,
+        _reset,
+        limit,
+        errors=(RollbackError,),
+        groups=groups,
+        group_limits=group_limits,
+    )
+    failed = [r.host for r in results if not r.ok]
+    if failed:
+        print(format_results(results))
+        raise RollbackError("Failed to reset nodes: " + ", ".join(failed))
+    return prepared
 
 
 def rollback_master(ip: str, user: str, password: str) -> None:
@@ -26,21 +75,65 @@ def rollback_master(ip: str, user: str, password: str) -> None:
     reset_node(ip, user, password)
 
 
-def rollback_workers(worker_ips: List[str], user: str, password: str) -> None:
-    """Rollback worker nodes."""
-    for ip in worker_ips:
-        reset_node(ip, user, password)
+def rollback_workers(
+    worker_ips: List[str], user: str, password: str, limit: int = DEFAULT_LIMIT
+) -> Set[str]:
+    """Rollback worker nodes concurrently, returning those still prepared."""
+    return reset_nodes(worker_ips, user, password, limit)
+
+
+def rejoin_workers(
+    master_ip: str,
+    worker_ips: List[str],
+    user: str,
+    password: str,
+    prepared: Collection[str] = (),
+    limit: int = DEFAULT_LIMIT,
+    groups: Optional[Dict[str, str]] = None,
+    group_limits: Optional[Dict[str, int]] = None,
+    token_ttl: int = TOKEN_TTL,
+) -> None:
+    """Rejoin workers to the cluster concurrently.
+
+    Workers in ``prepared`` skip the preparation steps entirely. All joins
+    share the join tokens of one broker, which are deleted afterwards.
+    """
+    if not worker_ips:
+        return
+    try:
+        broker = JoinTokenBroker(master_ip, user, password, token_ttl)
+    except Phase4Error as exc:
+        raise RollbackError(str(exc)) from exc
 
+    def _rejoin(ip: str, log) -> None:
+        if ip in prepared:
+            log(f" - Worker {ip} still prepared, skipping preparation")
+        else:
+            log(f" - Preparing worker {ip}")
+            prepare_worker(ip, user, password)
+        log(f" - Joining worker {ip}")
+        join_worker(ip, user, password, broker.join_command())
 
-def rejoin_workers(master_ip: str, worker_ips: List[str], user: str, password: str) -> None:
-    """Rejoin workers to the cluster."""
-    join_cmd = get_join_command(master_ip, user, password)
-    for ip in worker_ips:
-        prepare_worker(ip, user, password)
-        join_worker(ip, user, password, join_cmd)
+    with broker:
+        try:
+            broker.join_command()
+        except Phase4Error as exc:
+            raise RollbackError(str(exc)) from exc
+        results = run_per_host(
+            worker_ips,
+            _rejoin,
+            limit,
+            errors=(Phase4Error,),
+            groups=groups,
+            group_limits=group_limits,
+        )
+    failed = [r.host for r in results if not r.ok]
+    if failed:
+        print(format_results(results))
+        raise RollbackError("Failed to rejoin workers: " + ", ".join(failed))
 
 
 def post_rollback_validation(master_ip: str, user: str, password: str) -> None:
-    """Validate cluster health after rollback."""
+    """Validate cluster health after rollback, waiting for rejoined nodes."""
     verify_master_node(master_ip, user, password)
-    check_node_health(master_ip, user, password)
+    wait_for_nodes(master_ip, user, password)
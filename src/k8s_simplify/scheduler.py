@@ -0,0 +1,209 @@
+"""Dependency-graph scheduling of the steps of a run.
+
+The work of ``install``, ``update`` and ``rollback`` is declared as
+:class:`Task` nodes with explicit dependencies and the hosts they work on.
+:func:`run_tasks` starts every task as soon as its dependencies have
+finished, under a global limit of concurrently running tasks and a limit of
+tasks per host. Among ready tasks, those on the critical path start first.
+:func:`make_plan` computes the expected schedule from rough duration
+estimates without running anything.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextvars
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .tracing import in_phase
+
+DEFAULT_TASKS = 4
+
+
+class SchedulerError(Exception):
+    """Custom exception for invalid task graphs."""
+
+
+@dataclass
+class Task:
+    name: str
+    func: Callable[[], None]
+    deps: List[str] = field(default_factory=list)
+    # Hosts the task works on, at most ``host_limit`` tasks run per host
+    hosts: List[str] = field(default_factory=list)
+    # Rough expected duration in seconds, only used for the plan
+    estimate: float = 0.0
+
+
+@dataclass
+class Plan:
+    tasks: List[Task]
+    # Expected start and end of every task, in seconds from the beginning
+    schedule: Dict[str, Tuple[float, float]]
+    critical_path: List[str]
+    peak: int
+
+    @property
+    def duration(self) -> float:
+        return max((end for _, end in self.schedule.values()), default=0.0)
+
+    @property
+    def parallelism(self) -> float:
+        work = sum(task.estimate for task in self.tasks)
+        return work / self.duration if self.duration else 1.0
+
+    def format(self) -> str:
+        """Return the expected schedule, critical path and parallelism."""
+        width = max([len("TASK")] + [len(task.name) for task in self.tasks])
+        deps_width = max(
+            [len("DEPENDS ON")] + [len(", ".join(task.deps)) for task in self.tasks]
+        )
+        lines = [
+            f"  {'TASK':<{width}}  {'DEPENDS ON':<{deps_width}}  HOSTS  START(s)  END(s)"
+        ]
+        for task in sorted(self.tasks, key=lambda t: self.schedule[t.name]):
+            start, end = self.schedule[task.name]
+            mark = "*" if task.name in self.critical_path else " "
+            lines.append(
+                f"{mark} {task.name:<{width}}  {', '.join(task.deps) or '-':<{deps_width}}"
+                f"  {len(task.hosts):5d}  {start:8.0f}  {end:6.0f}"
+            )
+        lines.append(
+            "Critical path (*): "
+            + " -> ".join(self.critical_path)
+            + f" ({sum(self._estimate(name) for name in self.critical_path):.0f}s)"
+        )
+        lines.append(
+            f"Expected duration {self.duration:.0f}s, parallelism "
+            f"{self.parallelism:.1f} on average, {self.peak} tasks at peak"
+        )
+        return "\n".join(lines)
+
+    def _estimate(self, name: str) -> float:
+        return next(task.estimate for task in self.tasks if task.name == name)
+
+
+def _check_graph(tasks: List[Task]) -> List[str]:
+    """Validate the graph and return the task names in dependency order."""
+    names = [task.name for task in tasks]
+    if len(set(names)) != len(names):
+        raise SchedulerError("Duplicate task names: " + ", ".join(names))
+    for task in tasks:
+        unknown = [dep for dep in task.deps if dep not in names]
+        if unknown:
+            raise SchedulerError(f"Task {task.name} depends on unknown {', '.join(unknown)}")
+    order: List[str] = []
+    remaining = {task.name: set(task.deps) for task in tasks}
+    while remaining:
+        ready = [name for name in names if remaining.get(name) == set()]
+        if not ready:
+            raise SchedulerError("Dependency cycle between " + ", ".join(remaining))
+        for name in ready:
+            del remaining[name]
+            for deps in remaining.values():
+                deps.discard(name)
+        order += ready
+    return order
+
+
+def _tails(tasks: List[Task], order: List[str]) -> Dict[str, float]:
+    """Return the longest estimated path from each task to the end of the run."""
+    by_name = {task.name: task for task in tasks}
+    tails: Dict[str, float] = {}
+    for name in reversed(order):
+        dependents = [t.name for t in tasks if name in t.deps]
+        tails[name] = by_name[name].estimate + max(
+            (tails[d] for d in dependents), default=0.0
+        )
+    return tails
+
+
+def _startable(
+    task: Task, running: List[Task], limit: int, host_limit: int
+) -> bool:
+    if len(running) >= limit:
+        return False
+    busy: Dict[str, int] = {}
+    for other in running:
+        for host in other.hosts:
+            busy[host] = busy.get(host, 0) + 1
+    return all(busy.get(host, 0) < host_limit for host in task.hosts)
+
+
+def make_plan(
+    tasks: Iterable[Task], limit: int = DEFAULT_TASKS, host_limit: int = 1
+) -> Plan:
+    """Simulate :func:`run_tasks` with the task estimates."""
+    tasks = list(tasks)
+    order = _check_graph(tasks)
+    tails = _tails(tasks, order)
+    pending = sorted(tasks, key=lambda t: -tails[t.name])
+    running: List[Task] = []
+    schedule: Dict[str, Tuple[float, float]] = {}
+    now, peak = 0.0, 0
+    while pending or running:
+        for task in list(pending):
+            deps_done = all(
+                dep in schedule and schedule[dep][1] <= now for dep in task.deps
+            )
+            if deps_done and _startable(task, running, max(1, limit), host_limit):
+                pending.remove(task)
+                running.append(task)
+                schedule[task.name] = (now, now + task.estimate)
+        peak = max(peak, len(running))
+        now = min(schedule[task.name][1] for task in running)
+        running = [task for task in running if schedule[task.name][1] > now]
+    # Follow the dependencies with the longest tail from the first task
+    path: List[str] = []
+    candidates = [task for task in tasks if not task.deps]
+    while candidates:
+        task = max(candidates, key=lambda t: tails[t.name])
+        path.append(task.name)
+        candidates = [t for t in tasks if task.name in t.deps]
+    return Plan(tasks, schedule, path, peak)
+
+
+def run_tasks(
+    tasks: Iterable[Task], limit: int = DEFAULT_TASKS, host_limit: int = 1
+) -> None:
+    """Run all tasks, each as soon as its dependencies have finished.
+
+    Every task runs in a copy of the caller's context inside a tracing phase
+    named after the task. Once a task fails no further tasks are started;
+    after the running ones have finished the first failure is re-raised,
+    including ``SystemExit``.
+    """
+    tasks = list(tasks)
+    order = _check_graph(tasks)
+    tails = _tails(tasks, order)
+    pending = sorted(tasks, key=lambda t: -tails[t.name])
+    limit = max(1, limit)
+
+    def _run(task: Task) -> None:
+        with in_phase(task.name):
+            task.func()
+
+    done: List[str] = []
+    running: Dict = {}
+    failure: Optional[BaseException] = None
+    with ThreadPoolExecutor(max_workers=limit) as pool:
+        while pending or running:
+            if failure is None:
+                for task in list(pending):
+                    if all(dep in done for dep in task.deps) and _startable(
+                        task, list(running.values()), limit, host_limit
+                    ):
+                        pending.remove(task)
+                        future = pool.submit(contextvars.copy_context().run, _run, task)
+                        running[future] = task
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    done.append(task.name)
+                elif failure is None:
+                    failure = error
+    if failure is not None:
+        raise failure
@@ -0,0 +1,163 @@
+"""Per-command timing spans and trace export.
+
+Every remote command executed by the engine is recorded as a span with its
+host, phase, command, attempt number, exit code, wall time and queue time.
+Queue time covers waiting for a concurrency slot and for the SSH session to
+be established before the command starts. Spans can be exported in Chrome
+trace-event format (viewable in ``chrome://tracing`` or Perfetto). Join
+credentials are redacted from recorded commands and trace files are only
+readable by their owner.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+current_phase: ContextVar[str] = ContextVar("current_phase", default="")
+# Monotonic time at which the current unit of work was queued
+queued_since: ContextVar[Optional[float]] = ContextVar("queued_since", default=None)
+
+_lock = threading.Lock()
+_spans: List["Span"] = []
+_origin = time.monotonic()
+# Bootstrap tokens ("abcdef.0123456789abcdef") and secret join arguments
+_SECRETS = re.compile(
+    r"\b[a-z0-9]{6}\.[a-z0-9]{16}\b"
+    r"|(?<=--discovery-token-ca-cert-hash )\S+"
+    r"|(?<=--certificate-key )\S+"
+)
+
+
+def redact(command: str) -> str:
+    """Return ``command`` with join tokens and certificate keys masked."""
+    return _SECRETS.sub("<redacted>", command)
+
+
+@dataclass
+class Span:
+    host: str
+    phase: str
+    command: str
+    attempt: int
+    returncode: int
+    start: float
+    duration: float
+    queue: float
+
+
+@contextmanager
+def in_phase(name: str) -> Iterator[None]:
+    """Attribute all commands run inside the block to phase ``name``."""
+    token = current_phase.set(name)
+    try:
+        yield
+    finally:
+        current_phase.reset(token)
+
+
+def record(
+    host: str,
+    command: str,
+    attempt: int,
+    returncode: int,
+    start: float,
+    duration: float,
+    queue: float,
+) -> None:
+    """Record a finished command, ``start`` is a ``time.monotonic`` value."""
+    span = Span(
+        host,
+        current_phase.get(),
+        redact(command),
+        attempt,
+        returncode,
+        start,
+        duration,
+        queue,
+    )
+    with _lock:
+        _spans.append(span)
+
+
+def spans() -> List[Span]:
+    with _lock:
+        return list(_spans)
+
+
+def write_chrome_trace(path: str) -> None:
+    """Write all spans to ``path`` in Chrome trace-event JSON format."""
+    tids: Dict[str, int] = {}
+    events = []
+    for span in spans():
+        if span.host not in tids:
+            tids[span.host] = len(tids) + 1
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tids[span.host],
+                    "args": {"name": span.host},
+                }
+            )
+        events.append(
+            {
+                "name": span.command[:80],
+                "cat": span.phase or "none",
+                "ph": "X",
+                "pid": 1,
+                "tid": tids[span.host],
+                "ts": round((span.start - _origin) * 1e6),
+                "dur": round(span.duration * 1e6),
+                "args": {
+                    "host": span.host,
+                    "phase": span.phase,
+                    "command": span.command,
+                    "attempt": span.attempt,
+                    "exit_code": span.returncode,
+                    "queue_ms": round(span.queue * 1000, 3),
+                },
+            }
+        )
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # An existing file keeps its mode on open
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _table(title: str, groups: Dict[str, List[Span]]) -> List[str]:
+    width = max([len(title)] + [len(k) for k in groups])
+    lines = [f"{title:<{width}}  CALLS   WALL(s)    MAX(s)  QUEUE(s)"]
+    for key, items in groups.items():
+        wall = sum(s.duration for s in items)
+        lines.append(
+            f"{key:<{width}}  {len(items):5d}  {wall:8.1f}  "
+            f"{max(s.duration for s in items):8.1f}  {sum(s.queue for s in items):8.1f}"
+        )
+    return lines
+
+
+def summary(max_hosts: int = 10) -> str:
+    """Return per-phase and per-host latency tables.
+
+    Only the ``max_hosts`` hosts with the highest total wall time are listed.
+    """
+    by_phase: Dict[str, List[Span]] = {}
+    by_host: Dict[str, List[Span]] = {}
+    for span in spans():
+        by_phase.setdefault(span.phase or "-", []).append(span)
+        by_host.setdefault(span.host, []).append(span)
+    if not by_phase:
+        return "No remote commands recorded"
+    slowest = sorted(
+        by_host.items(), key=lambda item: sum(s.duration for s in item[1]), reverse=True
+    )[:max_hosts]
+    lines = _table("PHASE", by_phase) + [""] + _table("HOST", dict(slowest))
+    return "\n".join(lines)
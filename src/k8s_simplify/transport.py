@@ -0,0 +1,406 @@
+"""Pluggable transports executing commands on remote hosts.
+
+``SubprocessTransport`` runs the OpenSSH client (optionally through
+``sshpass``) over multiplexed sessions. ``ParamikoTransport`` keeps one
+authenticated connection per host inside the process and runs every command
+on its own channel of that connection, avoiding a fork and exec per command.
+``AgentTransport`` sends commands to a persistent helper process on each host
+over one long-lived SSH channel and also answers cheap RPCs (service states,
+facts, file contents) through :meth:`Transport.call`.
+
+When a line callback is passed to :meth:`Transport.run` the output is
+streamed line by line and only a bounded tail of each stream is returned.
+Large inputs can be passed as :class:`LocalFile` and are then streamed from
+disk in chunks instead of being held in memory.
+"""
+
+import asyncio
+from asyncio.subprocess import DEVNULL, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import os
+import select
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+from .agent import AgentError, AgentSession, start_session
+from .connection import close_sessions, host_settings, ssh_command, ssh_env
+from .output import LineCallback, LineSplitter, Tail
+
+try:
+    import paramiko
+except ImportError:  # optional dependency
+    paramiko = None
+
+_CHUNK = 1 << 20
+
+
+@dataclass(frozen=True)
+class LocalFile:
+    """Command input read from a local file in chunks."""
+
+    path: str
+
+
+Input = Union[str, bytes, LocalFile]
+
+
+def _chunks(input: Input) -> Iterator[bytes]:
+    """Yield the input as bytes, text is UTF-8 encoded."""
+    if isinstance(input, LocalFile):
+        with open(input.path, "rb") as f:
+            yield from iter(lambda: f.read(_CHUNK), b"")
+    else:
+        yield input.encode() if isinstance(input, str) else input
+
+
+@dataclass
+class CommandResult:
+    host: str
+    command: str
+    returncode: int
+    stdout: str
+    stderr: str
+    duration: float
+    # Time spent before the command started, e.g. opening the SSH session
+    queue: float = 0.0
+
+
+class _Collector:
+    """Collect one output stream, in full or as the tail of streamed lines."""
+
+    def __init__(self, on_line: Optional[LineCallback], stderr: bool):
+        self._data = bytearray()
+        self._tail = Tail()
+        self._splitter = None
+        if on_line is not None:
+
+            def _line(line: str) -> None:
+                self._tail.append(line)
+                on_line(line, stderr)
+
+            self._splitter = LineSplitter(_line)
+
+    def feed(self, data: bytes) -> None:
+        if self._splitter is None:
+            self._data += data
+        else:
+            self._splitter.feed(data)
+
+    def text(self) -> str:
+        if self._splitter is None:
+            return self._data.decode("utf-8", "replace")
+        self._splitter.flush()
+        return self._tail.text()
+
+
+class Transport:
+    """Interface for running commands on remote hosts."""
+
+    async def run(
+        self,
+        ip: str,
+        user: str,
+        password: str,
+        command: str,
+        input: Optional[Input],
+        timeout: Optional[float],
+        on_line: Optional[LineCallback] = None,
+    ) -> CommandResult:
+        """Run ``command`` and return its result.
+
+        A command exceeding ``timeout`` seconds is reported with exit code 124.
+        If ``on_line`` is given it receives every output line as it arrives
+        and the result only holds the last lines of stdout and stderr.
+        """
+        raise NotImplementedError
+
+    async def call(
+        self, ip: str, user: str, password: str, op: str, args: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """Run remote operation ``op`` and return its reply.
+
+        Returns None if the transport does not support operations on the
+        host, callers then fall back to running a command.
+        """
+        return None
+
+    def close(self) -> None:
+        """Release all connections held by the transport."""
+
+
+class SubprocessTransport(Transport):
+    """Run commands with the local ``ssh`` client over shared sessions."""
+
+    async def run(self, ip, user, password, command, input, timeout, on_line=None):
+        start = time.monotonic()
+        try:
+            argv = await asyncio.to_thread(ssh_command, ip, user, password, command)
+        except RuntimeError as exc:
+            # sshpass missing for a password from the inventory
+            return CommandResult(ip, command, 127, "", str(exc), 0.0, time.monotonic() - start)
+        queue = time.monotonic() - start
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=PIPE if input is not None else DEVNULL,
+                stdout=PIPE,
+                stderr=PIPE,
+                env=ssh_env(password),
+            )
+        except OSError as exc:
+            return CommandResult(ip, command, 127, "", str(exc), 0.0, queue)
+        stdout, stderr = _Collector(on_line, False), _Collector(on_line, True)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    _write(proc.stdin, input),
+                    _read(proc.stdout, stdout),
+                    _read(proc.stderr, stderr),
+                    proc.wait(),
+                ),
+                timeout,
+            )
+        except asyncio.CancelledError:
+            # The caller gave up, e.g. on the per-host timeout of gather_hosts
+            proc.kill()
+            raise
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return CommandResult(
+                ip,
+                command,
+                124,
+                stdout.text(),
+                f"timed out after {timeout}s",
+                time.monotonic() - start - queue,
+                queue,
+            )
+        return CommandResult(
+            ip,
+            command,
+            proc.returncode,
+            stdout.text(),
+            stderr.text(),
+            time.monotonic() - start - queue,
+            queue,
+        )
+
+    def close(self) -> None:
+        close_sessions()
+
+
+async def _write(writer: Optional[asyncio.StreamWriter], input: Optional[Input]) -> None:
+    if writer is None:
+        return
+    try:
+        for chunk in _chunks(input):
+            writer.write(chunk)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # the command exited without reading all of its input
+    writer.close()
+
+
+async def _read(reader: asyncio.StreamReader, collector: _Collector) -> None:
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        collector.feed(chunk)
+
+
+class ParamikoTransport(Transport):
+    """Run commands as channels of one in-process SSH connection per host.
+
+    Host keys are accepted automatically, matching the
+    ``StrictHostKeyChecking=no`` option of the subprocess transport.
+    """
+
+    def __init__(self, max_workers: int = 128, connect_timeout: float = 30):
+        if paramiko is None:
+            raise RuntimeError("paramiko is required for the paramiko transport")
+        self._connect_timeout = connect_timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._host_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._clients: Dict[Tuple[str, str], "paramiko.SSHClient"] = {}
+
+    def _client(self, ip: str, user: str, password: str) -> "paramiko.SSHClient":
+        key = (ip, user)
+        with self._lock:
+            host_lock = self._host_locks.setdefault(key, threading.Lock())
+        with host_lock:
+            client = self._clients.get(key)
+            if client is not None and client.get_transport().is_active():
+                return client
+            settings = host_settings(ip)
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(
+                ip,
+                port=settings.port or 22,
+                username=user,
+                password=password or None,
+                key_filename=os.path.expanduser(settings.key_file) or None,
+                timeout=self._connect_timeout,
+            )
+            client.get_transport().set_keepalive(30)
+            self._clients[key] = client
+            return client
+
+    def _run_sync(
+        self, ip, user, password, command, input, timeout, on_line
+    ) -> CommandResult:
+        start = time.monotonic()
+        try:
+            channel = self._client(ip, user, password).get_transport().open_session()
+        except (OSError, paramiko.SSHException) as exc:
+            # Same exit code the ssh client uses for connection errors
+            return CommandResult(ip, command, 255, "", str(exc), 0.0, time.monotonic() - start)
+        queue = time.monotonic() - start
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stdout, stderr = _Collector(on_line, False), _Collector(on_line, True)
+        with channel:
+            channel.exec_command(command)
+            if input is not None:
+                for chunk in _chunks(input):
+                    channel.sendall(chunk)
+            channel.shutdown_write()
+            while True:
+                if deadline is not None and time.monotonic() > deadline:
+                    return CommandResult(
+                        ip,
+                        command,
+                        124,
+                        stdout.text(),
+                        f"timed out after {timeout}s",
+                        time.monotonic() - start - queue,
+                        queue,
+                    )
+                select.select([channel], [], [], 0.1)
+                while channel.recv_ready():
+                    stdout.feed(channel.recv(65536))
+                while channel.recv_stderr_ready():
+                    stderr.feed(channel.recv_stderr(65536))
+                if (
+                    channel.exit_status_ready()
+                    and not channel.recv_ready()
+                    and not channel.recv_stderr_ready()
+                ):
+                    break
+            returncode = channel.recv_exit_status()
+        return CommandResult(
+            ip,
+            command,
+            returncode,
+            stdout.text(),
+            stderr.text(),
+            time.monotonic() - start - queue,
+            queue,
+        )
+
+    async def run(self, ip, user, password, command, input, timeout, on_line=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._pool,
+            self._run_sync,
+            ip,
+            user,
+            password,
+            command,
+            input,
+            timeout,
+            on_line,
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+
+class AgentTransport(SubprocessTransport):
+    """Run commands through a persistent agent on every host.
+
+    Streamed commands, binary input and hosts unable to run the agent use
+    the OpenSSH subprocess transport instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._host_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._sessions: Dict[Tuple[str, str], Optional[AgentSession]] = {}
+
+    def _session(self, ip: str, user: str, password: str) -> Optional[AgentSession]:
+        key = (ip, user)
+        with self._lock:
+            host_lock = self._host_locks.setdefault(key, threading.Lock())
+        with host_lock:
+            if key in self._sessions:
+                session = self._sessions[key]
+                if session is None or session.alive:
+                    return session
+            session = self._sessions[key] = start_session(ip, user, password)
+            return session
+
+    async def _request(
+        self, ip: str, user: str, password: str, request: Dict[str, Any]
+    ) -> Tuple[Optional[Dict[str, Any]], float]:
+        """Return the agent's reply (None without agent) and the queue time.
+
+        Raises :class:`AgentError` if the connection to the agent is lost.
+        """
+        start = time.monotonic()
+        session = await asyncio.to_thread(self._session, ip, user, password)
+        queue = time.monotonic() - start
+        if session is None:
+            return None, queue
+        return await asyncio.wrap_future(session.submit(request)), queue
+
+    async def run(self, ip, user, password, command, input, timeout, on_line=None):
+        if on_line is not None or not isinstance(input, (str, type(None))):
+            return await super().run(ip, user, password, command, input, timeout, on_line)
+        start = time.monotonic()
+        request = {"op": "exec", "command": command, "input": input, "timeout": timeout}
+        try:
+            reply, queue = await self._request(ip, user, password, request)
+        except AgentError as exc:
+            # Same exit code the ssh client uses for connection errors
+            return CommandResult(ip, command, 255, "", str(exc), 0.0, time.monotonic() - start)
+        if reply is None:
+            return await super().run(ip, user, password, command, input, timeout)
+        return CommandResult(
+            ip,
+            command,
+            reply["rc"],
+            reply.get("stdout", ""),
+            reply.get("stderr", reply.get("error", "")),
+            time.monotonic() - start - queue,
+            queue,
+        )
+
+    async def call(self, ip, user, password, op, args):
+        try:
+            reply, _ = await self._request(ip, user, password, {**args, "op": op})
+        except AgentError:
+            return None
+        return reply
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            if session is not None:
+                session.close()
+        super().close()
+
+
+TRANSPORTS = {
+    "ssh": SubprocessTransport,
+    "paramiko": ParamikoTransport,
+    "agent": AgentTransport,
+}
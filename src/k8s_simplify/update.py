@@ -1,59 +1,211 @@
 """Utilities for upgrading a Kubernetes cluster."""
 
-from subprocess import CalledProcessError, run
-from typing import Dict, List
+import math
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-from .phase1 import _ssh_cmd, run_remote
+from .engine import DEFAULT_LIMIT
+from .facts import HostFacts, gather_facts
+from .parallel import format_results, run_per_host
+from .phase1 import Phase1Error, run_remote
+from .phase2 import run_remote_capture
 from .phase3 import verify_master_node
-from .phase5 import check_node_health
+from .images import kube_version
+from .phase5 import Phase5Error, check_node_health, get_nodes
+from .ratelimit import APT_MIRROR
 
 
-class UpdateError(Exception):
-    """Custom exception for update failures."""
+PACKAGES = ("kubelet", "kubeadm", "kubectl")
+_APT_CACHE = "/var/cache/apt/archives"
 
 
-def _get_version(ip: str, user: str, password: str) -> str:
-    cmd = _ssh_cmd(ip, user, password, "kubelet --version")
-    try:
-        result = run(cmd, check=True, capture_output=True, text=True)
-    except CalledProcessError as exc:
-        raise UpdateError(f"Failed to query version on {ip}") from exc
-    parts = result.stdout.strip().split()
-    return parts[-1] if parts else "unknown"
+class UpdateError(Exception):
+    """Custom exception for update failures."""
 
 
 def pre_update_check(
-    master_ip: str, worker_ips: List[str], user: str, password: str
+    master_ip: str,
+    worker_ips: List[str],
+    user: str,
+    password: str,
+    limit: int = DEFAULT_LIMIT,
 ) -> Dict[str, str]:
-    """Return current kubelet versions for all nodes."""
+    """Return current kubelet versions for all nodes, queried concurrently.
+
+    The version of every node is printed as soon as it arrives.
+    """
+
+    def _version(host: HostFacts) -> str:
+        parts = host.facts.get("kubelet_version", "").split()
+        return parts[-1] if parts else "unknown"
+
+    def _report(host: HostFacts) -> None:
+        if host.ok("kubelet_version"):
+            print(f"Current version on {host.host}: {_version(host)}")
+        else:
+            print(f"Failed to query version on {host.host}: {host.error or 'kubelet missing'}")
+
+    facts = gather_facts(
+        [master_ip] + worker_ips, user, password, ["kubelet_version"], limit, _report
+    )
     versions: Dict[str, str] = {}
-    for ip in [master_ip] + worker_ips:
-        versions[ip] = _get_version(ip, user, password)
+    for ip, host in facts.items():
+        if not host.ok("kubelet_version"):
+            raise UpdateError(f"Failed to query version on {ip}")
+        versions[ip] = _version(host)
     return versions
 
 
-def update_master(ip: str, user: str, password: str, version: str) -> None:
-    """Upgrade Kubernetes control plane on the master node."""
+def resolve_package_version(ip: str, user: str, password: str, version: str) -> str:
+    """Return the apt version of the Kubernetes packages for ``version``.
+
+    ``version`` may be a Kubernetes version such as ``v1.33.1`` or an exact
+    package version such as ``1.33.1-1.1``; the newest matching package
+    revision known to the host's repositories is returned.
+    """
+    wanted = version.lstrip("v")
     try:
+        output = run_remote_capture(
+            ip,
+            user,
+            password,
+            "sudo apt-get update -q >/dev/null && apt-cache madison kubeadm",
+            policy="apt",
+            resources=(APT_MIRROR,),
+        )
+    except Exception as exc:  # broad but acceptable for CLI
+        raise UpdateError(f"Failed to query package versions on {ip}") from exc
+    # madison lists "kubeadm | 1.33.1-1.1 | <repository>", newest first
+    for line in output.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) >= 2 and wanted in (parts[1], parts[1].split("-")[0]):
+            return parts[1]
+    raise UpdateError(f"No kubeadm package for version {version} found on {ip}")
+
+
+def _install_command(package_version: str, packages: Iterable[str] = PACKAGES) -> str:
+    """Return the install of pre-staged packages, failing if any is missing."""
+    pins = " ".join(f"{name}={package_version}" for name in packages)
+    return (
+        "sudo apt-get install -y --no-download --allow-change-held-packages "
+        f"--allow-downgrades {pins}"
+    )
+
+
+def _prestage_command(package_version: str) -> str:
+    pins = " ".join(f"{name}={package_version}" for name in PACKAGES)
+    # Packages already installed at the target version are not downloaded
+    verify = " && ".join(
+        f"{{ dpkg-query -W -f='${{Version}}' {name} 2>/dev/null | grep -qxF {package_version}"
+        f" || ls {_APT_CACHE}/{name}_{package_version}_*.deb >/dev/null 2>&1"
+        f" || {{ echo '{name} {package_version} not staged' >&2; false; }}; }}"
+        for name in PACKAGES
+    )
+    return (
+        "sudo apt-get update -q && sudo apt-get install -y -q --download-only "
+        f"--allow-change-held-packages --allow-downgrades {pins} && {verify}"
+    )
+
+
+def prestage_packages(
+    hosts: List[str],
+    user: str,
+    password: str,
+    package_version: str,
+    limit: int = DEFAULT_LIMIT,
+    groups: Optional[Dict[str, str]] = None,
+    group_limits: Optional[Dict[str, int]] = None,
+) -> None:
+    """Download the packages into the apt cache of all hosts concurrently.
+
+    Every host verifies that each package is cached or already installed at
+    ``package_version``, so the later install does not download anything.
+    """
+
+    def _stage(ip: str, log: Callable[[str], None]) -> None:
+        try:
+            run_remote(
+                ip,
+                user,
+                password,
+                _prestage_command(package_version),
+                policy="apt",
+                resources=(APT_MIRROR,),
+            )
+        except Phase1Error as exc:
+            raise UpdateError(f"Failed to pre-stage packages on {ip}") from exc
+        log(f" - Packages {package_version} staged on {ip}")
+
+    results = run_per_host(
+        hosts,
+        _stage,
+        limit,
+        errors=(UpdateError,),
+        groups=groups,
+        group_limits=group_limits,
+    )
+    failed = [r.host for r in results if not r.ok]
+    if failed:
+        print(format_results(results))
+        raise UpdateError("Failed to pre-stage packages on: " + ", ".join(failed))
+
+
+def update_master(
+    ip: str,
+    user: str,
+    password: str,
+    version: str,
+    package_version: Optional[str] = None,
+) -> None:
+    """Upgrade Kubernetes control plane on the master node.
+
+    With ``package_version`` the packages must have been pre-staged by
+    :func:`prestage_packages`; kubeadm is installed before and kubelet and
+    kubectl after the control plane upgrade, without downloads.
+    """
+    try:
+        if package_version is not None:
+            run_remote(ip, user, password, _install_command(package_version, ["kubeadm"]))
         run_remote(ip, user, password, f"sudo kubeadm upgrade apply -y {version}")
-        run_remote(ip, user, password, "sudo apt-get install -y kubelet kubeadm kubectl")
+        if package_version is not None:
+            run_remote(
+                ip,
+                user,
+                password,
+                _install_command(package_version, ["kubelet", "kubectl"]),
+            )
+        else:
+            run_remote(
+                ip,
+                user,
+                password,
+                "sudo apt-get install -y kubelet kubeadm kubectl",
+                resources=(APT_MIRROR,),
+            )
         run_remote(ip, user, password, "sudo systemctl restart kubelet")
     except Exception as exc:  # broad but acceptable for CLI
         raise UpdateError(f"Failed to update master {ip}") from exc
 
 
-def update_worker(ip: str, user: str, password: str, version: str) -> None:
-    """Upgrade Kubernetes components on a worker node."""
+def update_worker(
+    ip: str,
+    user: str,
+    password: str,
+    version: str,
+    package_version: Optional[str] = None,
+) -> None:
+    """Upgrade Kubernetes components on a worker node.
+
+    Pre-staged packages (``package_version``) are installed from the apt
+    cache only.
+    """
+    if package_version is not None:
+        install = _install_command(package_version)
+        resources: Tuple[str, ...] = ()
+    else:
+        install = f"sudo apt-get install -y kubelet={version} kubeadm={version} kubectl={version}"
+        resources = (APT_MIRROR,)
     try:
-        run_remote(
-            ip,
-            user,
-            password,
-            (
-                "sudo apt-get install -y "
-                f"kubelet={version} kubeadm={version} kubectl={version}"
-            ),
-        )
+        run_remote(ip, user, password, install, resources=resources)
         run_remote(
             ip,
             user,
@@ -65,10 +217,137 @@ def update_worker(ip: str, user: str, password: str, version: str) -> None:
         raise UpdateError(f"Failed to update worker {ip}") from exc
 
 
-def update_workers(worker_ips: List[str], user: str, password: str, version: str) -> None:
-    """Perform rolling update of worker nodes."""
-    for ip in worker_ips:
-        update_worker(ip, user, password, version)
+def batch_size(max_unavailable: str, total: int) -> int:
+    """Convert a count or percentage such as ``2`` or ``25%`` to a batch size."""
+    try:
+        if max_unavailable.endswith("%"):
+            percent = float(max_unavailable[:-1])
+            valid = 0 < percent <= 100
+            size = math.ceil(total * percent / 100)
+        else:
+            size = int(max_unavailable)
+            valid = size > 0
+    except ValueError:
+        valid = False
+    if not valid:
+        raise UpdateError(f"Invalid max unavailable value: {max_unavailable}")
+    return max(1, min(size, total))
+
+
+def _node_names(master_ip: str, user: str, password: str) -> Dict[str, str]:
+    """Return a mapping of every node address and name to the node name.
+
+    Addresses of all types (internal, external, hostname) are included, so
+    hosts may be given by any address the node reports.
+    """
+    try:
+        nodes = get_nodes(master_ip, user, password)
+    except Phase5Error as exc:
+        raise UpdateError(f"Failed to list nodes on {master_ip}") from exc
+    return {
+        address: node.name
+        for node in nodes.values()
+        for address in [node.name] + node.addresses
+    }
+
+
+def _kubectl(master_ip: str, user: str, password: str, args: str) -> None:
+    try:
+        run_remote(master_ip, user, password, f"kubectl {args}")
+    except Exception as exc:  # broad but acceptable for CLI
+        raise UpdateError(f"kubectl {args} failed on {master_ip}") from exc
+
+
+def _upgrade_in_window(
+    master_ip: str,
+    ip: str,
+    node: str,
+    user: str,
+    password: str,
+    version: str,
+    log: Callable[[str], None],
+    package_version: Optional[str] = None,
+) -> None:
+    """Cordon, drain, upgrade, wait for Ready and uncordon a single worker."""
+    log(f" - Draining {node} ({ip})")
+    _kubectl(master_ip, user, password, f"cordon {node}")
+    _kubectl(
+        master_ip,
+        user,
+        password,
+        f"drain {node} --ignore-daemonsets --delete-emptydir-data --timeout=300s",
+    )
+    log(f" - Upgrading {node} ({ip})")
+    update_worker(ip, user, password, version, package_version)
+    # The Ready condition from before the kubelet restart may still be set,
+    # so wait for the restarted kubelet to report its new version first
+    kubelet_version = kube_version(package_version or version)
+    _kubectl(
+        master_ip,
+        user,
+        password,
+        "wait --for=jsonpath='{.status.nodeInfo.kubeletVersion}'="
+        f"{kubelet_version} node/{node} --timeout=300s",
+    )
+    _kubectl(
+        master_ip,
+        user,
+        password,
+        f"wait --for=condition=Ready node/{node} --timeout=300s",
+    )
+    _kubectl(master_ip, user, password, f"uncordon {node}")
+    log(f" - {node} ({ip}) upgraded")
+
+
+def update_workers(
+    master_ip: str,
+    worker_ips: List[str],
+    user: str,
+    password: str,
+    version: str,
+    max_unavailable: str = "1",
+    groups: Optional[Dict[str, str]] = None,
+    group_limits: Optional[Dict[str, int]] = None,
+    package_version: Optional[str] = None,
+) -> None:
+    """Perform rolling update of worker nodes.
+
+    Workers are upgraded in batches of at most ``max_unavailable`` nodes (a
+    count or a percentage of the workers). Every node of a batch is cordoned,
+    drained and upgraded concurrently; the next batch starts only after the
+    whole batch is Ready and uncordoned again. A failing batch stops the
+    rollout and leaves its failed nodes cordoned. ``groups`` and
+    ``group_limits`` further limit the concurrency per inventory group.
+    ``package_version`` installs packages pre-staged by
+    :func:`prestage_packages`.
+    """
+    if not worker_ips:
+        return
+    size = batch_size(max_unavailable, len(worker_ips))
+    names = _node_names(master_ip, user, password)
+    missing = [ip for ip in worker_ips if ip not in names]
+    if missing:
+        raise UpdateError("No Kubernetes node found for: " + ", ".join(missing))
+    for start in range(0, len(worker_ips), size):
+        batch = worker_ips[start:start + size]
+        print(f"* Upgrading workers {start + 1}-{start + len(batch)} of {len(worker_ips)}")
+        results = run_per_host(
+            batch,
+            lambda ip, log: _upgrade_in_window(
+                master_ip, ip, names[ip], user, password, version, log, package_version
+            ),
+            len(batch),
+            errors=(UpdateError,),
+            groups=groups,
+            group_limits=group_limits,
+        )
+        failed = [r for r in results if not r.ok]
+        if failed:
+            print(format_results(results))
+            raise UpdateError(
+                "Rolling update stopped, failed workers: "
+                + ", ".join(r.host for r in failed)
+            )
 
 
 def post_update_validation(master_ip: str, worker_ips: List[str], user: str, password: str) -> None:
@@ -0,0 +1,115 @@
+import json
+
+import pytest
+
+from k8s_simplify import cli
+from k8s_simplify.connection import HostSettings
+from k8s_simplify.inventory import InventoryError, load_inventory, parse_inventory
+
+INVENTORY = {
+    "vars": {"user": "ubuntu", "key_file": "~/.ssh/cluster"},
+    "groups": {
+        "master": {"hosts": ["10.0.0.10"]},
+        "rack3": {
+            "parallel": 10,
+            "vars": {"user": "admin"},
+            "hosts": ["10.0.3.1", {"address": "10.0.3.2", "port": 2222}],
+        },
+        "rack4": {"hosts": ["10.0.4.1", "10.0.3.1"]},
+    },
+}
+
+
+def test_parse_inventory():
+    inventory = parse_inventory(INVENTORY)
+    assert inventory.master == "10.0.0.10"
+    assert inventory.workers == ["10.0.3.1", "10.0.3.2", "10.0.4.1"]
+    assert inventory.group_of("10.0.3.1") == "rack3"
+    assert inventory.group_limits() == {"rack3": 10}
+
+
+def test_settings_precedence():
+    hosts = parse_inventory(INVENTORY).hosts
+    assert hosts["10.0.0.10"] == HostSettings("ubuntu", "", 0, "~/.ssh/cluster")
+    assert hosts["10.0.3.1"] == HostSettings("admin", "", 0, "~/.ssh/cluster")
+    assert hosts["10.0.3.2"] == HostSettings("admin", "", 2222, "~/.ssh/cluster")
+
+
+@pytest.mark.parametrize(
+    "selectors, hosts",
+    [
+        (["group:rack3"], ["10.0.3.1", "10.0.3.2"]),
+        # Hosts are returned in inventory order
+        (["rack4"], ["10.0.3.1", "10.0.4.1"]),
+        (["host:10.0.4.1,10.0.0.10"], ["10.0.0.10", "10.0.4.1"]),
+        (["rack3", "rack4"], ["10.0.3.1", "10.0.3.2", "10.0.4.1"]),
+    ],
+)
+def test_select(selectors, hosts):
+    assert parse_inventory(INVENTORY).select(selectors) == hosts
+
+
+@pytest.mark.parametrize("selector", ["group:rack9", "host:10.9.9.9", "rack9", "node:x"])
+def test_select_rejects_unknown(selector):
+    with pytest.raises(InventoryError):
+        parse_inventory(INVENTORY).select([selector])
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        [],
+        {"groups": []},
+        {"groups": {"workers": {"hosts": ["10.0.0.2"]}}},
+        {"groups": {"master": ["10.0.0.1"]}},
+        {"groups": {"master": {"hosts": "10.0.0.1"}}},
+        {"groups": {"master": {"hosts": [42]}}},
+        {"groups": {"master": {"hosts": [{"port": 22}]}}},
+        {"groups": {"master": {"hosts": [{"address": "a", "port": "x"}]}}},
+        {"groups": {"master": {"hosts": ["a"], "parallel": "x"}}},
+        {"vars": ["root"], "groups": {"master": {"hosts": ["a"]}}},
+    ],
+)
+def test_parse_inventory_rejects_invalid(data):
+    with pytest.raises(InventoryError):
+        parse_inventory(data)
+
+
+def test_load_inventory(tmp_path):
+    path = tmp_path / "cluster.json"
+    path.write_text(json.dumps(INVENTORY))
+    assert load_inventory(str(path)).master == "10.0.0.10"
+    path.write_text("{")
+    with pytest.raises(InventoryError, match="Failed to read"):
+        load_inventory(str(path))
+
+
+def test_cluster_config_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, "register_hosts", lambda hosts: None)
+    path = tmp_path / "cluster.json"
+    path.write_text(json.dumps(INVENTORY))
+    args = cli.build_parser().parse_args(
+        [
+            "rollback",
+            "--inventory",
+            str(path),
+            "--limit",
+            "rack3",
+            "--transport",
+            "paramiko",
+        ]
+    )
+    cfg = cli.cluster_config(args, cluster_name="")
+    assert cfg.master_ip == "10.0.0.10"
+    assert cfg.worker_ips == ["10.0.3.1", "10.0.3.2"]
+    assert not cfg.manage_master
+    assert cfg.groups["10.0.4.1"] == "rack4"
+    assert cfg.group_limits == {"rack3": 10}
+
+
+def test_cluster_config_limit_requires_inventory():
+    args = cli.build_parser().parse_args(
+        ["rollback", "--master", "10.0.0.1", "--limit", "rack3"]
+    )
+    with pytest.raises(SystemExit, match="--limit requires --inventory"):
+        cli.cluster_config(args, cluster_name="")
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from k8s_simplify import ratelimit
+from k8s_simplify.ratelimit import (
+    MIN_SCALE,
+    Limit,
+    RateLimitError,
+    Resource,
+    configure,
+    consume,
+    limits_summary,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_limits(monkeypatch):
+    monkeypatch.setattr(ratelimit, "LIMITS", dict(ratelimit.LIMITS))
+    monkeypatch.setattr(ratelimit, "_resources", {})
+
+
+def test_configure():
+    configure(["apt-mirror=20:2.5", "registry=4"])
+    assert ratelimit.LIMITS["apt-mirror"] == Limit(20, 2.5)
+    assert ratelimit.LIMITS["registry"] == Limit(4, 0.0)
+
+
+@pytest.mark.parametrize("spec", ["apt-mirror", "=4", "x=a", "x=4:b", "x=-1", "x=1:-2"])
+def test_configure_rejects_invalid_specs(spec):
+    with pytest.raises(RateLimitError):
+        configure([spec])
+
+
+def test_concurrency_limit():
+    resource = Resource("test", Limit(concurrency=2))
+    lock = threading.Lock()
+    in_use, peak = [0], [0]
+
+    def work():
+        resource.acquire()
+        with lock:
+            in_use[0] += 1
+            peak[0] = max(peak[0], in_use[0])
+        time.sleep(0.02)
+        with lock:
+            in_use[0] -= 1
+        resource.release()
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
+    assert resource.stats.acquired == 6
+
+
+def test_token_bucket_limits_start_rate():
+    resource = Resource("test", Limit(rate=50.0))
+    start = time.monotonic()
+    for _ in range(6):
+        resource.acquire()
+        resource.release()
+    # The first start uses the initial token, the others wait for a refill
+    assert time.monotonic() - start >= 5 / 50 * 0.9
+    assert resource.stats.wait > 0
+
+
+def test_backoff_and_recovery():
+    resource = Resource("test", Limit(concurrency=16))
+    for expected in (0.5, 0.25):
+        resource.acquire()
+        resource.release(upstream_error=True)
+        assert resource.scale() == expected
+    for _ in range(10):
+        resource.acquire()
+        resource.release(upstream_error=True)
+    assert resource.scale() == MIN_SCALE
+    assert resource.stats.backoffs == 12
+    for _ in range(15):
+        resource.acquire()
+        resource.release()
+    assert resource.scale() == 1.0
+
+
+def test_consume_backs_off_only_on_upstream_errors():
+    configure(["mirror=8"])
+    with consume(["mirror"]) as usage:
+        usage.report(100, "E: Unable to locate package kubelett")
+    assert ratelimit._resource("mirror").scale() == 1.0
+    with consume(["mirror"]) as usage:
+        usage.report(100, "E: Failed to fetch ... 503  Service Unavailable")
+    assert ratelimit._resource("mirror").scale() == 0.5
+
+
+def test_consume_releases_on_error():
+    configure(["mirror=1"])
+    with pytest.raises(RuntimeError):
+        with consume(["mirror"]):
+            raise RuntimeError("boom")
+    with consume(["mirror"]):
+        pass
+    assert ratelimit._resource("mirror").stats.acquired == 2
+
+
+def test_limits_summary():
+    assert limits_summary() == "No rate-limited resources used"
+    with consume(["apt-mirror"]):
+        pass
+    assert "apt-mirror" in limits_summary()
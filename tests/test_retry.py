@@ -0,0 +1,104 @@
+import pytest
+
+from k8s_simplify import phase1, retry
+from k8s_simplify.phase1 import Phase1Error, Step, StepResult, run_steps
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(retry.time, "sleep", lambda delay: None)
+
+
+@pytest.mark.parametrize(
+    "returncode, output, kind",
+    [
+        (255, "", "ssh connection"),
+        (100, "E: Could not get lock /var/lib/dpkg/lock-frontend", "dpkg lock"),
+        (100, "E: Failed to fetch ... 503  Service Unavailable", "mirror error"),
+        (100, "W: Hash Sum mismatch", "mirror error"),
+        (6, "curl: (6) Could not resolve host: pkgs.k8s.io", "network"),
+        (1, "Error from server: etcdserver: too many requests", "api overload"),
+        (100, "E: Unable to locate package kubelett", None),
+        (1, "", None),
+    ],
+)
+def test_classify(returncode, output, kind):
+    assert retry.classify(returncode, output) == kind
+
+
+def test_should_retry_transient_until_budget_exhausted():
+    assert retry.should_retry(1, 255, "")
+    assert retry.should_retry(2, 255, "")
+    assert not retry.should_retry(3, 255, "")
+
+
+def test_should_retry_permanent_failure():
+    assert not retry.should_retry(1, 1, "No such file or directory")
+
+
+def test_should_retry_policy_and_override():
+    lock = "Could not get lock"
+    assert retry.should_retry(5, 100, lock, "apt")
+    assert not retry.should_retry(6, 100, lock, "apt")
+    assert not retry.should_retry(1, 100, lock, "apt", retries=0)
+
+
+def test_should_retry_unknown_policy():
+    with pytest.raises(ValueError):
+        retry.should_retry(1, 255, "", "missing")
+
+
+def test_delay_is_capped():
+    policy = retry.RetryPolicy(base_delay=1.0, max_delay=4.0)
+    assert all(0 <= policy.delay(attempt) <= 4.0 for attempt in range(1, 10))
+
+
+def fake_batches(monkeypatch, failures):
+    """Make ``run_batch`` fail the named steps with an ssh error once each time."""
+    calls = []
+
+    def run_batch(ip, user, password, steps, attempt=1):
+        calls.append(([step.name for step in steps], attempt))
+        results = []
+        for step in steps:
+            if failures.get(step.name, 0) > 0:
+                failures[step.name] -= 1
+                results.append(StepResult(step.name, 255, 0.0, "connection lost"))
+                break
+            results.append(StepResult(step.name, 0, 0.0, ""))
+        return results
+
+    monkeypatch.setattr(phase1, "run_batch", run_batch)
+    return calls
+
+
+STEPS = [Step(name, "true") for name in ("a", "b", "c")]
+
+
+def test_run_steps_retries_from_failed_step(monkeypatch):
+    calls = fake_batches(monkeypatch, {"b": 1})
+    done = run_steps("10.0.0.1", "root", "", STEPS)
+    assert [r.name for r in done] == ["a", "b", "c"]
+    assert calls == [(["a", "b", "c"], 1), (["b", "c"], 2)]
+
+
+def test_run_steps_retry_budget_is_per_step(monkeypatch):
+    # Two retries each for b and c exceed a budget shared by the batch
+    calls = fake_batches(monkeypatch, {"b": 2, "c": 2})
+    done = run_steps("10.0.0.1", "root", "", STEPS)
+    assert [r.name for r in done] == ["a", "b", "c"]
+    assert [attempt for _, attempt in calls] == [1, 2, 3, 2, 3]
+
+
+def test_run_steps_gives_up_after_budget(monkeypatch):
+    fake_batches(monkeypatch, {"b": 3})
+    with pytest.raises(Phase1Error, match="Step 'b' failed"):
+        run_steps("10.0.0.1", "root", "", STEPS)
+
+
+def test_run_steps_skips_and_reports(monkeypatch):
+    calls = fake_batches(monkeypatch, {})
+    seen = []
+    run_steps("10.0.0.1", "root", "", STEPS, skip={"a"}, on_step=seen.append)
+    assert calls == [(["b", "c"], 1)]
+    assert [r.name for r in seen] == ["b", "c"]
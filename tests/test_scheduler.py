@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+from k8s_simplify.scheduler import SchedulerError, Task, make_plan, run_tasks
+
+
+def recorder(log, name, delay=0.0):
+    def func():
+        log.append(("start", name))
+        time.sleep(delay)
+        log.append(("end", name))
+
+    return func
+
+
+def test_run_tasks_respects_dependencies():
+    log = []
+    tasks = [
+        Task("c", recorder(log, "c"), ["a", "b"]),
+        Task("a", recorder(log, "a")),
+        Task("b", recorder(log, "b"), ["a"]),
+    ]
+    run_tasks(tasks)
+    assert [name for event, name in log if event == "end"] == ["a", "b", "c"]
+    assert log.index(("end", "b")) < log.index(("start", "c"))
+
+
+def test_run_tasks_starts_critical_path_first():
+    log = []
+    tasks = [
+        Task("short", recorder(log, "short"), estimate=1),
+        Task("long", recorder(log, "long"), estimate=5),
+        Task("tail", recorder(log, "tail"), ["long"], estimate=5),
+    ]
+    run_tasks(tasks, limit=1)
+    assert log[0] == ("start", "long")
+
+
+def test_run_tasks_limits_tasks_per_host():
+    running, peak = [], []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    tasks = [Task(str(i), work, hosts=["10.0.0.1"]) for i in range(3)]
+    run_tasks(tasks, limit=4, host_limit=1)
+    assert max(peak) == 1
+    peak.clear()
+    run_tasks(tasks, limit=4, host_limit=3)
+    assert max(peak) > 1
+
+
+def test_run_tasks_stops_after_failure():
+    log = []
+
+    def fail():
+        raise SystemExit(1)
+
+    tasks = [
+        Task("fail", fail),
+        Task("slow", recorder(log, "slow", 0.05)),
+        Task("after", recorder(log, "after"), ["slow"]),
+    ]
+    with pytest.raises(SystemExit):
+        run_tasks(tasks, limit=2)
+    # The running task finishes, its dependents are not started
+    assert ("end", "slow") in log
+    assert ("start", "after") not in log
+
+
+@pytest.mark.parametrize(
+    "tasks, message",
+    [
+        ([Task("a", None, ["b"]), Task("b", None, ["a"])], "cycle"),
+        ([Task("a", None, ["missing"])], "unknown"),
+        ([Task("a", None), Task("a", None)], "Duplicate"),
+    ],
+)
+def test_invalid_graphs(tasks, message):
+    with pytest.raises(SchedulerError, match=message):
+        make_plan(tasks)
+    with pytest.raises(SchedulerError, match=message):
+        run_tasks(tasks)
+
+
+def test_make_plan():
+    tasks = [
+        Task("prepare", None, [], ["m"], 10),
+        Task("workers", None, [], ["w"], 30),
+        Task("init", None, ["prepare"], ["m"], 10),
+        Task("join", None, ["init", "workers"], ["w"], 5),
+    ]
+    plan = make_plan(tasks)
+    assert plan.schedule["init"] == (10, 20)
+    assert plan.schedule["join"] == (30, 35)
+    assert plan.critical_path == ["workers", "join"]
+    assert plan.duration == 35
+    assert plan.peak == 2
+    assert "Critical path (*): workers -> join (35s)" in plan.format()
+
+
+def test_make_plan_serialises_tasks_on_one_host():
+    tasks = [Task("a", None, [], ["m"], 10), Task("b", None, [], ["m"], 10)]
+    assert make_plan(tasks).duration == 20
+    assert make_plan(tasks, host_limit=2).duration == 10
+    assert make_plan(tasks, limit=1, host_limit=2).duration == 20